@@ -31,6 +31,7 @@ from DesignFileBuilder import UnexpectedDeltaException, DesignFileBuilder, BitCo
 ### To get the pips for every tile, the first thing this fuzzer does is download the node database from lark/lapie tools.
 ### This is pretty slow -- expect 2-3 hours per device -- but the results are cached into a sqlite database so this is
 ### a one time thing.
+### Run tools/prefetch_nodes.py first to download it up front in parallel, resumably.
 ###
 ### To minimize the number of bitstreams built, this fuzzer uses DesignFileBuilder. This construct can combine multiple
 ### PIPs to solve into a single design. This brings the total number of bitfiles needed from around 20k per device to
@@ -141,10 +141,10 @@ def main():
                 prim_type = prim_type[0:wid_idx]
             bit = cfg.build_design(cfg.sv, dict(cmt="", prim=prim_type, site=site, config=ip_settings[prim]))
             with fuzzconfig.db_lock() as db:
-                chip = libpyprjoxide.Chip.from_bitstream(db, bit.bitstream)
+                chip = libpyprjoxide.Chip.from_bitstream(db, bit.source)
                 ipv = chip.get_ip_values()
 
-            logging.info(f"{bit.bitstream} {cfg.device} {site} {prim} has {len(ipv)} IP deltas")
+            logging.info(f"{bit} {cfg.device} {site} {prim} has {len(ipv)} IP deltas")
             if len(ipv) == 0:
                 continue
 
@@ -16,7 +16,7 @@ def main():
         for cfg in cfgs:
             cfg.setup()
             empty = cfg.build_design(cfg.sv, {})
-            libpyprjoxide.add_always_on_bits(db, empty.bitstream)
+            libpyprjoxide.add_always_on_bits(db, empty.source)
 
 if __name__ == "__main__":
     fuzzloops.FuzzerMain(main)
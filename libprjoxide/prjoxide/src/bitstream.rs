@@ -107,6 +107,23 @@ impl BitstreamParser {
         Ok(c)
     }
 
+    // Parse a bitstream already in memory, gzipped or not
+    pub fn parse_bytes(db: &mut Database, data: &[u8]) -> Result<Chip, String> {
+        let mut buffer = Vec::new();
+        let data = if data.starts_with(&[0x1F, 0x8B]) {
+            GzDecoder::new(data).read_to_end(&mut buffer)
+                .map_err(|x| format!("failed to decompress bitstream: {x:?}"))?;
+            &buffer[..]
+        } else {
+            data
+        };
+
+        let mut parser = BitstreamParser::new(data);
+        let mut c = parser.parse(db)?;
+        c.cram_to_tiles();
+        Ok(c)
+    }
+
     pub fn serialise_chip(ch: &Chip) -> Vec<u8> {
         let mut b = BitstreamParser {
             data: Vec::new(),
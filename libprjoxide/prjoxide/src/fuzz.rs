@@ -140,8 +140,12 @@ impl Fuzzer {
     }
     fn add_sample(&mut self, db: &mut Database, key: FuzzKey, bitfile: &str) {
         let parsed_bitstream = BitstreamParser::parse_file(db, bitfile).unwrap();
+        trace!("Sample {bitfile} {key:?}");
+        self.add_sample_chip(key, &parsed_bitstream);
+    }
+    fn add_sample_chip(&mut self, key: FuzzKey, parsed_bitstream: &Chip) {
         let delta: ChipDelta = parsed_bitstream.delta(&self.base);
-        trace!("Sample delta {bitfile} {key:?} {delta:?}");
+        trace!("Sample delta {key:?} {delta:?}");
         self.add_sample_delta(key, delta);
     }
 
@@ -164,6 +168,15 @@ impl Fuzzer {
             delta,
         );
     }
+    pub fn add_pip_sample_chip(&mut self, from_wire: &str, parsed_bitstream: &Chip, allow_partial_deltas: bool) {
+        self.add_sample_chip(
+            FuzzKey::PipKey {
+                from_wire: from_wire.to_string(),
+                allow_partial_deltas
+            },
+            parsed_bitstream,
+        );
+    }
     pub fn add_pip_sample_with_partial_delta(&mut self, db: &mut Database, from_wire: &str, bitfile: &str) {
         self.add_sample(
             db,
@@ -177,6 +190,9 @@ impl Fuzzer {
     pub fn add_word_sample(&mut self, db: &mut Database, index: usize, bitfile: &str) {
         self.add_sample(db, FuzzKey::WordKey { bit: index }, bitfile);
     }
+    pub fn add_word_sample_chip(&mut self, index: usize, parsed_bitstream: &Chip) {
+        self.add_sample_chip(FuzzKey::WordKey { bit: index }, parsed_bitstream);
+    }
     pub fn add_word_delta(&mut self, index: usize, delta : ChipDelta) {
         self.add_sample_delta( FuzzKey::WordKey { bit: index }, delta);
     }
@@ -190,6 +206,15 @@ impl Fuzzer {
         );
     }
 
+    pub fn add_enum_sample_chip(&mut self, option: &str, parsed_bitstream: &Chip) {
+        self.add_sample_chip(
+            FuzzKey::EnumKey {
+                option: option.to_string(),
+            },
+            parsed_bitstream,
+        );
+    }
+
     pub fn add_enum_sample(&mut self, db: &mut Database, option: &str, bitfile: &str) {
         self.add_sample(
             db,
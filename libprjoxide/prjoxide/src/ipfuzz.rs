@@ -74,6 +74,9 @@ impl IPFuzzer {
     }
     fn add_sample(&mut self, db: &mut Database, key: IPFuzzKey, bitfile: &str) {
         let parsed_bitstream = BitstreamParser::parse_file(db, bitfile).unwrap();
+        self.add_sample_chip(db, key, &parsed_bitstream);
+    }
+    fn add_sample_chip(&mut self, db: &mut Database, key: IPFuzzKey, parsed_bitstream: &Chip) {
         let addr_opt = db
             .device_baseaddrs(&parsed_bitstream.family, &parsed_bitstream.device)
             .regions
@@ -91,6 +94,18 @@ impl IPFuzzer {
     pub fn add_word_sample(&mut self, db: &mut Database, set_bits: Vec<bool>, bitfile: &str) {
         self.add_sample(db, IPFuzzKey::WordKey { bits: set_bits }, bitfile);
     }
+    pub fn add_word_sample_chip(&mut self, db: &mut Database, set_bits: Vec<bool>, parsed_bitstream: &Chip) {
+        self.add_sample_chip(db, IPFuzzKey::WordKey { bits: set_bits }, parsed_bitstream);
+    }
+    pub fn add_enum_sample_chip(&mut self, db: &mut Database, option: &str, parsed_bitstream: &Chip) {
+        self.add_sample_chip(
+            db,
+            IPFuzzKey::EnumKey {
+                option: option.to_string(),
+            },
+            parsed_bitstream,
+        );
+    }
     pub fn add_enum_sample(&mut self, db: &mut Database, option: &str, bitfile: &str) {
         self.add_sample(
             db,
@@ -12,13 +12,35 @@ use prjoxide::sites;
 use prjoxide::wires;
 use pyo3::exceptions::PyException;
 use pyo3::prelude::*;
-use pyo3::types::{PyList, PySet};
+use pyo3::types::{PyBytes, PyList, PySet};
 use pyo3::wrap_pyfunction;
 use std::collections::BTreeSet;
 use std::fs::File;
 use std::io::*;
 use prjoxide::chip::ChipDelta;
 
+// A bitstream passed from Python: either the path of a file, gzipped or not, or its contents as bytes
+enum BitstreamSource<'a> {
+    File(String),
+    Contents(&'a [u8]),
+}
+
+impl<'a> BitstreamSource<'a> {
+    fn extract(obj: &'a PyAny) -> PyResult<BitstreamSource<'a>> {
+        match obj.extract::<&PyBytes>() {
+            Ok(contents) => Ok(BitstreamSource::Contents(contents.as_bytes())),
+            Err(_) => Ok(BitstreamSource::File(obj.extract::<String>()?)),
+        }
+    }
+
+    fn parse(&self, db: &mut database::Database) -> std::result::Result<chip::Chip, String> {
+        match self {
+            BitstreamSource::File(filename) => bitstream::BitstreamParser::parse_file(db, filename),
+            BitstreamSource::Contents(data) => bitstream::BitstreamParser::parse_bytes(db, data),
+        }
+    }
+}
+
 #[pyclass]
 struct Database {
     db: database::Database
@@ -132,14 +154,15 @@ impl Fuzzer {
     #[staticmethod]
     pub fn word_fuzzer(
         db: &mut Database,
-        base_bitfile: &str,
+        base_bitfile: &PyAny,
         fuzz_tiles: &PySet,
         name: &str,
         desc: &str,
         width: usize,
-        zero_bitfile: &str,
+        zero_bitfile: &PyAny,
     ) -> Fuzzer {
-        let base_chip = bitstream::BitstreamParser::parse_file(&mut db.db, base_bitfile).unwrap();
+        let base_chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
+        let zero_bitfile = zero_bitfile.extract::<&str>().unwrap_or("");
 
         Fuzzer {
             fz: fuzz::Fuzzer::init_word_fuzzer(
@@ -161,7 +184,7 @@ impl Fuzzer {
     #[staticmethod]
     pub fn pip_fuzzer(
         db: &mut Database,
-        base_bitfile: &str,
+        base_bitfile: &PyAny,
         fuzz_tiles: &PySet,
         to_wire: &str,
         fixed_conn_tile: &str,
@@ -179,8 +202,10 @@ impl Fuzzer {
             .map(|x| x.extract::<String>().unwrap())
             .collect();
 
+        let base_bitfile = BitstreamSource::extract(base_bitfile).unwrap();
+
         py.allow_threads(|| {
-            let base_chip = bitstream::BitstreamParser::parse_file(&mut db.db, base_bitfile).unwrap();
+            let base_chip = base_bitfile.parse(&mut db.db).unwrap();
 
             Fuzzer {
                 fz: fuzz::Fuzzer::init_pip_fuzzer(
@@ -200,7 +225,7 @@ impl Fuzzer {
     #[staticmethod]
     pub fn enum_fuzzer(
         db: &mut Database,
-        base_bitfile: &str,
+        base_bitfile: &PyAny,
         fuzz_tiles: &PySet,
         name: &str,
         desc: &str,
@@ -209,7 +234,7 @@ impl Fuzzer {
         mark_relative_to: Option<String>,
         overlay: &str
     ) -> Fuzzer {
-        let base_chip = bitstream::BitstreamParser::parse_file(&mut db.db, base_bitfile).unwrap();
+        let base_chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
 
         Fuzzer {
             fz: fuzz::Fuzzer::init_enum_fuzzer(
@@ -229,31 +254,41 @@ impl Fuzzer {
         }
     }
 
-    fn add_word_sample(&mut self, db: &mut Database, index: usize, base_bitfile: &str) {
-        self.fz.add_word_sample(&mut db.db, index, base_bitfile);
+    fn add_word_sample(&mut self, db: &mut Database, index: usize, base_bitfile: &PyAny) {
+        let chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
+        self.fz.add_word_sample_chip(index, &chip);
     }
-    fn add_pip_sample(&mut self, db: &mut Database, from_wire: &str, base_bitfile: &str) {
-        self.fz.add_pip_sample(&mut db.db, from_wire, base_bitfile);
+    fn add_pip_sample(&mut self, db: &mut Database, from_wire: &str, base_bitfile: &PyAny) {
+        let chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
+        self.fz.add_pip_sample_chip(from_wire, &chip, false);
     }
 
-    fn add_pip_samples(&mut self, db: &mut Database, samples: Vec<(String, String)>, py: Python) {
+    fn add_pip_samples(&mut self, db: &mut Database, samples: Vec<(String, &PyAny)>, py: Python) -> PyResult<()> {
+        let samples = samples
+            .into_iter()
+            .map(|(from_wire, base_bitfile)| Ok((from_wire, BitstreamSource::extract(base_bitfile)?)))
+            .collect::<PyResult<Vec<_>>>()?;
         py.allow_threads(|| {
             samples.iter().for_each(|(from_wire, base_bitfile)| {
-                self.fz.add_pip_sample(&mut db.db, from_wire, base_bitfile);
+                let chip = base_bitfile.parse(&mut db.db).unwrap();
+                self.fz.add_pip_sample_chip(from_wire, &chip, false);
             });
         });
+        Ok(())
     }
 
     fn add_pip_sample_delta(&mut self, from_wire: &str, delta: chip::ChipDelta) {
         self.fz.add_pip_sample_delta(from_wire, delta);
     }
 
-    fn add_pip_sample_with_partial_delta(&mut self, db: &mut Database, from_wire: &str, base_bitfile: &str) {
-        self.fz.add_pip_sample_with_partial_delta(&mut db.db, from_wire, base_bitfile);
+    fn add_pip_sample_with_partial_delta(&mut self, db: &mut Database, from_wire: &str, base_bitfile: &PyAny) {
+        let chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
+        self.fz.add_pip_sample_chip(from_wire, &chip, true);
     }
 
-    fn add_enum_sample(&mut self, db: &mut Database, option: &str, base_bitfile: &str) {
-        self.fz.add_enum_sample(&mut db.db, option, base_bitfile);
+    fn add_enum_sample(&mut self, db: &mut Database, option: &str, base_bitfile: &PyAny) {
+        let chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
+        self.fz.add_enum_sample_chip(option, &chip);
     }
     fn add_enum_delta(&mut self, option: &str, delta: ChipDelta) {
         self.fz.add_enum_delta(option, delta);
@@ -285,7 +320,7 @@ impl IPFuzzer {
     #[staticmethod]
     pub fn word_fuzzer(
         db: &mut Database,
-        base_bitfile: &str,
+        base_bitfile: &PyAny,
         fuzz_ipcore: &str,
         fuzz_iptype: &str,
         name: &str,
@@ -293,7 +328,7 @@ impl IPFuzzer {
         width: usize,
         inverted_mode: bool,
     ) -> IPFuzzer {
-        let base_chip = bitstream::BitstreamParser::parse_file(&mut db.db, base_bitfile).unwrap();
+        let base_chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
 
         IPFuzzer {
             fz: ipfuzz::IPFuzzer::init_word_fuzzer(
@@ -313,13 +348,13 @@ impl IPFuzzer {
     #[staticmethod]
     pub fn enum_fuzzer(
         db: &mut Database,
-        base_bitfile: &str,
+        base_bitfile: &PyAny,
         fuzz_ipcore: &str,
         fuzz_iptype: &str,
         name: &str,
         desc: &str,
     ) -> IPFuzzer {
-        let base_chip = bitstream::BitstreamParser::parse_file(&mut db.db, base_bitfile).unwrap();
+        let base_chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
 
         IPFuzzer {
             fz: ipfuzz::IPFuzzer::init_enum_fuzzer(
@@ -333,16 +368,18 @@ impl IPFuzzer {
         }
     }
 
-    fn add_word_sample(&mut self, db: &mut Database, bits: &PyList, base_bitfile: &str) {
-        self.fz.add_word_sample(
+    fn add_word_sample(&mut self, db: &mut Database, bits: &PyList, base_bitfile: &PyAny) {
+        let chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
+        self.fz.add_word_sample_chip(
             &mut db.db,
             bits.iter().map(|x| x.extract::<bool>().unwrap()).collect(),
-            base_bitfile,
+            &chip,
         );
     }
 
-    fn add_enum_sample(&mut self, db: &mut Database, option: &str, base_bitfile: &str) {
-        self.fz.add_enum_sample(&mut db.db, option, base_bitfile);
+    fn add_enum_sample(&mut self, db: &mut Database, option: &str, base_bitfile: &PyAny) {
+        let chip = BitstreamSource::extract(base_bitfile).unwrap().parse(&mut db.db).unwrap();
+        self.fz.add_enum_sample_chip(&mut db.db, option, &chip);
     }
 
     fn solve(&mut self, db: &mut Database) {
@@ -381,8 +418,8 @@ fn copy_db(
 }
 
 #[pyfunction]
-fn add_always_on_bits(db: &mut Database, empty_bitfile: &str) {
-    let mut empty_chip = bitstream::BitstreamParser::parse_file(&mut db.db, empty_bitfile).unwrap();
+fn add_always_on_bits(db: &mut Database, empty_bitfile: &PyAny) {
+    let mut empty_chip = BitstreamSource::extract(empty_bitfile).unwrap().parse(&mut db.db).unwrap();
     empty_chip.cram_to_tiles();
     fuzz::add_always_on_bits(&mut db.db, &empty_chip);
 }
@@ -404,9 +441,10 @@ impl Chip {
     }
 
     #[staticmethod]
-    pub fn from_bitstream(db: &mut Database, filename: &str,  py: Python) -> Chip {
+    pub fn from_bitstream(db: &mut Database, filename: &PyAny,  py: Python) -> Chip {
+        let source = BitstreamSource::extract(filename).unwrap();
         py.allow_threads(|| {
-            let chip = bitstream::BitstreamParser::parse_file(&mut db.db, filename).unwrap();
+            let chip = source.parse(&mut db.db).unwrap();
             Chip { c: chip }
         })
     }
@@ -419,15 +457,17 @@ impl Chip {
         self.c.ipconfig.iter().map(|(a, d)| (*a, *d)).collect()
     }
 
-    fn delta_with_ipvalues(&self, db: &mut Database, new_bitstream: &str, py: Python) -> PyResult<(chip::ChipDelta, Vec<(u32, u8)>)> {
+    fn delta_with_ipvalues(&self, db: &mut Database, new_bitstream: &PyAny, py: Python) -> PyResult<(chip::ChipDelta, Vec<(u32, u8)>)> {
+        let source = BitstreamSource::extract(new_bitstream)?;
         py.allow_threads(|| {
-            let parsed_bitstream = bitstream::BitstreamParser::parse_file(&mut db.db, new_bitstream).unwrap();
+            let parsed_bitstream = source.parse(&mut db.db).map_err(PyException::new_err)?;
             Ok((parsed_bitstream.delta(&self.c), parsed_bitstream.ipconfig.iter().map(|(a, d)| (*a, *d)).collect()))
         })
     }
-    fn delta(&self, db: &mut Database, new_bitstream: &str, py: Python) -> PyResult<chip::ChipDelta> {
+    fn delta(&self, db: &mut Database, new_bitstream: &PyAny, py: Python) -> PyResult<chip::ChipDelta> {
+        let source = BitstreamSource::extract(new_bitstream)?;
         py.allow_threads(|| {
-            let parsed_bitstream = bitstream::BitstreamParser::parse_file(&mut db.db, new_bitstream).unwrap();
+            let parsed_bitstream = source.parse(&mut db.db).map_err(PyException::new_err)?;
             Ok(parsed_bitstream.delta(&self.c))
         })
     }
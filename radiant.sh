@@ -64,6 +64,30 @@ esac
 SCRIPT_PATH=$(readlink -f "${BASH_SOURCE:-$0}")
 SCRIPT_DIR=$(dirname "$SCRIPT_PATH")
 bscache=${BITSTREAM_CACHE:-$SCRIPT_DIR/tools/bitstreamcache.py}
+bscache_socket=${BITSTREAM_CACHE_SOCKET:-$SCRIPT_DIR/.bitstreamcache/daemon.sock}
+
+# Cache lookups and commits. Builds started from the Python fuzzers set NO_BITSTREAM_CACHE, since they look up and
+# commit in-process. If `tools/bitstreamcache.py serve` is running (and socat is installed) calls go to it instead of
+# starting a new interpreter each time.
+bitstream_cache() {
+	if [ -n "$NO_BITSTREAM_CACHE" ]; then
+		[ "$1" = "commit" ]
+		return
+	fi
+	if [ -S "$bscache_socket" ] && command -v socat > /dev/null; then
+		local fields=("$1" "$PWD") k
+		for k in RADIANTDIR GEN_RBF DEV_PACKAGE SPEED_GRADE STRUCT_VER RBK_MODE; do
+			if [[ "$(declare -p $k 2> /dev/null)" == "declare -x"* ]]; then fields+=("env:$k=${!k}"); fi
+		done
+		fields+=("${@:2}")
+		local reply
+		reply=$(IFS=$'\t'; echo "${fields[*]}" | socat - "UNIX-CONNECT:$bscache_socket" 2> /dev/null)
+		if [ "$reply" = "0" ] || [ "$reply" = "1" ]; then
+			return $reply
+		fi
+	fi
+	LD_LIBRARY_PATH=$ld_lib_path_orig $bscache "$@"
+}
 
 (
 
@@ -73,7 +97,7 @@ cp "$2.v" "$2.tmp/input.v"
 MAYBE_PDC=""
 if [ -e "$2.pdc" ]; then cp "$2.pdc" "$2.tmp/input.pdc"; MAYBE_PDC="$2.tmp/input.pdc"; fi
 
-if ([ -z "$FORCE_REBUILD"] && (LD_LIBRARY_PATH=$ld_lib_path_orig $bscache fetch $PART "$2.tmp" "$2.tmp/input.v" $MAYBE_PDC)); then
+if [ -z "$FORCE_REBUILD" ] && bitstream_cache fetch $PART "$2.tmp" "$2.tmp/input.v" $MAYBE_PDC; then
 	# Cache hit
 	echo "Cache hit, not running Radiant"
 else
@@ -106,7 +130,7 @@ else
 		  exit -1
 		fi
 
-		LD_LIBRARY_PATH=$ld_lib_path_orig $bscache commit $PART "input.v" $MAP_PDC output "par.udb" "par.rbt"
+		bitstream_cache commit $PART "input.v" $MAP_PDC output "par.udb" "par.rbt"
 	else
 		if [ -n "$RBK_MODE" ]; then
 			OUTPUT=$("$fpgabindir"/bitgen $EXTRA_BIT_ARGS -d -w -m 1 par.udb 2>&1)
@@ -120,7 +144,7 @@ else
 			   exit -1
 		  fi
 
-		LD_LIBRARY_PATH=$ld_lib_path_orig $bscache commit $PART "input.v" $MAP_PDC output "par.udb" "par.bit"
+		bitstream_cache commit $PART "input.v" $MAP_PDC output "par.udb" "par.bit"
 	fi
 	export LD_LIBRARY_PATH=""
 fi
@@ -6,9 +6,21 @@ This avoids expensive bitstream rebuilds when making small changes to the
 fuzzer and the Verilog input is largely unchanged.
 
 Note that it is disabled by default. Run:
-    tools/bitstreamcache.py init
+    tools/bitstreamcache.py init [MAX SIZE]
 to start using it.
 
+Entries live in a single sqlite file, `.bitstreamcache/store.sqlite`, keyed by the Radiant version and a hash of the
+inputs. All products of a build are committed in one transaction, and every entry records when it was last used. If
+a maximum size is set (`init 200G`, or BITSTREAM_CACHE_MAX_SIZE) commits evict the least recently used entries once
+the store grows past it.
+
+Bitstreams of a device mostly match each other, so the first `.bit` committed for a device and set of build options
+is kept as its baseline, and later ones are stored as the byte runs where they differ from it. Fetches rebuild the
+full bitstream; fetch_bit_diff hands out the runs themselves.
+
+Builds that fail are recorded under the same key with the error, and the Python build path raises it again instead of
+rerunning Radiant. Failures are kept per Radiant version.
+
 Usage:
     tools/bitstreamcache.py fetch <DEVICE> <OUTPUT DIR> <INPUT FILE 1> <INPUT FILE 2> ...
         if a bitstream with the given configuration and input already exists,
@@ -17,24 +29,470 @@ Usage:
     tools/bitstreamcache.py commit <DEVICE> <INPUT FILE 1> <INPUT FILE 2> output <OUTPUT FILE 1> ..
         save output files as the products of the input files and configuration
 
-gzip and gunzip must be on your path for it to work
+    tools/bitstreamcache.py gc [MAX SIZE]
+        evict least recently used entries down to the size cap, drop failures recorded with other Radiant versions
+        and return the freed space to the file system
+
+    tools/bitstreamcache.py stats
+        print entry counts and sizes
+
+    tools/bitstreamcache.py migrate
+        move entries of the old directory-per-entry layout into the store
+
+    tools/bitstreamcache.py clear-failures
+        forget every build recorded as failing
+
+    tools/bitstreamcache.py serve [SOCKET]
+        answer radiant.sh's fetch and commit calls on a UNIX socket (default .bitstreamcache/daemon.sock)
 
 """
+import json
 import logging
 import sys, os, shutil, hashlib, gzip
+import sqlite3
+import struct
+import threading
 import time
-from logging import exception
+import zlib
 from pathlib import Path
 
 root_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
 cache_dir = os.path.join(root_dir, ".bitstreamcache")
+store_path = os.path.join(cache_dir, "store.sqlite")
+default_socket_path = os.path.join(cache_dir, "daemon.sock")
+
+# Don't rewrite the access time of an entry used within this many seconds
+atime_resolution = 60
 
-def get_version_directory():
-    radiantdir = os.environ.get("RADIANTDIR", "UNKNOWN")
+# After a commit goes over the size cap, evict down to this fraction of it
+evict_target = 0.9
+
+# Remember builds that fail, and fail them again without running Radiant. BITSTREAM_CACHE_FAILURES=0 turns this off.
+record_failures = os.environ.get("BITSTREAM_CACHE_FAILURES", "1") != "0"
+
+# Build options that change the bitstream. They are part of the cache key, and bitstreams are only diffed against a
+# baseline built with the same ones
+baseline_env_keys = ("GEN_RBF", "DEV_PACKAGE", "SPEED_GRADE", "STRUCT_VER", "RBK_MODE")
+
+def get_version_directory(env = None):
+    """The version entries are stored under: the name and a hash of the RADIANTDIR in env, by default os.environ"""
+    if env is None:
+        env = os.environ
+    radiantdir = env.get("RADIANTDIR", "UNKNOWN")
     return Path(radiantdir).name + "-" + hashlib.md5(radiantdir.encode("UTF-8")).hexdigest()
 
 version_directory = get_version_directory()
 
+def parse_size(size):
+    """Bytes in a size like 500M or 200G"""
+    size = str(size).strip().upper()
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+BITDIFF_MAGIC = b"OXBD"
+# Differences closer than this are stored as one run
+bitdiff_merge_gap = 16
+bitdiff_block = 4096
+
+def encode_bitdiff(baseline, bitstream):
+    """The runs of bitstream that differ from baseline, packed and compressed; None if the lengths differ"""
+    if len(baseline) != len(bitstream):
+        return None
+
+    a, b = memoryview(baseline), memoryview(bitstream)
+    runs = []
+    for start in range(0, len(b), bitdiff_block):
+        end = min(start + bitdiff_block, len(b))
+        if a[start:end] == b[start:end]:
+            continue
+        for i in range(start, end):
+            if a[i] != b[i]:
+                if len(runs) and i - runs[-1][1] <= bitdiff_merge_gap:
+                    runs[-1][1] = i + 1
+                else:
+                    runs.append([i, i + 1])
+
+    packed = [BITDIFF_MAGIC, struct.pack("<II", len(b), len(runs))]
+    for start, end in runs:
+        packed.append(struct.pack("<II", start, end - start))
+        packed.append(b[start:end])
+    return zlib.compress(b"".join(packed))
+
+def decode_bitdiff_runs(data):
+    """[(offset, bytes)] of an encode_bitdiff result, and the bitstream length"""
+    data = zlib.decompress(data)
+    assert data[:4] == BITDIFF_MAGIC, "Not a bitstream diff"
+    length, count = struct.unpack_from("<II", data, 4)
+    pos = 12
+    runs = []
+    for _ in range(count):
+        offset, n = struct.unpack_from("<II", data, pos)
+        runs.append((offset, data[pos + 8:pos + 8 + n]))
+        pos = pos + 8 + n
+    return runs, length
+
+def decode_bitdiff(baseline, data):
+    runs, length = decode_bitdiff_runs(data)
+    assert length == len(baseline), "Bitstream diff doesn't match its baseline"
+    bitstream = bytearray(baseline)
+    for offset, run in runs:
+        bitstream[offset:offset + len(run)] = run
+    return bytes(bitstream)
+
+def format_size(size):
+    for unit in ["", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size = size / 1024
+    return f"{size:.1f}T"
+
+class Store:
+    """
+    The sqlite file holding the cache. Connections are per thread; sqlite's locking keeps concurrent builds in other
+    processes consistent.
+    """
+    _local = threading.local()
+
+    @staticmethod
+    def get():
+        conn = getattr(Store._local, "conn", None)
+        if conn is None or Store._local.path != store_path:
+            conn = Store._local.conn = Store._connect(store_path)
+            Store._local.path = store_path
+        return Store(conn)
+
+    @staticmethod
+    def _connect(path):
+        conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            BEGIN;
+            CREATE TABLE IF NOT EXISTS entries (
+                version TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                atime REAL NOT NULL,
+                PRIMARY KEY (version, hash)
+            );
+            CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+            CREATE TABLE IF NOT EXISTS products (
+                version TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                name TEXT NOT NULL,
+                data BLOB NOT NULL,
+                encoding TEXT NOT NULL DEFAULT 'gzip',
+                baseline INTEGER,
+                sha1 TEXT,
+                PRIMARY KEY (version, hash, name)
+            );
+            CREATE TABLE IF NOT EXISTS baselines (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                version TEXT NOT NULL,
+                key TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                UNIQUE (version, key, size)
+            );
+            CREATE TABLE IF NOT EXISTS failures (
+                version TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                message TEXT NOT NULL,
+                error_lines TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (version, hash)
+            );
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                value
+            );
+            INSERT OR IGNORE INTO metadata VALUES ('total_size', 0);
+            COMMIT;
+        """)
+        # Stores from before bitstream diffs
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(products)")]
+        if "encoding" not in columns:
+            try:
+                conn.execute("ALTER TABLE products ADD COLUMN encoding TEXT NOT NULL DEFAULT 'gzip'")
+                conn.execute("ALTER TABLE products ADD COLUMN baseline INTEGER")
+            except sqlite3.OperationalError:
+                # Another process added them first
+                pass
+        if "sha1" not in columns:
+            try:
+                conn.execute("ALTER TABLE products ADD COLUMN sha1 TEXT")
+            except sqlite3.OperationalError:
+                pass
+        # Baseline ids are cached by every process, so a deleted id must never be handed out again
+        if not Store._has_autoincrement(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have converted it while we waited for the lock
+                if not Store._has_autoincrement(conn):
+                    conn.execute("ALTER TABLE baselines RENAME TO baselines_old")
+                    conn.execute("""
+                        CREATE TABLE baselines (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            version TEXT NOT NULL,
+                            key TEXT NOT NULL,
+                            size INTEGER NOT NULL,
+                            data BLOB NOT NULL,
+                            UNIQUE (version, key, size)
+                        )""")
+                    conn.execute("INSERT INTO baselines SELECT * FROM baselines_old")
+                    conn.execute("DROP TABLE baselines_old")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return conn
+
+    @staticmethod
+    def _has_autoincrement(conn):
+        return "AUTOINCREMENT" in conn.execute("SELECT sql FROM sqlite_master WHERE name = 'baselines'").fetchone()[0]
+
+    # Decompressed baselines by id. Ids are never reused, so an entry stays valid after its baseline is deleted.
+    _baselines = {}
+    _baselines_lock = threading.Lock()
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get_metadata(self, key, default = None):
+        row = self.conn.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_metadata(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)", (key, value))
+
+    def max_size(self):
+        if "BITSTREAM_CACHE_MAX_SIZE" in os.environ:
+            return parse_size(os.environ["BITSTREAM_CACHE_MAX_SIZE"])
+        return int(self.get_metadata("max_size", 0))
+
+    def _touch(self, version, h):
+        """Mark an entry as used now, for eviction"""
+        now = time.time()
+        self.conn.execute("UPDATE entries SET atime = ? WHERE version = ? AND hash = ? AND atime < ?",
+                          (now, version, h, now - atime_resolution))
+
+    def fetch_encoded(self, version, h):
+        """{product name: (encoding, baseline id, data)} of an entry as stored, or None"""
+        rows = self.conn.execute("SELECT name, encoding, baseline, data FROM products WHERE version = ? AND hash = ?",
+                                 (version, h)).fetchall()
+        if len(rows) == 0:
+            return None
+
+        self._touch(version, h)
+        return {name: (encoding, baseline, data) for name, encoding, baseline, data in rows}
+
+    def fetch(self, version, h):
+        """{product name: gzipped contents} of an entry, or None"""
+        products = self.fetch_encoded(version, h)
+        if products is None:
+            return None
+        return {name: self.decode(*product) for name, product in products.items()}
+
+    def fetch_raw(self, version, h):
+        """{product name: (uncompressed contents, sha1 of them)} of an entry, or None"""
+        rows = self.conn.execute("SELECT name, encoding, baseline, data, sha1 FROM products "
+                                 "WHERE version = ? AND hash = ?", (version, h)).fetchall()
+        if len(rows) == 0:
+            return None
+
+        self._touch(version, h)
+
+        products = {}
+        for name, encoding, baseline, data, sha1 in rows:
+            contents = self.decode_raw(encoding, baseline, data)
+            # Entries committed before the column existed
+            if sha1 is None:
+                sha1 = hashlib.sha1(contents).hexdigest()
+            products[name] = (contents, sha1)
+        return products
+
+    def decode(self, encoding, baseline, data):
+        if encoding == "gzip":
+            return data
+        assert encoding == "bitdiff", f"Unknown product encoding {encoding}"
+        return gzip.compress(decode_bitdiff(self.get_baseline(baseline), data), compresslevel=1)
+
+    def decode_raw(self, encoding, baseline, data):
+        if encoding == "gzip":
+            return gzip.decompress(data)
+        assert encoding == "bitdiff", f"Unknown product encoding {encoding}"
+        return decode_bitdiff(self.get_baseline(baseline), data)
+
+    def get_baseline(self, baseline_id):
+        with Store._baselines_lock:
+            if (store_path, baseline_id) in Store._baselines:
+                return Store._baselines[(store_path, baseline_id)]
+        data = self.conn.execute("SELECT data FROM baselines WHERE id = ?", (baseline_id,)).fetchone()[0]
+        data = zlib.decompress(data)
+        with Store._baselines_lock:
+            Store._baselines[(store_path, baseline_id)] = data
+        return data
+
+    def encode(self, version, key, name, contents):
+        """
+        (encoding, baseline id, data, sha1) to store product name with. Bitstreams are diffed against the baseline for key,
+        becoming it if there is none yet. Only call this inside the transaction that commits the product, so the
+        baseline can't be vacuumed away before anything refers to it.
+        """
+        assert self.conn.in_transaction
+        sha1 = hashlib.sha1(contents).hexdigest()
+        if name.endswith(".bit"):
+            row = self.conn.execute("SELECT id FROM baselines WHERE version = ? AND key = ? AND size = ?",
+                                    (version, key, len(contents))).fetchone()
+            if row is None:
+                cursor = self.conn.execute("INSERT INTO baselines (version, key, size, data) VALUES (?, ?, ?, ?)",
+                                           (version, key, len(contents), zlib.compress(contents)))
+                row = (cursor.lastrowid,)
+
+            diff = encode_bitdiff(self.get_baseline(row[0]), contents)
+            if diff is not None and len(diff) < len(contents) // 8:
+                return ("bitdiff", row[0], diff, sha1)
+
+        return ("gzip", None, gzip.compress(contents), sha1)
+
+    def commit(self, version, h, products):
+        """Store {product name: (encoding, baseline id, data, sha1)} as one entry, replacing any previous one"""
+        self._commit(version, h, lambda: products)
+
+    def commit_contents(self, version, h, key, contents):
+        """Encode and store {product name: uncompressed contents} as one entry, diffing bitstreams against key's baseline"""
+        self._commit(version, h, lambda: {f"{name}.gz": self.encode(version, key, name, data)
+                                          for name, data in contents.items()})
+
+    def _commit(self, version, h, make_products):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            products = make_products()
+            size = sum(len(product[2]) for product in products.values())
+            now = time.time()
+
+            self._delete(version, h)
+            self.conn.execute("DELETE FROM failures WHERE version = ? AND hash = ?", (version, h))
+            self.conn.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", (version, h, size, now, now))
+            self.conn.executemany("INSERT INTO products (version, hash, name, data, encoding, baseline, sha1) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(version, h, name, product[2], product[0], product[1],
+                                    product[3] if len(product) > 3 else None)
+                                   for name, product in products.items()])
+            self.conn.execute("UPDATE metadata SET value = value + ? WHERE key = 'total_size'", (size,))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        max_size = self.max_size()
+        if max_size and self.total_size() > max_size:
+            self.evict(int(max_size * evict_target))
+
+    def fetch_failure(self, version, h):
+        """(kind, message, error lines) of a build recorded as failing, or None"""
+        row = self.conn.execute("SELECT kind, message, error_lines FROM failures WHERE version = ? AND hash = ?",
+                                (version, h)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def commit_failure(self, version, h, kind, message, error_lines):
+        self.conn.execute("INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?, ?)",
+                          (version, h, kind, message, json.dumps(list(error_lines)), time.time()))
+
+    def clear_failures(self, version = None):
+        """Forget recorded failures; those of every version but `version` if given. Returns the count."""
+        if version is None:
+            return self.conn.execute("DELETE FROM failures").rowcount
+        return self.conn.execute("DELETE FROM failures WHERE version != ?", (version,)).rowcount
+
+    def _delete(self, version, h):
+        row = self.conn.execute("SELECT size FROM entries WHERE version = ? AND hash = ?", (version, h)).fetchone()
+        if row is None:
+            return
+        self.conn.execute("DELETE FROM entries WHERE version = ? AND hash = ?", (version, h))
+        self.conn.execute("DELETE FROM products WHERE version = ? AND hash = ?", (version, h))
+        self.conn.execute("UPDATE metadata SET value = value - ? WHERE key = 'total_size'", (row[0],))
+
+    def total_size(self):
+        return int(self.get_metadata("total_size", 0))
+
+    def evict(self, target_size, batch = 256):
+        """Delete least recently used entries until the products take at most target_size bytes. Returns the count."""
+        evicted = 0
+        while self.total_size() > target_size:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                over = self.total_size() - target_size
+                victims = []
+                for version, h, size in self.conn.execute(
+                        "SELECT version, hash, size FROM entries ORDER BY atime LIMIT ?", (batch,)):
+                    if over <= 0:
+                        break
+                    victims.append((version, h))
+                    over = over - size
+                for version, h in victims:
+                    self._delete(version, h)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            if len(victims) == 0:
+                break
+            evicted = evicted + len(victims)
+        if evicted:
+            logging.info(f"Evicted {evicted} bitstream cache entries")
+        return evicted
+
+    def vacuum(self):
+        """Drop unused baselines and return the pages of deleted entries to the file system"""
+        # A commit looks up its baseline and inserts its products in one write transaction, so no baseline that is
+        # about to be used can look unused here
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = [row[0] for row in self.conn.execute(
+                "SELECT id FROM baselines WHERE id NOT IN "
+                "(SELECT DISTINCT baseline FROM products WHERE baseline IS NOT NULL)").fetchall()]
+            self.conn.executemany("DELETE FROM baselines WHERE id = ?", [(i,) for i in deleted])
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        with Store._baselines_lock:
+            for baseline_id in deleted:
+                Store._baselines.pop((store_path, baseline_id), None)
+        self.conn.execute("PRAGMA incremental_vacuum").fetchall()
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def stats(self):
+        entries, products_size, oldest, newest = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(atime), MAX(atime) FROM entries").fetchone()
+        products = self.conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+        versions = self.conn.execute("SELECT version, COUNT(*), SUM(size) FROM entries GROUP BY version").fetchall()
+        encodings = self.conn.execute("SELECT encoding, COUNT(*), SUM(LENGTH(data)) FROM products "
+                                      "GROUP BY encoding").fetchall()
+        baselines = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM baselines").fetchone()
+        failures = self.conn.execute("SELECT COUNT(*) FROM failures").fetchone()[0]
+        return {
+            "entries": entries,
+            "products": products,
+            "size": products_size,
+            "file_size": os.path.getsize(store_path),
+            "max_size": self.max_size(),
+            "oldest_use": oldest,
+            "newest_use": newest,
+            "versions": versions,
+            "encodings": encodings,
+            "baselines": baselines,
+            "failures": failures,
+        }
+
 def get_hash_by_contents(device, input_file_contents, env = None):
     if env is None:
         env = os.environ
@@ -42,7 +500,7 @@ def get_hash_by_contents(device, input_file_contents, env = None):
     hasher = hashlib.sha1()
     hasher.update(b"DEVICE")
     hasher.update(device.encode('utf-8'))
-    for envkey in ("GEN_RBF", "DEV_PACKAGE", "SPEED_GRADE", "STRUCT_VER", "RBK_MODE"):
+    for envkey in baseline_env_keys:
         if envkey in env:
             hasher.update(envkey.encode('utf-8'))
             hasher.update(env[envkey].encode('utf-8'))
@@ -66,52 +524,297 @@ def get_hash(device, input_files, env = None):
 
     return get_hash_by_contents(device, input_file_contents, env=env)
 
-def fetch_by_contents(device, input_file_contents, env = None):
+def fetch_encoded_products(h, version = None):
+    """
+    {product name: (encoding, baseline id, data)} of the entry with hash tuple h, or None. version is that of this
+    process's Radiant by default.
+    """
+    if not os.path.exists(cache_dir):
+        return None
+
+    store = Store.get()
+    # Entries from before the cache was versioned are stored with an empty version
+    for version in [version or version_directory, ""]:
+        products = store.fetch_encoded(version, "".join(h))
+        if products is not None:
+            return products
+    return None
+
+def fetch_products(h, version = None):
+    """{product name: gzipped contents} of the entry with hash tuple h, or None"""
+    products = fetch_encoded_products(h, version)
+    if products is None:
+        return None
+    store = Store.get()
+    return {name: store.decode(*product) for name, product in products.items()}
+
+def fetch_bit_diff(device, input_files, env = None):
+    """
+    The cached bitstream for the inputs as (baseline, [(offset, bytes)]) -- the runs where it differs from the
+    baseline bitstream -- without rebuilding it. None if it isn't cached or isn't stored as a diff.
+    """
+    products = fetch_encoded_products(get_hash(device, input_files, env=env))
+    if products is None:
+        return None
+    for name, (encoding, baseline, data) in products.items():
+        if name.endswith(".bit.gz") and encoding == "bitdiff":
+            return Store.get().get_baseline(baseline), decode_bitdiff_runs(data)[0]
+    return None
+
+class CachedProduct:
+    """A cached build product held in memory, uncompressed"""
+    def __init__(self, name, contents, sha1):
+        self.name = name
+        self.contents = contents
+        self.sha1 = sha1
+
+    def write(self, path):
+        """Write the contents to path, replacing it atomically"""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.contents)
+        os.replace(tmp_path, path)
+        return path
+
+    def __len__(self):
+        return len(self.contents)
+
+    def __repr__(self):
+        return f"CachedProduct({self.name}, {len(self.contents)} bytes, {self.sha1})"
+
+def fetch_in_memory(device, input_file_contents, env = None):
+    """
+    {product name: CachedProduct} of the cache entry for the inputs, or None on a miss. Product names are those of
+    the build outputs ("par.bit", "par.udb"); nothing is written to disk.
+    """
+    if not os.path.exists(cache_dir):
+        return None
+
+    h = "".join(get_hash_by_contents(device, input_file_contents, env=env))
+    store = Store.get()
+    for version in [version_directory, ""]:
+        products = store.fetch_raw(version, h)
+        if products is not None:
+            return {name.removesuffix(".gz"): CachedProduct(name.removesuffix(".gz"), contents, sha1)
+                    for name, (contents, sha1) in products.items()}
+    return None
+
+def fetch_by_contents(device, input_file_contents, env = None, output_dir = None):
+    """
+    Write the products of the cache entry for the inputs into output_dir (a new temporary folder by default) as
+    gzipped files, yielding (product name, path) for each
+    """
     if not os.path.exists(cache_dir):
         return
 
     h = get_hash_by_contents(device, input_file_contents, env=env)
+    products = fetch_products(h)
+    if products is None:
+        return
 
-    check_dirs = [os.path.join(cache_dir, version_directory, *h),
-                  os.path.join(cache_dir, "".join(h))]
-
-    for cache_entry in check_dirs:
-        if not os.path.exists(cache_entry) or len(os.listdir(cache_entry)) < 2:
-            continue
-
-        # Touch the directory and it's contents
-        now = time.time()
-        os.utime(cache_entry, (now, now))
-        products = os.listdir(cache_entry)
-        for outprod in products:
-            gz_path = os.path.join(cache_entry, outprod)
-            os.utime(gz_path, (now, now))
-
-            yield (outprod, gz_path)
+    if output_dir is None:
+        import tempfile
+        output_dir = tempfile.mkdtemp(prefix="bitstreamcache.")
+
+    # Named by the hash, so that a later fetch into the same folder doesn't change files handed out earlier
+    for outprod, data in products.items():
+        gz_path = os.path.join(output_dir, f"{''.join(h)}.{outprod}")
+        if not os.path.exists(gz_path):
+            tmp_path = f"{gz_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, gz_path)
+        yield (outprod, gz_path)
+
+def fetch(device, input_files, env = None, output_dir = None):
+    """Like fetch_by_contents, writing next to the first input file by default"""
+    if not os.path.exists(cache_dir):
+        return []
 
-        if len(products):
-            return
+    input_file_contents = {
+        fname:open(fname, "rb").read()
+        for fname in input_files
+    }
 
+    if output_dir is None:
+        output_dir = os.path.dirname(os.path.abspath(input_files[0]))
+    return fetch_by_contents(device, input_file_contents, env, output_dir=output_dir)
+
+def fetch_failure(device, input_file_contents, env = None):
+    """
+    (kind, message, error lines) if building the inputs failed with the current Radiant version, else None. Only
+    failures of this version count, so upgrading Radiant retries every failed build.
+    """
+    if not os.path.exists(cache_dir) or not record_failures:
+        return None
+    h = get_hash_by_contents(device, input_file_contents, env=env)
+    return Store.get().fetch_failure(version_directory, "".join(h))
 
-def fetch(device, input_files, env = None):
-    if not os.path.exists(cache_dir):
+def commit_failure(device, input_file_contents, kind, message, error_lines, env = None):
+    """Record that building the inputs fails, with the exception kind and message and the tool's error lines"""
+    if not os.path.exists(cache_dir) or not record_failures:
         return
+    h = get_hash_by_contents(device, input_file_contents, env=env)
+    Store.get().commit_failure(version_directory, "".join(h), kind, message, error_lines)
 
+def commit(device, input_files, output_files, env = None, version = None):
     input_file_contents = {
-        fname:open(fname, "rb").read()
+        fname: open(fname, "rb").read()
         for fname in input_files
     }
+    commit_by_contents(device, input_file_contents, output_files, env=env, version=version)
+
+def commit_by_contents(device, input_file_contents, output_files, env = None, version = None):
+    """
+    Save output_files as the products of the given inputs; the key matches fetch_by_contents and fetch_in_memory.
+    version is that of this process's Radiant by default.
+    """
+    if not os.path.exists(cache_dir):
+        return
+    if env is None:
+        env = os.environ
+    h = get_hash_by_contents(device, input_file_contents, env=env)
+    baseline_key = "|".join([device] + [f"{k}={env[k]}" for k in baseline_env_keys if k in env])
+
+    contents = {}
+    for outprod in output_files:
+        bn = os.path.basename(outprod)
+
+        if not os.path.exists(outprod):
+            raise Exception(f"Output product does not exist")
+
+        if os.path.getsize(outprod) == 0:
+            raise Exception(f"Output product has zero length; refusing to gzip {outprod}")
+
+        with open(outprod, 'rb') as inf:
+            contents[bn] = inf.read()
+
+    Store.get().commit_contents(version or version_directory, "".join(h), baseline_key, contents)
+
+def migrate():
+    """Move entries of the old directory-per-entry layout into the store, deleting the directories"""
+    store = Store.get()
+    count = 0
+
+    def import_entry(version, h, entry_dir):
+        nonlocal count
+        products = {}
+        for outprod in os.listdir(entry_dir):
+            with open(os.path.join(entry_dir, outprod), "rb") as f:
+                products[outprod] = ("gzip", None, f.read())
+        if len(products) >= 2:
+            store.commit(version, h, products)
+            count = count + 1
+        shutil.rmtree(entry_dir)
+
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isdir(path):
+            continue
+        if len(name) == 40 and all(c in "0123456789abcdef" for c in name):
+            import_entry("", name, path)
+            continue
+        for prefix in os.listdir(path):
+            for rest in os.listdir(os.path.join(path, prefix)):
+                import_entry(name, prefix + rest, os.path.join(path, prefix, rest))
+        shutil.rmtree(path)
+
+    store.vacuum()
+    print(f"Migrated {count} entries")
 
-    return fetch_by_contents(device, input_file_contents, env)
+def write_products(products, output_dir):
+    """Write fetched products the way radiant.sh expects them: bitstreams gzipped, everything else decompressed"""
+    for outprod, data in products.items():
+        assert outprod.endswith(".gz")
+
+        if outprod.endswith(".bit.gz"):
+            out_path = os.path.join(output_dir, outprod)
+        else:
+            out_path = os.path.join(output_dir, outprod[:-3])
+            data = gzip.decompress(data)
+        logging.info(f"Writing {out_path}")
+        with open(out_path, 'wb') as outf:
+            outf.write(data)
+
+def handle_request(line):
+    """
+    Serve one daemon request: tab separated command, working directory, `env:KEY=VALUE` fields for RADIANTDIR and the
+    build options, and then the arguments of the matching command line call. Returns the exit code that call would
+    have had. Entries are looked up under the caller's Radiant version, not the daemon's.
+    """
+    fields = line.rstrip("\n").split("\t")
+    cmd, cwd = fields[0], fields[1]
+    env = {f[4:].split("=", 1)[0]: f[4:].split("=", 1)[1] for f in fields[2:] if f.startswith("env:")}
+    args = [os.path.join(cwd, f) if i > 0 and f != "output" else f
+            for i, f in enumerate(f for f in fields[2:] if not f.startswith("env:"))]
+
+    if not os.path.exists(cache_dir):
+        return 1 if cmd == "fetch" else 0
+    version = get_version_directory(env)
+
+    if cmd == "fetch":
+        device, output_dir, input_files = args[0], args[1], args[2:]
+        products = fetch_products(get_hash(device, input_files, env=env), version)
+        if products is None:
+            return 1
+        write_products(products, output_dir)
+        return 0
+    elif cmd == "commit":
+        idx = args.index("output")
+        commit(args[0], args[1:idx], args[idx+1:], env=env, version=version)
+        return 0
+    raise ValueError(f"Unknown command {cmd}")
+
+def serve(socket_path):
+    """
+    Answer fetch and commit requests on a UNIX socket, one request line and one reply line per connection. Lets
+    radiant.sh use the cache without starting an interpreter per build.
+    """
+    import socket
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline().decode()
+            if not line:
+                # Another serve checking whether this one is alive
+                return
+            try:
+                reply = str(handle_request(line))
+            except Exception as e:
+                logging.exception(f"Request {line.strip()} failed")
+                reply = f"error {e}".replace("\n", " ")
+            self.wfile.write(f"{reply}\n".encode())
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a daemon that didn't shut down cleanly
+                os.remove(socket_path)
+            else:
+                raise RuntimeError(f"A daemon is already serving on {socket_path}")
+    with Server(socket_path, Handler) as server:
+        logging.info(f"Serving the bitstream cache on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
 
 def main():
     if len(sys.argv) < 2:
-        print("Expected command (init|fetch|commit)")
+        print("Expected command (init|fetch|commit|gc|stats|migrate|serve|clear-failures)")
         sys.exit(1)
     cmd = sys.argv[1]
     if cmd == "init":
         if not os.path.exists(cache_dir):
             os.mkdir(cache_dir)
+        if len(sys.argv) > 2:
+            Store.get().set_metadata("max_size", parse_size(sys.argv[2]))
     if cmd == "fetch":
 
         if not os.path.exists(cache_dir):
@@ -120,24 +823,15 @@ def main():
             print("Usage: tools/bitstreamcache.py fetch <DEVICE> <OUTPUT DIR> <INPUT FILE 1> <INPUT FILE 2> ...")
             sys.exit(1)
 
-        cache_entries = fetch(sys.argv[2], sys.argv[4:])
-
-        for (outprod, gz_path) in cache_entries:
-            assert gz_path.endswith(".gz")
-
-            Path(gz_path).touch()
-            if gz_path.endswith(".bit.gz"):
-                print(f"Linking {os.path.join(sys.argv[3], outprod)}")
-                os.symlink(gz_path, os.path.join(sys.argv[3], outprod))
-            else:
-                bn = Path(gz_path[:-3]).name
-                with gzip.open(gz_path, 'rb') as gzf:
-                    print(f"Writing {os.path.join(sys.argv[3], bn)}")
-                    with open(os.path.join(sys.argv[3], bn), 'wb') as outf:
-                        outf.write(gzf.read())
-        else:
+        input_file_contents = {
+            fname: open(fname, "rb").read()
+            for fname in sys.argv[4:]
+        }
+        products = fetch_products(get_hash_by_contents(sys.argv[2], input_file_contents))
+        if products is None:
             sys.exit(1)
 
+        write_products(products, sys.argv[3])
         sys.exit(0)
 
     if cmd == "commit":
@@ -147,25 +841,53 @@ def main():
         if len(sys.argv) < 6 or idx == -1:
             print("Usage: tools/bitstreamcache.py commit <DEVICE> <INPUT FILE 1> <INPUT FILE 2> output <OUTPUT FILE 1> ..")
             sys.exit(1)
-        h = get_hash(sys.argv[2], sys.argv[3:idx])
-
-        cache_entry = os.path.join(cache_dir, version_directory, *h)
-        if not os.path.exists(cache_entry):
-            os.makedirs(cache_entry, exist_ok=True)
-        for outprod in sys.argv[idx+1:]:
-            bn = os.path.basename(outprod)
-            cn = os.path.join(cache_entry, bn + ".gz")
-
-            if not os.path.exists(outprod):
-                raise Exception(f"Output product does not exist")
+        commit(sys.argv[2], sys.argv[3:idx], sys.argv[idx+1:])
+        sys.exit(0)
 
-            if os.path.getsize(outprod) == 0:
-                raise Exception(f"Output product has zero length; refusing to gzip {outprod}")
+    if cmd in ("gc", "stats", "migrate", "clear-failures") and not os.path.exists(cache_dir):
+        print("Bitstream cache is not initialised")
+        sys.exit(1)
 
-            with gzip.open(cn, 'wb') as gzf:
-                with open(outprod, 'rb') as inf:
-                    gzf.write(inf.read())
-        sys.exit(0)
+    if cmd == "gc":
+        store = Store.get()
+        max_size = parse_size(sys.argv[2]) if len(sys.argv) > 2 else store.max_size()
+        before = os.path.getsize(store_path)
+        store.clear_failures(version_directory)
+        if max_size:
+            store.evict(max_size)
+        store.vacuum()
+        print(f"Store is {format_size(os.path.getsize(store_path))}, was {format_size(before)}")
+
+    if cmd == "stats":
+        stats = Store.get().stats()
+        print(f"{stats['entries']} entries, {stats['products']} products")
+        print(f"{format_size(stats['size'])} of products in a {format_size(stats['file_size'])} file, "
+              f"cap {format_size(stats['max_size']) if stats['max_size'] else 'none'}")
+        if stats["entries"]:
+            print(f"Last used between {time.ctime(stats['oldest_use'])} and {time.ctime(stats['newest_use'])}")
+        for version, entries, size in stats["versions"]:
+            print(f"    {version or '(unversioned)'}: {entries} entries, {format_size(size)}")
+        for encoding, products, size in stats["encodings"]:
+            print(f"    {encoding}: {products} products, {format_size(size)}")
+        print(f"    {stats['baselines'][0]} baselines, {format_size(stats['baselines'][1])}")
+        print(f"    {stats['failures']} failed builds")
+
+    if cmd == "clear-failures":
+        print(f"Forgot {Store.get().clear_failures()} failed builds")
+
+    if cmd == "migrate":
+        migrate()
+
+    if cmd == "serve":
+        if not os.path.exists(cache_dir):
+            print("Bitstream cache is not initialised")
+            sys.exit(1)
+        logging.basicConfig(level=logging.INFO)
+        try:
+            serve(sys.argv[2] if len(sys.argv) > 2 else default_socket_path)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Prefetch the lapie node database for whole devices
+
+Fuzzers normally fill `.cache/<radiant version>/<device>-nodes.sqlite` lazily, which stalls them on lapie queries.
+This downloads every node of a device up front instead. The full node list is split into shards which are queried in
+parallel (up to OXIDE_JOBS tool sessions). Completed shards are recorded in the sqlite file, so an interrupted
+prefetch picks up where it stopped when rerun.
+
+Usage:
+    tools/prefetch_nodes.py [--shard-size N] [DEVICE ...]
+        prefetch the given devices, or every device allowed by FUZZER_PLATFORM if none are given
+"""
+import argparse
+import itertools
+import logging
+import os
+import threading
+import time
+
+import fuzzconfig
+import fuzzloops
+import lapie
+from nodes_database import NodesDatabase
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{(seconds // 60) % 60:02d}m{seconds % 60:02d}s"
+
+def prefetch_device(device, shard_size = 2000):
+    db = NodesDatabase.get(device)
+    if db.is_fully_prefetched():
+        logging.info(f"{device}: node database already prefetched")
+        return
+
+    all_nodes = sorted(lapie.get_full_node_list(device))
+    shards = [list(shard) for shard in itertools.batched(all_nodes, shard_size)]
+    completed = db.get_completed_prefetch_shards(shard_size)
+    todo = [idx for idx in range(len(shards)) if idx not in completed]
+
+    total_nodes = sum(len(shards[idx]) for idx in todo)
+    logging.info(f"{device}: {len(all_nodes)} nodes in {len(shards)} shards, {len(completed)} already done, "
+                 f"{total_nodes} nodes to fetch")
+
+    progress_lock = threading.Lock()
+    done_nodes = 0
+    start = time.time()
+
+    def run_shard(idx):
+        nonlocal done_nodes
+
+        shard = shards[idx]
+        s = time.time()
+        db = NodesDatabase.get(device)
+
+        # Nodes can already be present from earlier lazy lookups by fuzzers
+        existing = db.get_node_data(shard, skip_pips=True)
+        missing = [n for n in shard if n not in existing]
+        writes = [db.insert_nodeinfos(chunk, wait=False) for chunk in lapie.iter_node_data(device, missing)]
+        for w in writes:
+            w.result()
+
+        db.mark_prefetch_shard_complete(shard_size, idx, len(shard), time.time() - s)
+
+        with progress_lock:
+            done_nodes = done_nodes + len(shard)
+            elapsed = time.time() - start
+            rate = done_nodes / max(elapsed, 1e-3)
+            eta = (total_nodes - done_nodes) / max(rate, 1e-3)
+            logging.info(f"{device}: shard {idx + 1}/{len(shards)} ({len(missing)} queried) "
+                         f"{done_nodes}/{total_nodes} nodes, {rate:.1f} N/sec, ETA {format_duration(eta)}")
+
+    fuzzloops.parallel_foreach(todo, run_shard)
+
+    db.set_metadata("prefetch_complete", 1)
+    logging.info(f"{device}: prefetched {total_nodes} nodes in {format_duration(time.time() - start)}")
+
+def main():
+    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
+    logging.basicConfig(
+        level=LOGLEVEL,
+    )
+
+    parser = argparse.ArgumentParser(description="Prefetch the lapie node database for whole devices")
+    parser.add_argument("--shard-size", type=int, default=2000, help="nodes per lapie query")
+    parser.add_argument("devices", nargs="*", help="devices to prefetch (default: all)")
+    args = parser.parse_args()
+
+    devices = args.devices if len(args.devices) else fuzzconfig.devices_to_fuzz()
+    for device in devices:
+        prefetch_device(device, shard_size=args.shard_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Stress test for util/common/threadsafe.py and the module caches built on it
+
+Hammers threadsafe.cache and threadsafe.Counter from many threads at once and checks that:
+    - each cache key is computed exactly once, however many threads ask for it together
+    - an exception is not cached, and the threads waiting on the failed computation get that exception
+    - recursion into a cached function with the same key doesn't deadlock
+    - Counter loses no increments, and every increment returns a distinct value
+
+Then it drives the converted module caches against a small fixture database of two devices (PRJOXIDE_DB is pointed
+at a temporary folder), checking that threads racing on cold caches all get the same per-device object and correct
+results:
+    - database.get_tilegrid and get_tilegrid_hash
+    - tiles.TileGrid.get, RCCodec.get and NodeResolver.get
+    - tiles.get_rc_from_name and get_tiles_by_rc, for tile, node and edge IO names
+    - NodeResolver relative and actual node resolution
+    - the lapie.run_with_udb_cnt and FuzzConfig build counters
+
+Loaders that run Radiant or lapie -- FuzzConfig.standard_empty, lapie.get_full_node_list, database.get_sites -- are
+not driven; they are cached with the same threadsafe.cache the first part covers.
+
+Usage:
+    tools/test_threadsafe.py [--threads N] [--rounds N]
+
+Exits non-zero on the first failed check.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter as Tally
+
+import database
+import lapie
+import threadsafe
+import tiles
+from fuzzconfig import FuzzConfig
+
+# Fixture devices: (rows, cols)
+fixture_devices = {"LIFCL-40": (12, 16), "LIFCL-17": (8, 10)}
+
+def hammer(threads, fn):
+    """Run fn(thread index) on that many threads, all released at once. Returns the results and exceptions."""
+    barrier = threading.Barrier(threads)
+    results = [None] * threads
+    exceptions = [None] * threads
+
+    def runner(i):
+        barrier.wait()
+        try:
+            results[i] = fn(i)
+        except Exception as e:
+            exceptions[i] = e
+
+    ts = [threading.Thread(target=runner, args=(i,)) for i in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return results, exceptions
+
+def check(condition, message):
+    if not condition:
+        print(f"FAIL: {message}")
+        sys.exit(1)
+
+def test_single_flight(threads, keys):
+    calls = Tally()
+    calls_lock = threading.Lock()
+
+    @threadsafe.cache
+    def slow(key):
+        with calls_lock:
+            calls[key] += 1
+        time.sleep(0.01)
+        return [key]
+
+    results, exceptions = hammer(threads, lambda i: [slow(k) for k in range(keys)])
+
+    check(all(e is None for e in exceptions), f"unexpected exceptions {[e for e in exceptions if e]}")
+    check(all(calls[k] == 1 for k in range(keys)), f"keys computed more than once: {dict(calls)}")
+    # Every thread got the same object per key, not just an equal one
+    check(all(r[k] is results[0][k] for r in results for k in range(keys)), "threads got different result objects")
+    check(slow.cache_info() == {"currsize": keys, "in_flight": 0}, f"bad cache_info {slow.cache_info()}")
+
+def test_exceptions(threads):
+    calls = threadsafe.Counter()
+    started = threading.Event()
+
+    @threadsafe.cache
+    def failing(key):
+        n = calls.increment()
+        if n == 1:
+            started.set()
+            # Hold the computation until the other threads are waiting on it
+            time.sleep(0.2)
+            raise ValueError(f"failure {n}")
+        return n
+
+    def ask(i):
+        if i != 0:
+            started.wait()
+        return failing("k")
+
+    results, exceptions = hammer(threads, ask)
+
+    check(calls.value == 1, f"waiters ran the function again instead of getting the exception: {calls.value} calls")
+    check(all(isinstance(e, ValueError) and str(e) == "failure 1" for e in exceptions),
+          f"not every waiter saw the exception: {results} {exceptions}")
+    check(failing.cache_info()["in_flight"] == 0, "failed key still in flight")
+
+    # Not cached: the next call runs the function again and its result is kept
+    check(failing("k") == 2, "exception was cached")
+    check(failing("k") == 2 and calls.value == 2, "result after a failure was not cached")
+
+def test_recursion():
+    @threadsafe.cache
+    def fact(n):
+        return 1 if n <= 1 else n * fact(n - 1)
+
+    depth = threading.local()
+
+    @threadsafe.cache
+    def reenter(key):
+        # Ask for the same key again from inside its own computation
+        depth.n = getattr(depth, "n", 0) + 1
+        return depth.n if depth.n == 3 else reenter(key)
+
+    check(fact(50) == fact(49) * 50, "recursive cached function returned the wrong value")
+    check(reenter("k") == 3 and reenter("k") == 3, "same key recursion returned the wrong value")
+
+def test_counter(threads, increments):
+    counter = threadsafe.Counter()
+    results, exceptions = hammer(threads, lambda i: [counter.increment() for _ in range(increments)])
+
+    check(all(e is None for e in exceptions), f"unexpected exceptions {[e for e in exceptions if e]}")
+    total = threads * increments
+    check(counter.value == total, f"lost increments: {counter.value} != {total}")
+    returned = sorted(v for r in results for v in r)
+    check(returned == list(range(1, total + 1)), "increment returned duplicate or missing values")
+    check(f"{counter:d}" == str(total) and int(counter) == total, "counter doesn't format like an int")
+
+def make_fixture_db(root):
+    """A database with a tilegrid of two tiles per RC for each fixture device"""
+    devices = {"families": {"LIFCL": {"devices": {}}}}
+    for device, (rows, cols) in fixture_devices.items():
+        devices["families"]["LIFCL"]["devices"][device] = {"max_row": rows - 1, "max_col": cols - 1}
+        grid = {"tiles": {}}
+        for r in range(rows):
+            for c in range(cols):
+                grid["tiles"][f"R{r}C{c}:PLC"] = {"x": c, "y": r, "tiletype": "PLC"}
+                grid["tiles"][f"CIB_R{r}C{c}:CIB"] = {"x": c, "y": r, "tiletype": "CIB"}
+        os.makedirs(os.path.join(root, "LIFCL", device))
+        with open(os.path.join(root, "LIFCL", device, "tilegrid.json"), "w") as f:
+            json.dump(grid, f)
+    with open(os.path.join(root, "devices.json"), "w") as f:
+        json.dump(devices, f)
+
+def clear_module_caches():
+    """Start the next test with cold caches, so that threads race on building them"""
+    database.get_tilegrid.cache_clear()
+    database.get_tilegrid_hash.cache_clear()
+    for cls, attr in [(tiles.TileGrid, "_grids"), (tiles.RCCodec, "_codecs"), (tiles.NodeResolver, "_resolvers")]:
+        with cls._lock:
+            getattr(cls, attr).clear()
+
+def device_order(i):
+    """The fixture devices, rotated per thread so threads ask for them in different orders"""
+    devices = list(fixture_devices)
+    return devices[i % len(devices):] + devices[:i % len(devices)]
+
+def test_tilegrid_caches(threads):
+    clear_module_caches()
+
+    def ask(i):
+        return {d: (database.get_tilegrid(d), database.get_tilegrid_hash(d), tiles.TileGrid.get(d),
+                    tiles.RCCodec.get(d), tiles.NodeResolver.get(d)) for d in device_order(i)}
+
+    results, exceptions = hammer(threads, ask)
+    check(all(e is None for e in exceptions), f"unexpected exceptions {[e for e in exceptions if e]}")
+
+    for device, (rows, cols) in fixture_devices.items():
+        first = results[0][device]
+        check(all(r[device][k] is first[k] for r in results for k in range(len(first))),
+              f"threads got different cached objects for {device}")
+        tilegrid, tilegrid_hash, grid, codec, resolver = first
+        with open(os.path.join(database.get_db_root(), "LIFCL", device, "tilegrid.json"), "rb") as f:
+            check(tilegrid_hash == hashlib.sha1(f.read()).hexdigest(), f"wrong tilegrid hash for {device}")
+        check(len(tilegrid["tiles"]) == 2 * rows * cols, f"wrong tilegrid for {device}")
+        check(grid.device == codec.device == resolver.device == device, f"objects of another device for {device}")
+        check(len(grid.tiles) == len(tilegrid["tiles"]), f"TileGrid of {device} is missing tiles")
+    check(results[0]["LIFCL-40"][2] is not results[0]["LIFCL-17"][2], "devices share a TileGrid")
+
+def test_rc_lookups(threads):
+    clear_module_caches()
+
+    expected = {}
+    for device, (rows, cols) in fixture_devices.items():
+        names = {}
+        for r in range(rows):
+            for c in range(cols):
+                names[f"R{r}C{c}:PLC"] = (r, c)
+                names[f"CIB_R{r}C{c}:CIB"] = (r, c)
+                names[f"R{r}C{c}_JA{(r + c) % 8}"] = (r, c)
+                names[f"R{r}C{c}_H02E0{c % 8}01"] = (r, c)
+        for c in range(cols):
+            names[f"IOL_T{c}A"] = (0, c)
+            names[f"IOL_B{c}A"] = (rows - 1, c)
+        for r in range(rows):
+            names[f"IOL_L{r}B"] = (r, 0)
+            names[f"IOL_R{r}B"] = (r, cols - 1)
+        expected[device] = names
+
+    def ask(i):
+        rng = random.Random(i)
+        found = {}
+        for device in device_order(i):
+            names = list(expected[device])
+            rng.shuffle(names)
+            found[device] = {}
+            for n in names:
+                tiles_at = tiles.get_tiles_by_rc(device, n) if ":" in n else None
+                found[device][n] = (tiles.get_rc_from_name(device, n), tiles_at and sorted(tiles_at))
+        return found
+
+    results, exceptions = hammer(threads, ask)
+    check(all(e is None for e in exceptions), f"unexpected exceptions {[e for e in exceptions if e]}")
+
+    for device, names in expected.items():
+        for n, rc in names.items():
+            tiles_at = sorted([f"R{rc[0]}C{rc[1]}:PLC", f"CIB_R{rc[0]}C{rc[1]}:CIB"]) if ":" in n else None
+            check(all(r[device][n] == (rc, tiles_at) for r in results),
+                  f"wrong RC or tiles for {n} on {device}: {set(str(r[device][n]) for r in results)}")
+
+def test_node_resolver(threads):
+    clear_module_caches()
+
+    pairs = {}
+    for device, (rows, cols) in fixture_devices.items():
+        pairs[device] = []
+        for r in range(1, rows - 1):
+            for c in range(1, cols - 1):
+                rel_to = (r + 1, c - 1)
+                pairs[device] += [(f"R{r}C{c}_JA{c % 8}", rel_to), (f"R{r}C{c}_VCC", rel_to),
+                                  (f"R{r}C{c}_HPBX0{c % 8}00", rel_to), (f"R{r}C{c}_V02N0{r % 8}01", rel_to)]
+
+    # Worked out serially on resolvers of our own, outside the per-device cache
+    expected_relative = {d: [tiles.NodeResolver(d)._relative(n, rc) for n, rc in p] for d, p in pairs.items()}
+
+    def ask(i):
+        found = {}
+        for device in device_order(i):
+            resolver = tiles.NodeResolver.get(device)
+            relative = resolver.relative_many(pairs[device])
+            # Span wires would need the device's node list to resolve back
+            actual = resolver.actual_many([(rel, rc) for rel, (n, rc) in zip(relative, pairs[device])
+                                           if rel[0] not in "NEWS"])
+            found[device] = (relative, actual)
+        return found
+
+    results, exceptions = hammer(threads, ask)
+    check(all(e is None for e in exceptions), f"unexpected exceptions {[e for e in exceptions if e]}")
+
+    for device in fixture_devices:
+        names = [n for (n, rc), rel in zip(pairs[device], expected_relative[device]) if rel[0] not in "NEWS"]
+        check(all(r[device][0] == expected_relative[device] for r in results),
+              f"threads resolved relative nodes of {device} differently")
+        check(all(r[device][1] == names for r in results), f"relative nodes of {device} didn't resolve back")
+
+def test_module_counters(threads, increments):
+    counters = [lapie.run_with_udb_cnt, FuzzConfig.radiant_builds, FuzzConfig.radiant_cache_hits,
+                FuzzConfig.radiant_failure_hits, FuzzConfig.delta_skips]
+    before = [c.value for c in counters]
+
+    def ask(i):
+        for _ in range(increments):
+            for c in counters:
+                c.increment()
+            # As the status line reads them, while other threads increment
+            f"{FuzzConfig.radiant_builds}/{FuzzConfig.radiant_cache_hits} {lapie.run_with_udb_cnt}"
+
+    results, exceptions = hammer(threads, ask)
+    check(all(e is None for e in exceptions), f"unexpected exceptions {[e for e in exceptions if e]}")
+    check(all(c.value == b + threads * increments for c, b in zip(counters, before)),
+          f"lost increments on module counters: {[c.value - b for c, b in zip(counters, before)]}")
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Stress test threadsafe.cache and threadsafe.Counter")
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args(argv[1:])
+
+    db_root = tempfile.mkdtemp(prefix="test_threadsafe.")
+    try:
+        make_fixture_db(db_root)
+        os.environ["PRJOXIDE_DB"] = db_root
+        database.get_db_root.cache_clear()
+
+        # Switch threads as often as possible to shake out races
+        sys.setswitchinterval(1e-6)
+
+        for r in range(args.rounds):
+            test_single_flight(args.threads, keys=16)
+            test_exceptions(args.threads)
+            test_recursion()
+            test_counter(args.threads, increments=2000)
+            test_tilegrid_caches(args.threads)
+            test_rc_lookups(args.threads)
+            test_node_resolver(args.threads)
+            test_module_counters(args.threads, increments=200)
+            print(f"Round {r + 1}/{args.rounds} passed")
+    finally:
+        shutil.rmtree(db_root, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,14 +1,18 @@
 """
 Database and Database Path Management
 """
+import hashlib
 import logging
 import os
-from functools import lru_cache, cache
+import shutil
+import tempfile
+from functools import lru_cache
 from os import path, makedirs
 import json
 import subprocess
 from pathlib import Path
 import pyron as ron
+from threadsafe import cache
 import gzip
 
 def get_oxide_root():
@@ -43,6 +47,27 @@ def get_cache_dir():
     makedirs(path, exist_ok=True)
     return path
 
+def replace_cache_dir(tmp_dir, directory):
+    """
+    Swap the freshly written tmp_dir in as directory. Processes that have files of the old directory open keep working.
+    Returns the directory the data ended up in, which is tmp_dir if another process swapped in its own copy first.
+    """
+    old_dir = None
+    if os.path.exists(directory):
+        old_dir = tempfile.mkdtemp(dir=path.dirname(directory), prefix=f"{path.basename(directory)}.old.")
+        try:
+            os.replace(directory, f"{old_dir}/data")
+        except OSError:
+            pass
+    try:
+        os.replace(tmp_dir, directory)
+    except OSError:
+        logging.debug(f"{directory} was replaced concurrently")
+        directory = tmp_dir
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return directory
+
 
 def get_primitive_json(primitive):
     import parse_webdoc
@@ -131,6 +156,19 @@ def get_tilegrid(family, device = None):
     else:
         return {"tiles":{}}
 
+@cache
+def get_tilegrid_hash(family, device = None):
+    """Hash of the tilegrid file for a family, device; for keying data derived from it"""
+    if device is None:
+        device = family
+        family = get_family_for_device(device)
+
+    tgjson = path.join(get_db_subdir(family, device), "tilegrid.json")
+    if not path.exists(tgjson):
+        return "none"
+    with open(tgjson, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
 def get_iodb(family, device = None):
     """
     Return the deserialised iodb for a family, device
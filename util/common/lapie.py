@@ -2,25 +2,32 @@
 Python wrapper for `lapie`
 """
 import asyncio
+import atexit
 import hashlib
 import itertools
 import logging
 import os
+import queue
 import re
 import shutil
 import sqlite3
 import subprocess
 import tempfile
+import threading
 import time
 from collections import defaultdict
-from functools import cache
+from concurrent.futures import Future, ThreadPoolExecutor
 from os import path
 
 import cachier
+import numpy as np
 import fuzzconfig
 
 import cachecontrol
 import database
+import routing_graph
+import threadsafe
+from threadsafe import cache
 
 radiant_version = database.get_radiant_version()
 
@@ -76,21 +83,205 @@ def run(commands, workdir=None, stdout=None):
     output = output[:output.find(pleasantry)].strip()
     return output
 
-run_with_udb_cnt = 0
-def run_with_udb(udb, commands, stdout = None):
-    global run_with_udb_cnt
-    run_with_udb_cnt = run_with_udb_cnt + 1
+def _resolve_udb(udb):
+    """Map a device name to its cached specimen udb, building it if needed. Paths to a udb are passed through."""
     if not udb.endswith(".udb"):
         device = udb
         udb = f"/tmp/prjoxide_node_data/{device}.udb"
         if not os.path.exists(udb):
             config = fuzzconfig.FuzzConfig(device, f"extract-site-info-{device}", [])
             config.setup()
+            os.makedirs(path.dirname(udb), exist_ok=True)
             shutil.copyfile(config.udb, udb)
+    return path.abspath(udb)
 
-    return run(['des_read_udb "{}"'.format(path.abspath(udb))] + commands, stdout = stdout)
+run_with_udb_cnt = threadsafe.Counter()
+def run_with_udb(udb, commands, stdout = None):
+    run_with_udb_cnt.increment()
+    udb = _resolve_udb(udb)
+
+    return run(['des_read_udb "{}"'.format(udb)] + commands, stdout = stdout)
+
+class TclSessionError(Exception):
+    pass
+
+class TclSession:
+    """
+    A long-lived Tcl tool process with a udb already loaded. Commands are written to its stdin and the output is read
+    back from stdout up to a marker line, so the tool startup and udb load are only paid once.
+    """
+    def __init__(self, udb):
+        self.udb = udb
+        self.workdir = tempfile.mkdtemp()
+        self.proc = None
+        self.commands_run = 0
+        try:
+            self.start()
+        except BaseException:
+            # Nobody gets a reference to close it; don't leak the process or the workdir
+            self.close()
+            raise
+
+    def start(self):
+        rcmd_path = path.join(database.get_oxide_root(), "radiant_cmd.sh")
+        env = os.environ.copy()
+        env[dev_enable_name] = "1"
+        env["LSC_SHOW_INTERNAL_ERROR"] = "1"
+
+        logging.debug(f"Starting {tcltool} session for {self.udb} in {self.workdir}")
+        self.proc = subprocess.Popen(["bash", rcmd_path, tcltool], env=env, cwd=self.workdir, text=True, bufsize=1,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.run(['des_read_udb "{}"'.format(self.udb)])
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def run(self, commands):
+        """Run a list of Tcl commands in this session, returning their output as a string"""
+        if not self.alive():
+            raise TclSessionError(f"{tcltool} session for {self.udb} is not running")
+
+        self.commands_run = self.commands_run + 1
+        marker = f"__prjoxide_done_{id(self)}_{self.commands_run}__"
+        try:
+            for c in commands:
+                self.proc.stdin.write(c + '\n')
+            # Tcl fully buffers stdout when it is a pipe; flush so the marker is seen
+            self.proc.stdin.write(f'puts "{marker}"; flush stdout\n')
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise TclSessionError(f"Could not write to {tcltool} session for {self.udb}: {e}") from e
+
+        output = []
+        for line in self.proc.stdout:
+            if line.strip() == marker:
+                break
+            if line.startswith("WARNING - "):
+                continue
+            output.append(line)
+        else:
+            try:
+                returncode = self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                returncode = None
+            raise TclSessionError(f"{tcltool} session for {self.udb} exited with {returncode}: {''.join(output[-10:])}")
+
+        return "".join(output).strip()
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            if self.alive():
+                self.proc.stdin.write("exit\n")
+                self.proc.stdin.flush()
+            self.proc.wait(timeout=30)
+        except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+class TclSessionPool:
+    """
+    Pool of warm TclSessions for a single udb. At most OXIDE_JOBS sessions are started; they are started lazily and
+    replaced if the underlying process dies.
+    """
+    _pools = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(udb):
+        udb = _resolve_udb(udb)
+        with TclSessionPool._lock:
+            if udb not in TclSessionPool._pools:
+                import fuzzloops
+                TclSessionPool._pools[udb] = TclSessionPool(udb, fuzzloops.jobs())
+            return TclSessionPool._pools[udb]
+
+    @staticmethod
+    def shutdown_all():
+        with TclSessionPool._lock:
+            pools = list(TclSessionPool._pools.values())
+            TclSessionPool._pools.clear()
+        for pool in pools:
+            pool.shutdown()
+
+    def __init__(self, udb, size):
+        self.udb = udb
+        self.size = size
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+        self.restarts = 0
+
+    def _checkout(self):
+        try:
+            session = self.idle.get_nowait()
+            if session.alive():
+                return session
+            session.close()
+        except queue.Empty:
+            pass
+        return TclSession(self.udb)
+
+    def run(self, commands, retry = True):
+        """
+        Run commands in an idle session. If the session dies they are run again in a fresh one, unless retry is False
+        -- commands that write to a named pipe can't be rerun, nothing would be reading the pipe.
+        """
+        with self.slots:
+            session = self._checkout()
+            try:
+                return self._run_once(session, commands)
+            except TclSessionError as e:
+                if not retry:
+                    raise
+                self.restarts = self.restarts + 1
+                logging.warning(f"Restarting {tcltool} session for {self.udb}: {e}")
+                return self._run_once(TclSession(self.udb), commands)
+
+    def _run_once(self, session, commands):
+        """
+        Run commands in session and return it to the idle sessions. If run() doesn't return, whatever the exception,
+        the session is closed: its output may still hold the rest of these commands' output and their marker, which
+        the next caller would read as its own.
+        """
+        try:
+            result = session.run(commands)
+        except BaseException:
+            session.close()
+            raise
+        if session.alive():
+            self.idle.put(session)
+        else:
+            session.close()
+        return result
+
+    def shutdown(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+atexit.register(TclSessionPool.shutdown_all)
+
+use_tcl_sessions = os.environ.get("OXIDE_TCL_SESSIONS", "1") != "0"
+
+def run_in_session(udb, commands, retry = True):
+    """
+    Run a list of Tcl commands against a udb (or device name) using a warm session from the pool. Falls back to a
+    fresh tool process per call when OXIDE_TCL_SESSIONS=0. See TclSessionPool.run for retry.
+    """
+    if not use_tcl_sessions:
+        return run_with_udb(udb, commands, stdout = subprocess.DEVNULL)
+
+    run_with_udb_cnt.increment()
+    return TclSessionPool.get(udb).run(commands, retry=retry)
 
 class PipInfo:
+    __slots__ = ["from_wire", "to_wire", "flags", "buffertype", "is_bidi"]
+
     def __init__(self, from_wire, to_wire, is_bidi = False, flags = 0, buffertype = ""):
         self.from_wire = from_wire
         self.to_wire = to_wire
@@ -102,6 +293,8 @@ class PipInfo:
         return str((self.from_wire, self.to_wire))
 
 class PinInfo:
+    __slots__ = ["site", "pin", "wire", "dir"]
+
     def __init__(self, site, pin, wire, pindir):
         self.site = site
         self.pin = pin
@@ -109,6 +302,8 @@ class PinInfo:
         self.dir = pindir
 
 class NodeInfo:
+    __slots__ = ["name", "aliases", "nodetype", "uphill_pips", "downhill_pips", "pins"]
+
     def __init__(self, name):
         self.name = name
         self.aliases = []
@@ -119,7 +314,138 @@ class NodeInfo:
         
     def pips(self):
         return self.uphill_pips + self.downhill_pips
-        
+
+class NodeInfoBatch:
+    """
+    The NodeInfos of one lookup held as parallel arrays. Names are stored once in a string table, and each pip once,
+    shared by the downhill list of its from node and the uphill list of its to node. Iterating (or indexing) gives
+    NodeInfoViews, which have the read side of the NodeInfo API; their pips are PipInfoViews made on access.
+    """
+    __slots__ = ["names", "node_names", "aliases", "buffertypes",
+                 "pip_from", "pip_to", "pip_bidi", "pip_flags", "pip_buffertype",
+                 "uphill_ptr", "uphill_pips", "downhill_ptr", "downhill_pips"]
+
+    def __init__(self, id_to_name, node_ids, aliases, edge_from, edge_to, edge_bidi, edge_flags, edge_buffertype,
+                 buffertypes, direction = None):
+        """
+        node_ids are the ids of the nodes in the batch and aliases their alias lists. The edge_* arrays describe the
+        pips, with node ids resolved by id_to_name and edge_buffertype indexing into buffertypes. direction
+        ("uphill" or "downhill") leaves the other pip list of every node empty.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        edge_from = np.asarray(edge_from, dtype=np.int64)
+        edge_to = np.asarray(edge_to, dtype=np.int64)
+
+        ids = np.unique(np.concatenate([node_ids, edge_from, edge_to]))
+        self.names = [id_to_name[int(i)] for i in ids]
+        self.node_names = np.searchsorted(ids, node_ids).astype(np.int32)
+        self.aliases = [tuple(a) for a in aliases]
+        self.buffertypes = list(buffertypes)
+
+        self.pip_from = np.searchsorted(ids, edge_from).astype(np.int32)
+        self.pip_to = np.searchsorted(ids, edge_to).astype(np.int32)
+        self.pip_bidi = np.asarray(edge_bidi, dtype=bool)
+        self.pip_flags = np.asarray(edge_flags, dtype=np.int32)
+        self.pip_buffertype = np.asarray(edge_buffertype, dtype=np.int16)
+
+        # Position of each name in the batch, -1 for names that are only pip endpoints
+        node_index = np.full(len(ids), -1, dtype=np.int64)
+        node_index[self.node_names] = np.arange(len(node_ids))
+
+        def csr(endpoints, enabled):
+            owner = node_index[endpoints] if enabled else np.full(len(endpoints), -1, dtype=np.int64)
+            pips = np.flatnonzero(owner >= 0)
+            pips = pips[np.argsort(owner[pips], kind="stable")]
+            ptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(owner[pips], minlength=len(node_ids)), out=ptr[1:])
+            return ptr, pips.astype(np.int32)
+
+        self.downhill_ptr, self.downhill_pips = csr(self.pip_from, direction != "uphill")
+        self.uphill_ptr, self.uphill_pips = csr(self.pip_to, direction != "downhill")
+
+    def __len__(self):
+        return len(self.node_names)
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        return NodeInfoView(self, index)
+
+    def __iter__(self):
+        return (NodeInfoView(self, i) for i in range(len(self)))
+
+    def as_dict(self):
+        return {info.name: info for info in self}
+
+class NodeInfoView:
+    __slots__ = ["batch", "index"]
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def name(self):
+        return self.batch.names[self.batch.node_names[self.index]]
+
+    @property
+    def aliases(self):
+        return list(self.batch.aliases[self.index])
+
+    @property
+    def nodetype(self):
+        return None
+
+    @property
+    def pins(self):
+        return []
+
+    @property
+    def uphill_pips(self):
+        b = self.batch
+        return [PipInfoView(b, i) for i in b.uphill_pips[b.uphill_ptr[self.index]:b.uphill_ptr[self.index + 1]].tolist()]
+
+    @property
+    def downhill_pips(self):
+        b = self.batch
+        return [PipInfoView(b, i) for i in b.downhill_pips[b.downhill_ptr[self.index]:b.downhill_ptr[self.index + 1]].tolist()]
+
+    def pips(self):
+        return self.uphill_pips + self.downhill_pips
+
+    def __repr__(self):
+        return f"NodeInfoView({self.name})"
+
+class PipInfoView:
+    __slots__ = ["batch", "index"]
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def from_wire(self):
+        return self.batch.names[self.batch.pip_from[self.index]]
+
+    @property
+    def to_wire(self):
+        return self.batch.names[self.batch.pip_to[self.index]]
+
+    @property
+    def flags(self):
+        return int(self.batch.pip_flags[self.index])
+
+    @property
+    def buffertype(self):
+        return self.batch.buffertypes[self.batch.pip_buffertype[self.index]]
+
+    @property
+    def is_bidi(self):
+        return bool(self.batch.pip_bidi[self.index])
+
+    def __repr__(self):
+        return str((self.from_wire, self.to_wire))
+
 node_re = re.compile(r'^\[\s*\d+\]\s*([A-Z0-9a-z_]+)')
 alias_node_re = re.compile(r'^\s*Alias name = ([A-Z0-9a-z_]+)')
 pip_re = re.compile(r'^([A-Z0-9a-z_]+) (<--|<->|-->) ([A-Z0-9a-z_]+) \(Flags: .+, (\d+)\) \(Buffer: ([A-Z0-9a-z_]+)\)')
@@ -130,31 +456,34 @@ pin_re = re.compile(r'^Pin  : ([A-Z0-9a-z_]+)/([A-Z0-9a-z_]+) \(([A-Z0-9a-z_]+)\
 # can have a lot of aliases and the only clear indication of which name is normative is its the one
 # used in the connections.
 
-def parse_node_report(rpt, node_keys):
+def iter_node_report(lines, node_keys = ()):
+    """
+    Incrementally parse a dev_report_node report from an iterable of lines, yielding each NodeInfo as soon as its
+    section is complete. Only the node currently being parsed is held in memory.
+    """
+    node_keys = set(node_keys)
     curr_node = None
-    nodes_dict = {}
-    nodes = []
     reset_curr_node = True
-    
-    def get_node(name):
-        if name in nodes_dict:
-            n = nodes_dict[name]
-            n.name = name
-            return n
-
-        nodes_dict[name] = NodeInfo(name)
-        nodes.append(nodes_dict[name])
-        return nodes_dict[name]
-        
-    for line in rpt.split('\n'):
+
+    for line in lines:
         sl = line.strip()
+        if len(sl) == 0:
+            reset_curr_node = True
+            continue
 
-        name_match = [nm.group(1) for nm in [re.match(sl) for re in [node_re, alias_node_re]] if nm is not None]
+        # Dispatch on the first characters so only one regex is run per line
+        nm = None
+        if sl[0] == "[":
+            nm = node_re.match(sl)
+        elif sl.startswith("Alias name"):
+            nm = alias_node_re.match(sl)
 
-        if len(name_match):
-            new_name = name_match[0]
+        if nm is not None:
+            new_name = nm.group(1)
             if reset_curr_node:
-                curr_node = get_node(new_name)
+                if curr_node is not None:
+                    yield curr_node
+                curr_node = NodeInfo(new_name)
                 reset_curr_node = False
             curr_node.aliases.append(new_name)
 
@@ -164,15 +493,22 @@ def parse_node_report(rpt, node_keys):
 
         # If we get back into an alias section, we are onto a new node
         reset_curr_node = True
-        
+
+        if sl.startswith("Pin  :"):
+            qm = pin_re.match(sl)
+            if qm and curr_node:
+                curr_node.pins.append(
+                    PinInfo(qm.group(1), qm.group(2), curr_node.name, qm.group(3))
+                )
+            continue
+
         pm = pip_re.match(sl)
         if pm:
             # Name the node according to what things call it
             curr_node.name = pm.group(1)
-            
+
             flg = int(pm.group(4))
             btyp = pm.group(5)
-            #print(f"Found connection {pm}")
             if pm.group(2) == "<--":
                 curr_node.uphill_pips.append(
                     PipInfo(pm.group(3), pm.group(1), False, flg, btyp)
@@ -190,18 +526,16 @@ def parse_node_report(rpt, node_keys):
                 )
             else:
                 assert False
-            continue
-        qm = pin_re.match(sl)
-        #print("Match", qm, curr_node)
-        if qm and curr_node:
-            curr_node.pins.append(
-                PinInfo(qm.group(1), qm.group(2), curr_node.name, qm.group(3))
-            )
-    #print([x.name for x in nodes])
-    return nodes
+
+    if curr_node is not None:
+        yield curr_node
+
+def parse_node_report(rpt, node_keys):
+    return list(iter_node_report(rpt.split('\n'), node_keys))
 
 def parse_sites(rpt):
-    past_preamble = False
+    # Output from a warm session has no udb loading banner to skip
+    past_preamble = "Successfully loading udb" not in rpt
     sites = []
     for line in rpt.split('\n'):
         sl = line.strip()
@@ -218,8 +552,29 @@ def parse_sites(rpt):
 
     return sites
 
+def _node_list_db(device):
+    """NodesDatabase of device with the full node list in its name index"""
+    from nodes_database import NodesDatabase
+
+    db = NodesDatabase.get(device)
+    if not db.has_node_list():
+        db.insert_node_list(_read_full_node_list(device))
+    return db
+
 @cache
 def get_full_node_list(udb):
+    if udb.endswith(".udb"):
+        return _read_full_node_list(udb)
+    return _node_list_db(udb).get_node_list()
+
+def get_node_list_hash(device):
+    return _node_list_db(device).get_node_list_hash()
+
+def find_nodes(device, regexes = (), globs = ()):
+    """Names of all nodes in device matching any of the regexes (searched, not anchored) or globs"""
+    return _node_list_db(device).search_node_list(regexes=regexes, globs=globs)
+
+def _read_full_node_list(udb):
     workdir = f"/tmp/prjoxide_node_data/{udb}"
     nodefile = path.join(workdir, "full_nodes.txt")
     os.makedirs(workdir, exist_ok=True)
@@ -234,36 +589,29 @@ def get_full_node_list(udb):
         return {res for line in nf.read().split("\n")
                 if len(res:=line.split(":")[-1].strip()) != 0 }
 
-@cache
-def _get_list_arc(device):
-    nodefile = f"/tmp/prjoxide_node_data/{device}/arclist"
-    if not os.path.exists(nodefile):
-        run_with_udb(device, [f'dev_list_arc -file {nodefile} -jumpwire'], stdout=subprocess.DEVNULL)
+def iter_arc_list(lines):
+    """Parse dev_list_arc output into (from_wire, to_wire) tuples"""
+    for line in lines:
+        parts = line.split(" ")
+        if parts[2] != "-->":
+            print(line, parts)
+        assert parts[2] == "-->"
 
-    with open(nodefile, 'r') as nf:
-        nodes = {}
-        arcs = set()
-        def get_node(n):
-            if n not in nodes:
-                nodes[n] = NodeInfo(n)
-            return nodes[n]
+        yield parts[1], parts[3]
 
+def iter_list_arc_chunks(device, chunk_size = 100000):
+    """Yield the device jumpwire arcs in chunks, streaming them from the tool unless an arclist dump already exists"""
+    nodefile = f"/tmp/prjoxide_node_data/{device}/arclist"
+    if os.path.exists(nodefile):
         logging.info(f"Reading arc file {nodefile}")
-        for line in nf.readlines():
-            parts = line.split(" ")
-            if parts[2] != "-->":
-                print(line, parts)
-            assert parts[2] == "-->"
-
-            pip = PipInfo(parts[1], parts[3])
-            get_node(parts[1]).downhill_pips.append(pip)
-            get_node(parts[3]).uphill_pips.append(pip)
-
-        for n,info in nodes.items():
-            for t in info.pips():
-                arcs.add((t.from_wire, t.to_wire))
+        with open(nodefile, 'r') as nf:
+            yield from itertools.batched(iter_arc_list(nf), chunk_size)
+    else:
+        yield from itertools.batched(iter_arc_list(stream_tool_report(device, 'dev_list_arc -file {file} -jumpwire')), chunk_size)
 
-        return arcs
+@cache
+def _get_list_arc(device):
+    return {arc for chunk in iter_list_arc_chunks(device) for arc in chunk}
 
 @cache
 def get_jump_wires(device):
@@ -271,70 +619,223 @@ def get_jump_wires(device):
     node_db = NodesDatabase.get(device)
     jmp = set(node_db.get_jumpwires())
     if len(jmp) == 0:
-        jmp = _get_list_arc(device)
-        node_db.insert_jumpwires(jmp)
+        # One write so an interrupted load doesn't leave a partial list that looks complete
+        node_db.insert_jumpwires([arc for chunk in iter_list_arc_chunks(device) for arc in chunk])
+        jmp = set(node_db.get_jumpwires())
 
     return jmp
 
-@cache
-def get_jump_wires_lookup(device):
-    rtn = defaultdict(set)
-    for jmp in get_jump_wires(device):
-        rtn[jmp[0]].add(jmp)
-        rtn[jmp[1]].add(jmp)
-    return rtn
-
 def get_jump_wires_by_nodes(device, nodes):
-    nodes = set(nodes)
-    lu = get_jump_wires_lookup(device)
+    graph = routing_graph.RoutingGraph.get(device)
+    if graph.jumpwire_count == 0:
+        get_jump_wires(device)
+        graph = routing_graph.RoutingGraph.get(device, refresh=True)
 
-    raw_set = set()
-    for n in nodes:
-        raw_set = raw_set | lu[n]
+    node_ids = set(graph.ids_for_names(set(nodes)).values())
+    edges = graph.edges_for_nodes(node_ids, mask=routing_graph.JUMPWIRE)
 
     # Most of the things are connections; but sometimes there are multi-source connections. Filter those out.
-    raw_dict = defaultdict(list)
-    for (from_wire, to_wire) in raw_set:
-        raw_dict[to_wire].append(from_wire)
+    to_ids, counts = np.unique(graph.edge_to[edges], return_counts=True)
+    edges = edges[np.isin(graph.edge_to[edges], to_ids[counts == 1])]
 
-    return {
-        (from_wires[0], to_wire)
-        for (to_wire, from_wires) in raw_dict.items()
-        if len(from_wires) == 1
-    }
+    frm, to = graph.edge_from[edges].tolist(), graph.edge_to[edges].tolist()
+    id_to_name = graph.names_for_ids(set(frm) | set(to))
+    return {(id_to_name[f], id_to_name[t]) for f, t in zip(frm, to)}
 
-def _get_node_data(udb, nodes):
-    regex = False
+use_report_fifos = os.environ.get("OXIDE_REPORT_FIFOS", "1") != "0"
 
+def stream_tool_report(udb, command):
+    """
+    Run a Tcl command that writes a report to `{file}` and yield the report line by line. By default the report is a
+    named pipe that is read while the tool is still writing it, so whole-device reports are never held on disk or in
+    memory. With OXIDE_REPORT_FIFOS=0 the report is written to a temporary file and read back afterwards.
+    """
     workdir = tempfile.mkdtemp()
-    nodefile = path.join(workdir, "nodes.txt")
+    report = path.join(workdir, "report.txt")
+    command = command.replace("{file}", report)
+
+    try:
+        if not use_report_fifos:
+            run_in_session(udb, [command])
+            with open(report, 'r') as f:
+                yield from f
+            return
+
+        os.mkfifo(report)
+        result = Future()
+        reader_done = threading.Event()
+
+        def run_command():
+            try:
+                result.set_result(run_in_session(udb, [command], retry=False))
+            except BaseException as e:
+                result.set_exception(e)
+
+            # If the tool never opened the pipe the reader is still blocked in open(); connect and close a writer so it
+            # sees EOF.
+            while not reader_done.is_set():
+                try:
+                    os.close(os.open(report, os.O_WRONLY | os.O_NONBLOCK))
+                    return
+                except OSError:
+                    time.sleep(0.1)
+
+        threading.Thread(target=run_command, daemon=True, name="tool-report-fifo").start()
+        line_count = 0
+        try:
+            with open(report, 'r') as f:
+                for line in f:
+                    line_count = line_count + 1
+                    yield line
+        finally:
+            reader_done.set()
+
+        # The lines already yielded may be a truncated report; callers must not keep them if this raises
+        try:
+            output = result.result()
+        except Exception as e:
+            raise TclSessionError(f"{tcltool} failed after {line_count} report lines for {command[:100]}: {e}") from e
+        if line_count == 0 and "ERROR" in output:
+            raise TclSessionError(f"{tcltool} failed to write report for {command[:100]}: {output}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def iter_node_data(udb, nodes, chunk_size = 1000):
+    """Query lapie for the given nodes, yielding lists of up to chunk_size NodeInfos as the report is produced"""
     nodelist = "[list {}]".format(" ".join(nodes))
 
     logging.info(f"Querying for {len(nodes)} nodes {nodes[:10]}")
 
-    if not udb.endswith(".udb"):
-        device = udb
-        udb = f"/tmp/prjoxide_node_data/{device}.udb"
-        if not os.path.exists(udb):
-            config = fuzzconfig.FuzzConfig(device, f"extract-site-info-{device}", [])
-            config.setup()
-            shutil.copyfile(config.udb, udb)
-
-    re_slug = "-re " if regex else ""
-    run_with_udb(udb, [f'dev_report_node -file {nodefile} [{get_nodes} {re_slug}{nodelist}]'], stdout = subprocess.DEVNULL)
-
-    with open(nodefile, 'r') as nf:
-        return parse_node_report(nf.read(), nodes)
-
-async def get_pip_data(device, nodes, filter_type = None):
-    from nodes_database import NodesDatabase
-    # Make sure we have full db for these entries
-    await asyncio.to_thread(get_node_data, device, nodes, skip_pips=True)
+    lines = stream_tool_report(udb, f'dev_report_node -file {{file}} [{get_nodes} {nodelist}]')
+    for chunk in itertools.batched(iter_node_report(lines, nodes), chunk_size):
+        yield list(chunk)
 
-    db = NodesDatabase.get(device)
-    return db.get_pips(nodes, filter_type = filter_type)
+def _get_node_data(udb, nodes):
+    return [n for chunk in iter_node_data(udb, nodes) for n in chunk]
+
+class NodeDataLoader:
+    """
+    Coalesces node data requests from all threads for a device into shared lapie queries. Requests arriving within
+    `window` seconds of each other are batched, nodes already queued or in flight are not queried again, and the batch
+    size follows the measured nodes/sec so that each query takes roughly `target_seconds`.
+
+    `load` returns a Future per node which resolves to its NodeInfo (or None if lapie did not return it) once the
+    node has been written to the NodesDatabase.
+    """
+    _loaders = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(device):
+        with NodeDataLoader._lock:
+            if device not in NodeDataLoader._loaders:
+                NodeDataLoader._loaders[device] = NodeDataLoader(device)
+            return NodeDataLoader._loaders[device]
+
+    def __init__(self, device, window = 0.05, target_seconds = 60, min_batch = 50, max_batch = 20000):
+        import fuzzloops
+
+        self.device = device
+        self.window = window
+        self.target_seconds = target_seconds
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.batch_size = 5000
+        self.nodes_per_sec = None
+
+        self.jobs = fuzzloops.jobs()
+        self.executor = ThreadPoolExecutor(self.jobs, thread_name_prefix=f"node-loader-{device}")
+        self.cv = threading.Condition()
+        self.pending = {}
+        self.in_flight = {}
+        self.active_batches = 0
+
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True, name=f"node-loader-dispatch-{device}")
+        self.dispatcher.start()
+
+    def load(self, nodes):
+        """Queue nodes for loading. Returns a dict of node name to Future"""
+        futures = {}
+        with self.cv:
+            for n in nodes:
+                f = self.pending.get(n) or self.in_flight.get(n)
+                if f is None:
+                    f = self.pending[n] = Future()
+                futures[n] = f
+            self.cv.notify()
+        return futures
+
+    def _next_batch_size(self):
+        # Split the queue across the available tool sessions rather than leaving sessions idle behind one big query
+        share = -(-len(self.pending) // max(1, self.jobs - self.active_batches))
+        return max(self.min_batch, min(self.batch_size, share))
+
+    def _dispatch(self):
+        while True:
+            with self.cv:
+                while len(self.pending) == 0 or self.active_batches >= self.jobs:
+                    self.cv.wait()
+
+                # Give concurrent callers a short window to add to this batch
+                deadline = time.time() + self.window
+                while len(self.pending) < self.batch_size and (remaining := deadline - time.time()) > 0:
+                    self.cv.wait(remaining)
+
+                batch = sorted(self.pending)[:self._next_batch_size()]
+                for n in batch:
+                    self.in_flight[n] = self.pending.pop(n)
+                self.active_batches = self.active_batches + 1
+
+            self.executor.submit(self._run_batch, batch)
+
+    def _update_rate(self, count, elapsed):
+        rate = count / max(elapsed, 1e-3)
+        self.nodes_per_sec = rate if self.nodes_per_sec is None else 0.7 * self.nodes_per_sec + 0.3 * rate
+        self.batch_size = int(max(self.min_batch, min(self.max_batch, self.nodes_per_sec * self.target_seconds)))
+        logging.debug(f"Node loader {self.device}: {count} nodes in {elapsed:.1f}s, {self.nodes_per_sec:.1f} N/sec, next batch {self.batch_size}")
+
+    def _run_batch(self, batch):
+        from nodes_database import NodesDatabase
+
+        results = {}
+        exception = None
+        try:
+            s = time.time()
+            db = NodesDatabase.get(self.device)
+            requested = set(batch)
+            writes = []
+            # The last chunk can end in a node cut short if the tool dies, so it is only written once the report has
+            # finished cleanly; earlier chunks are complete and are written while parsing continues
+            last_chunk = None
+            for nodeinfos in iter_node_data(self.device, batch):
+                if last_chunk is not None:
+                    writes.append(db.insert_nodeinfos(last_chunk, wait=False))
+                last_chunk = nodeinfos
+                for ni in nodeinfos:
+                    for name in [ni.name, *ni.aliases]:
+                        if name in requested:
+                            results[name] = ni
+            if last_chunk is not None:
+                writes.append(db.insert_nodeinfos(last_chunk, wait=False))
+            for w in writes:
+                w.result()
+            self._update_rate(len(batch), time.time() - s)
+        except BaseException as e:
+            logging.error(f"Node loader {self.device} failed for {len(batch)} nodes {batch[:10]}: {e}")
+            exception = e
+
+        with self.cv:
+            futures = [(n, self.in_flight.pop(n)) for n in batch]
+            self.active_batches = self.active_batches - 1
+            self.cv.notify()
+
+        for n, f in futures:
+            if exception is not None:
+                f.set_exception(exception)
+            else:
+                f.set_result(results.get(n))
 
-def get_node_data(device, nodes, regex=False, executor = None, filter_by_name=True, skip_missing = False, skip_pips=False):
+def _get_node_data_future(device, nodes, regex=False, filter_by_name=True, skip_missing = False, skip_pips=False):
     from nodes_database import NodesDatabase
     import fuzzloops
 
@@ -344,58 +845,75 @@ def get_node_data(device, nodes, regex=False, executor = None, filter_by_name=Tr
         nodes = sorted(set(nodes))
 
     if regex:
-        all_nodes = get_full_node_list(device)
-        regex = [re.compile(n) for n in nodes]
-        nodes = sorted(set([n for n in all_nodes if any([r for r in regex if r.search(n) is not None])]))
+        nodes = sorted(find_nodes(device, nodes))
     elif filter_by_name:
-        all_nodes = get_full_node_list(device)
-        nodes = sorted(set(nodes) & all_nodes)
+        nodes = sorted(_node_list_db(device).filter_node_list(nodes))
 
+    rtn = Future()
     if len(nodes) == 0:
-        return []
+        rtn.set_result([])
+        return rtn
 
     db = NodesDatabase.get(device)
     t = time.time()
     nis = db.get_node_data(nodes, skip_pips=skip_pips)
     logging.debug(f"Looked up {len(nis)} records in {time.time() - t} sec")
     missing = sorted({k for k in nodes if k not in nis})
-    futures = []
 
-    if not skip_missing and len(missing):
-        cnt = 5000
-        logging.info(f"Getting from lapie: {len(missing)} nodes {missing[:10]}...")
+    # After a full prefetch anything still missing is a node lapie has no report for; don't ask again
+    if skip_missing or len(missing) == 0 or db.is_fully_prefetched():
+        rtn.set_result(list(nis.values()))
+        return rtn
 
-        with fuzzloops.Executor(executor) as local_executor:
-            def lapie_get_node_data(query):
-                s = time.time()
-                nodes = _get_node_data(device, query)
-                logging.debug(f"{len(query)} N {len(query) / (time.time() - s)} N/sec ({(time.time() - s)} deltas)")
-                return nodes
-
-            def integrate_nodes(nodes):
-                db = NodesDatabase.get(device)
-                try:
-                    db.insert_nodeinfos(nodes)
-                except sqlite3.OperationalError as e:
-                    logging.warning(f"Could not populate node db: {e}")
+    logging.info(f"Getting from lapie: {len(missing)} nodes {missing[:10]}...")
 
-                for n in nodes:
-                    nis[n.name] = n
+    def integrate_nodes(nodes):
+        for n in nodes:
+            if n is not None:
+                nis[n.name] = n
+        return list(nis.values())
 
-            for grp in itertools.batched(missing, cnt):
-                f = local_executor.submit(lapie_get_node_data, list(grp))
-                futures.append(fuzzloops.chain(f, integrate_nodes))
+    return fuzzloops.chain(list(NodeDataLoader.get(device).load(missing).values()), integrate_nodes)
 
+def get_node_data(device, nodes, regex=False, executor = None, filter_by_name=True, skip_missing = False, skip_pips=False):
+    """
+    Return NodeInfos for the given nodes, querying lapie through the shared NodeDataLoader for any nodes not in the
+    NodesDatabase yet. If an executor is given, a Future is returned instead.
+    """
+    future = _get_node_data_future(device, nodes, regex=regex, filter_by_name=filter_by_name,
+                                   skip_missing=skip_missing, skip_pips=skip_pips)
     if executor is not None:
-        return fuzzloops.chain(futures, lambda _: list(nis.values()))
-    else:
-        return list(nis.values())
+        return future
+    return future.result()
+
+async def get_node_data_async(device, nodes, **kwargs):
+    return await asyncio.wrap_future(_get_node_data_future(device, nodes, **kwargs))
+
+async def get_pip_data(device, nodes, filter_type = None):
+    from nodes_database import NodesDatabase
+    # Make sure we have full db for these entries
+    await get_node_data_async(device, nodes, skip_pips=True)
+
+    db = NodesDatabase.get(device)
+    return db.get_pips(nodes, filter_type = filter_type)
+
+async def get_pip_edges(device, nodes, direction = None):
+    """
+    Like get_pip_data, but returns the pips as NumPy (from_ids, to_ids, flags) arrays together with the name -> id
+    map of nodes. Use NodesDatabase.get_node_names to turn ids back into names.
+    """
+    from nodes_database import NodesDatabase
+    await get_node_data_async(device, nodes, skip_pips=True)
+
+    db = NodesDatabase.get(device)
+    name_to_id = db.lookup_node_ids(nodes, include_aliases=False)
+    return name_to_id, db.get_pip_edges(name_to_id.values(), direction=direction)
 
 def _get_sites(udb, rc = None):
     rc_slug = ""
     if rc is not None:
         rc_slug = f"-row {rc[0]} -column {rc[1]}"
-    rpt = run_with_udb(udb, [f'dev_list_site {rc_slug}'], stdout = subprocess.DEVNULL)
+    rpt = run_in_session(udb, [f'dev_list_site {rc_slug}'])
 
     return parse_sites(rpt)
 
@@ -406,26 +924,27 @@ def get_sites(device, rc = None):
     sites = get_sites_with_pin(device, rc)
     return list(sites.keys())
 
-def parse_report_site(rpt):
-    site_re = re.compile(
-        r'^Site=(?P<site_name>\S+)\s+'
-        r'id=(?P<id>\d+)\s+'
-        r'type=(?P<type>\S+)\s+'
-        r'X=(?P<x>-?\d+)\s+'
-        r'Y=(?P<y>-?\d+)$'
-    )
-
-    pin_re = re.compile(
-        r'^\s*Pin\s+id\s*=\s*(?P<pin_id>\d+)\s+'
-        r'pin\s+name\s*=\s*(?P<pin_name>\S+)\s+'
-        r'pin\s+node\s+name\s*=\s*(?P<pin_node>\S+)$'
-    )
-    
-    past_preamble = False
-    sites = {}
+site_report_re = re.compile(
+    r'^Site=(?P<site_name>\S+)\s+'
+    r'id=(?P<id>\d+)\s+'
+    r'type=(?P<type>\S+)\s+'
+    r'X=(?P<x>-?\d+)\s+'
+    r'Y=(?P<y>-?\d+)$'
+)
+
+site_pin_report_re = re.compile(
+    r'^\s*Pin\s+id\s*=\s*(?P<pin_id>\d+)\s+'
+    r'pin\s+name\s*=\s*(?P<pin_name>\S+)\s+'
+    r'pin\s+node\s+name\s*=\s*(?P<pin_node>\S+)$'
+)
+
+def iter_report_site(lines, has_preamble = True):
+    """Incrementally parse a dev_report_site report, yielding (site_name, site_info) as each site completes"""
+    past_preamble = not has_preamble
+    site_name = None
     current_site = None
-    
-    for line in rpt.split('\n'):
+
+    for line in lines:
         sl = line.strip()
 
         if not past_preamble:
@@ -435,20 +954,26 @@ def parse_report_site(rpt):
         if "--------------------" in sl:
             break
 
-        m = site_re.match(line)
-        if m:
-            current_site = m.groupdict()
-            current_site["pins"] = []
-            sites[current_site["site_name"]] = current_site
-            del current_site["site_name"]
-            
-        m = pin_re.match(line)
-        if m:
-            pins = m.groupdict()
-            del pins["pin_id"]
-            current_site["pins"].append(pins)
+        if sl.startswith("Site="):
+            m = site_report_re.match(line)
+            if m:
+                if current_site is not None:
+                    yield site_name, current_site
+                current_site = m.groupdict()
+                current_site["pins"] = []
+                site_name = current_site.pop("site_name")
+        elif sl.startswith("Pin"):
+            m = site_pin_report_re.match(line)
+            if m:
+                pins = m.groupdict()
+                del pins["pin_id"]
+                current_site["pins"].append(pins)
+
+    if current_site is not None:
+        yield site_name, current_site
 
-    return sites
+def parse_report_site(rpt):
+    return dict(iter_report_site(rpt.split('\n'), "Successfully loading udb" in rpt))
 
 @cachecontrol.cache_fn()
 def get_sites_with_pin(device):
@@ -459,7 +984,7 @@ def get_sites_with_pin(device):
     sites = node_db.get_sites()
 
     if len(sites) == 0:
-        rpt = run_with_udb(device, [f'dev_report_site'], stdout = subprocess.DEVNULL)
+        rpt = run_in_session(device, [f'dev_report_site'])
         sites =  parse_report_site(rpt)
 
         node_db.insert_sites(sites)
@@ -469,7 +994,7 @@ def get_sites_with_pin(device):
 
 def list_nets(udb):
     # des_list_net no longer works?
-    output = run_with_udb(udb, ['des_report_instance'])
+    output = run_in_session(udb, ['des_report_instance'])
     net_list = set()
 
     for line in output.split('\n'):
@@ -483,12 +1008,16 @@ def list_nets(udb):
 
 
 class NetPin:
+    __slots__ = ["cell", "pin", "node"]
+
     def __init__(self, cell, pin, node):
         self.cell = cell
         self.pin = pin
         self.node = node
 
 class NetPip:
+    __slots__ = ["node1", "node2", "is_dir"]
+
     def __init__(self, node1, node2, is_dir):
         self.node1 = node1
         self.node2 = node2
@@ -499,28 +1028,43 @@ class NetRouting:
         self.pins = []
         self.pips = []
 
-def get_routing(udb, nets):
-    output = run_with_udb(udb, ['des_report_net {{{}}}'.format(n) for n in nets])
+route_name_re = re.compile(r'Name = ([^ ]*) id = \d+ power_type = \d+')
+route_pin_re = re.compile(r'comp= ([^ ]*) pin= ([^ ]*) node= ([^ ]*) subnet= \d+ num_x=\d+')
+route_pip_re = re.compile(r'node1= ([^ ]*) node2= ([^ ]*) subnet= \d+  type=\(\d+ -> \d+\)  dir=([A-Z])')
+
+def iter_routing(lines):
+    """Incrementally parse des_report_net output, yielding (net, NetRouting) pairs"""
     curr_routing = NetRouting()
-    routing = {}
-    name_re = re.compile(r'Name = ([^ ]*) id = \d+ power_type = \d+')
-    pin_re = re.compile(r'comp= ([^ ]*) pin= ([^ ]*) node= ([^ ]*) subnet= \d+ num_x=\d+')
-    pip_re = re.compile(r'node1= ([^ ]*) node2= ([^ ]*) subnet= \d+  type=\(\d+ -> \d+\)  dir=([A-Z])')
 
-    for line in output.split('\n'):
+    for line in lines:
         sl = line.strip()
-        nm = name_re.match(sl)
-        if nm:
-            curr_net = nm.group(1)
-            routing[curr_net] = curr_routing
-            curr_routing = NetRouting()
+        if sl.startswith("Name = "):
+            nm = route_name_re.match(sl)
+            if nm:
+                yield nm.group(1), curr_routing
+                curr_routing = NetRouting()
             continue
-        pm = pin_re.match(sl)
-        if pm:
-            curr_routing.pins.append(NetPin(pm.group(1), pm.group(2), pm.group(3)))
+        if sl.startswith("comp= "):
+            pm = route_pin_re.match(sl)
+            if pm:
+                curr_routing.pins.append(NetPin(pm.group(1), pm.group(2), pm.group(3)))
             continue
-        pipm = pip_re.match(sl)
-        if pipm:
-            is_dir = pipm.group(3) == "D"
-            curr_routing.pips.append(NetPip(pipm.group(1), pipm.group(2), is_dir))
-    return routing
+        if sl.startswith("node1= "):
+            pipm = route_pip_re.match(sl)
+            if pipm:
+                is_dir = pipm.group(3) == "D"
+                curr_routing.pips.append(NetPip(pipm.group(1), pipm.group(2), is_dir))
+
+def get_routing(udb, nets):
+    output = run_in_session(udb, ['des_report_net {{{}}}'.format(n) for n in nets])
+    return dict(iter_routing(output.split('\n')))
+
+def _reset_after_fork():
+    # Tool sessions belong to the parent, whose pipes the child shares, and loader threads don't survive a fork; the
+    # child starts its own on first use
+    TclSessionPool._lock = threading.Lock()
+    TclSessionPool._pools = {}
+    NodeDataLoader._lock = threading.Lock()
+    NodeDataLoader._loaders = {}
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,17 +1,291 @@
+import atexit
+import hashlib
+import itertools
+import json
 import logging
+import os
+import queue
+import re
 import sqlite3
 import threading
 import time
 from collections import defaultdict
+from concurrent.futures import Future
 from threading import RLock
 
+import numpy as np
+
 _thread_local = threading.local()
 
+_node_name_re = re.compile(r"^R(0|[1-9][0-9]*)C(0|[1-9][0-9]*)_(.+)$")
+
+def split_node_name(name):
+    """Split a node name into (row, col, wire suffix); names without an RC prefix give (-1, -1, name)"""
+    m = _node_name_re.match(name)
+    if m is None:
+        return -1, -1, name
+    return int(m.group(1)), int(m.group(2)), m.group(3)
+
+def join_node_name(row, col, suffix):
+    if row < 0:
+        return suffix
+    return f"R{row}C{col}_{suffix}"
+
+def _skip_class(pattern, i):
+    """Index just past the character class starting at pattern[i]"""
+    i = i + 1
+    if pattern[i:i + 1] == "^":
+        i = i + 1
+    # A leading ] is a literal member of the class
+    if pattern[i:i + 1] == "]":
+        i = i + 1
+    while i < len(pattern) and pattern[i] != "]":
+        i = i + (2 if pattern[i] == "\\" else 1)
+    return i + 1
+
+def _skip_group(pattern, i):
+    """Index just past the group starting at pattern[i]"""
+    depth = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i = i + 2
+            continue
+        if c == "[":
+            i = _skip_class(pattern, i)
+            continue
+        if c == "(":
+            depth = depth + 1
+        elif c == ")":
+            depth = depth - 1
+            if depth == 0:
+                return i + 1
+        i = i + 1
+    return i
+
+def required_literals(pattern):
+    """
+    Literal runs that every match of the regex pattern must contain, for narrowing a search with the trigram index.
+    Returns [] whenever that isn't obvious from the pattern (alternations, inline flags, unusual escapes, ...).
+    """
+    if "|" in pattern or re.search(r"\(\?(?!:)", pattern):
+        return []
+
+    runs = []
+    run = ""
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            nxt = pattern[i + 1:i + 2]
+            if nxt.isalnum():
+                if nxt in "xuUN01234567":
+                    return []
+                runs.append(run)
+                run = ""
+            else:
+                run = run + nxt
+            i = i + 2
+        elif c in "*?{":
+            # The previous character may not occur at all
+            runs.append(run[:-1])
+            run = ""
+            if c == "{":
+                i = pattern.find("}", i)
+                if i < 0:
+                    return []
+            i = i + 1
+        elif c == "(":
+            runs.append(run)
+            run = ""
+            i = _skip_group(pattern, i)
+        elif c == "[":
+            runs.append(run)
+            run = ""
+            i = _skip_class(pattern, i)
+        elif c in "+.^$)]}":
+            runs.append(run)
+            run = ""
+            i = i + 1
+        else:
+            run = run + c
+            i = i + 1
+    runs.append(run)
+
+    # The index is of trigrams; shorter runs can't narrow anything down
+    return [r for r in runs if len(r) >= 3]
+
+# Layout version of export_routing_graph's files
+ROUTING_GRAPH_FORMAT = 2
+
+def _hash_node_list(names):
+    h = hashlib.sha1()
+    for name in sorted(names):
+        h.update(name.encode())
+        h.update(b"\n")
+    return h.hexdigest()
+
+def _glob_escape(literal):
+    return "".join(f"[{c}]" if c in "*?[" else c for c in literal)
+
+def _compile_any(patterns):
+    """A predicate for "any of patterns matches", as one combined regex where that doesn't change the meaning"""
+    if not any(re.search(r"\\[1-9]|\(\?P=", p) for p in patterns):
+        try:
+            return re.compile("|".join(f"(?:{p})" for p in patterns)).search
+        except re.error:
+            pass
+    compiled = [re.compile(p) for p in patterns]
+    return lambda n: any(r.search(n) is not None for r in compiled)
+
+class NodesDatabaseWriter:
+    """
+    Owns the only read-write connection to a device's node database. Write jobs are queued from any thread and run
+    on the writer thread in batches, one transaction per batch, with a savepoint per job so a failing job doesn't take
+    the rest of the batch with it. Batches that hit a locked database are retried until they commit.
+    """
+    max_batch = 64
+    checkpoint_interval = 60
+
+    def __init__(self, device):
+        self.device = device
+        self.queue = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.jobs = 0
+        self.commits = 0
+        self.retries = 0
+        self.commit_seconds = 0
+        self.max_commit_seconds = 0
+        self.last_checkpoint = time.time()
+
+        ready = Future()
+        self.thread = threading.Thread(target=self._run, args=(ready,), daemon=True,
+                                       name=f"nodes-db-writer-{device}")
+        self.thread.start()
+        # Surfaces schema setup / migration errors to the first caller
+        ready.result()
+
+    def submit(self, fn, *args):
+        """Queue fn(db, *args) to run on the writer connection; the Future resolves once its batch is committed"""
+        future = Future()
+        self.queue.put((fn, args, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "jobs": self.jobs,
+                "commits": self.commits,
+                "retries": self.retries,
+                "avg_commit_ms": 1000 * self.commit_seconds / max(self.commits, 1),
+                "max_commit_ms": 1000 * self.max_commit_seconds,
+            }
+
+    def _run(self, ready):
+        try:
+            self.db = NodesDatabase(self.device)
+        except BaseException as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(True)
+
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            jobs = [job]
+            while len(jobs) < self.max_batch:
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.queue.put(None)
+                    break
+                jobs.append(job)
+
+            self._run_batch(jobs)
+
+            if self.queue.empty() and time.time() - self.last_checkpoint > self.checkpoint_interval:
+                self._checkpoint()
+
+        self._checkpoint()
+        self.db.conn.close()
+
+    @staticmethod
+    def _is_busy(e):
+        return isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e))
+
+    def _run_batch(self, jobs):
+        conn = self.db.conn
+
+        for attempt in itertools.count():
+            results = []
+            t = time.time()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for fn, args, future in jobs:
+                    conn.execute("SAVEPOINT job")
+                    try:
+                        results.append((future, fn(self.db, *args), None))
+                        conn.execute("RELEASE job")
+                    except Exception as e:
+                        if self._is_busy(e):
+                            raise
+                        conn.execute("ROLLBACK TO job")
+                        conn.execute("RELEASE job")
+                        results.append((future, None, e))
+                conn.execute("COMMIT")
+                self.db._transaction_done(committed=True)
+                break
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                self.db._transaction_done(committed=False)
+                if not self._is_busy(e):
+                    for fn, args, future in jobs:
+                        future.set_exception(e)
+                    return
+
+                delay = min(30, 0.1 * 2 ** attempt)
+                logging.warning(f"Node database for {self.device} is busy ({e}); retrying {len(jobs)} writes in {delay}s")
+                with self.stats_lock:
+                    self.retries = self.retries + 1
+                time.sleep(delay)
+
+        elapsed = time.time() - t
+        with self.stats_lock:
+            self.jobs = self.jobs + len(jobs)
+            self.commits = self.commits + 1
+            self.commit_seconds = self.commit_seconds + elapsed
+            self.max_commit_seconds = max(self.max_commit_seconds, elapsed)
+
+        for future, result, exception in results:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def _checkpoint(self):
+        # PASSIVE never waits on readers; it copies what it can and leaves the rest for the next one
+        self.last_checkpoint = time.time()
+        busy, log_pages, checkpointed = self.db.conn.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchone()
+        logging.debug(f"Checkpointed {checkpointed}/{log_pages} wal pages of {self.device}: {self.stats()}")
+
 class NodesDatabase:
+    """
+    Per-thread handle on a device's node database. Reads go through a read-only connection owned by the calling
+    thread; writes are handed to the device's NodesDatabaseWriter and block until committed.
+    """
     _lock = RLock()
-    _write_locks = {}
-    _last_checkpoint = {}
-    current_version = 3
+    _writers = {}
+    current_version = 4
 
     @staticmethod
     def get(device):
@@ -22,125 +296,267 @@ class NodesDatabase:
                 logging.warning(f"Creating dbs {_thread_local} {threading.get_ident()}")
                 setattr(_thread_local, 'dbs', {})
                 dbs = _thread_local.dbs
-            if device not in NodesDatabase._write_locks:
-                NodesDatabase._write_locks[device] = threading.Lock()
-            if device not in NodesDatabase._last_checkpoint:
-                NodesDatabase._last_checkpoint[device] = time.time()
+            if device not in NodesDatabase._writers:
+                NodesDatabase._writers[device] = NodesDatabaseWriter(device)
             if device not in dbs:
-                dbs[device] = NodesDatabase(device)
+                dbs[device] = NodesDatabase(device, writer=NodesDatabase._writers[device])
             return dbs[device]
 
-    def __init__(self, device):
+    @staticmethod
+    def close_all():
+        with NodesDatabase._lock:
+            for writer in NodesDatabase._writers.values():
+                writer.close()
+            NodesDatabase._writers.clear()
+
+    @staticmethod
+    def writer_stats():
+        with NodesDatabase._lock:
+            return {device: writer.stats() for device, writer in NodesDatabase._writers.items()}
+
+    @staticmethod
+    def writer_status():
+        """One line summary of the writer queues for status displays"""
+        stats = NodesDatabase.writer_stats().values()
+        if len(stats) == 0:
+            return "db idle"
+        depth = sum(st["queue_depth"] for st in stats)
+        commit_ms = max(st["avg_commit_ms"] for st in stats)
+        return f"db queue {depth} commit {commit_ms:.0f}ms"
+
+    def __init__(self, device, writer = None):
         import database
 
-        self.write_lock = NodesDatabase._write_locks[device]
         self.db_path = f"{database.get_cache_dir()}/{device}-nodes.sqlite"
         logging.debug(f"Opening node database at {self.db_path} thread: {threading.get_ident()}")
 
         self.device = device
-        self.conn = sqlite3.connect(self.db_path)
-        self.init_db()
+        self.writer = writer
+        self._suffix_cache = {}
+        self._uncommitted_suffixes = {}
+
+        # Transactions are explicit on both kinds of connection. Reads run as one autocommit statement each, so a
+        # reader never sits on an old snapshot that would hide the writer's commits and stall checkpoints.
+        if writer is None:
+            self.conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=60)
+            self.init_db()
+        else:
+            self.conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, isolation_level=None)
+            self._create_temp_tables()
+
+    def _write(self, fn, *args):
+        return self.writer.submit(fn, *args).result()
+
+    def _transaction_done(self, committed):
+        if committed:
+            self._suffix_cache.update(self._uncommitted_suffixes)
+        self._uncommitted_suffixes = {}
+
+    def _create_temp_tables(self):
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA temp_store = MEMORY;")
+        cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS tmp_node_ids (
+            id   INTEGER PRIMARY KEY
+        );
+        """)
+        cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS tmp_node_names (
+            name TEXT PRIMARY KEY
+        );
+        """)
+        cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS tmp_node_keys (
+            row       INTEGER NOT NULL,
+            col       INTEGER NOT NULL,
+            suffix_id INTEGER NOT NULL,
+            PRIMARY KEY (row, col, suffix_id)
+        ) WITHOUT ROWID;
+        """)
 
     def init_db(self):
+        """Schema setup and migration; only run on the writer connection"""
         conn = self.conn
         cur = conn.cursor()
         cur.execute("PRAGMA user_version;")
 
         version = cur.fetchone()
 
-        with conn:
-            cur.execute("""
-            CREATE TEMP TABLE IF NOT EXISTS tmp_node_ids (
-                id   INTEGER PRIMARY KEY
-            );            
-            """)
-            cur.execute("""
-                        CREATE
-                        TEMP TABLE IF NOT EXISTS tmp_node_names (
-                name TEXT PRIMARY KEY
-            );
-            """)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_temp_tables()
+
+        # Bookkeeping for tools/prefetch_nodes.py; independent of the node schema version
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS prefetch_shards (
+            shard_size INTEGER NOT NULL,
+            shard      INTEGER NOT NULL,
+            node_count INTEGER NOT NULL,
+            seconds    REAL NOT NULL,
+            PRIMARY KEY (shard_size, shard)
+        );
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS metadata (
+            key   TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        """)
+
+        # The full node list of the device, rowid = node id. The trigram index serves substring, GLOB and LIKE
+        # searches over the names; see search_node_list.
+        cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS node_list USING fts5(name, tokenize = 'trigram', detail = 'none');
+        """)
 
         if len(version) == 0 or version[0] != NodesDatabase.current_version:
-                with conn:
-                    cur.execute(f"PRAGMA user_version = {NodesDatabase.current_version};")
-                    conn.execute("PRAGMA foreign_keys = ON")
-                    conn.execute('PRAGMA journal_mode=WAL;')
-                    conn.execute('PRAGMA synchronous=NORMAL')
-
-                    cur.execute("""
-            CREATE TABLE IF NOT EXISTS nodes (
-                id   INTEGER PRIMARY KEY,
-                name TEXT UNIQUE NOT NULL,
-                has_full_data INTEGER NOT NULL DEFAULT 0 CHECK (has_full_data IN (0, 1))
-            );
-                    """)
+            # Off while tables are rebuilt; dropping the old nodes table would otherwise check every pip
+            conn.execute("PRAGMA foreign_keys = OFF")
 
-                    try:
-                        cur.execute("ALTER TABLE pips ADD COLUMN jumpwire INTEGER")
-                    except sqlite3.OperationalError as e:
-                        pass
-
-                    # PIPs table:
-                    # from_wire and to_wire are node IDs
-                    # bidir = 0 (unidirectional) or 1 (bidirectional)
-                    cur.execute("""
-            CREATE TABLE IF NOT EXISTS pips (
-                from_id INTEGER NOT NULL,
-                to_id   INTEGER NOT NULL,
-                bidir INTEGER NOT NULL CHECK (bidir IN (0,1)),
-                jumpwire INTEGER NOT NULL CHECK (jumpwire IN (0,1)) DEFAULT 0,
-                flags INTEGER NOT NULL DEFAULT 0,
-                buffertype TEXT NOT NULL DEFAULT "",
-                PRIMARY KEY (from_id, to_id),
-                FOREIGN KEY (from_id) REFERENCES nodes(id),
-                FOREIGN KEY (to_id)   REFERENCES nodes(id)
-            ) WITHOUT ROWID;
-                    """)
+            migrated = False
+            with conn:
+                cur.execute("BEGIN IMMEDIATE")
+                if "name" in self._table_columns(cur, "nodes"):
+                    self._migrate_node_names(cur)
+                    migrated = True
 
-                    try:
-                        cur.execute("""CREATE INDEX from_id_index ON pips (from_id);""")
-                        cur.execute("""CREATE INDEX to_id_index ON pips (to_id);""")
-                    except sqlite3.OperationalError as e:
-                        pass
-
-
-                    cur.execute("""
-                    CREATE TABLE IF NOT EXISTS sites (
-                        id   INTEGER PRIMARY KEY,
-                        name TEXT UNIQUE NOT NULL,
-                        type TEXT NOT NULL,
-                        x    INTEGER NOT NULL,
-                        y    INTEGER NOT NULL
-                    );
-                    """)
+                self._create_tables(cur)
+                cur.execute(f"PRAGMA user_version = {NodesDatabase.current_version};")
+
+            if migrated:
+                logging.info(f"Compacting {self.db_path}")
+                conn.execute("VACUUM")
+
+        conn.execute("PRAGMA foreign_keys = ON")
+
+    @staticmethod
+    def _table_columns(cur, table):
+        return {row[1] for row in cur.execute(f"PRAGMA table_info({table})").fetchall()}
+
+    def _create_tables(self, cur):
+        # Node names are stored split as R<row>C<col>_<suffix>; the suffixes repeat across tiles and are kept once in
+        # wire_suffixes. Names not of that form get row = col = -1 and the whole name as suffix.
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS wire_suffixes (
+            id     INTEGER PRIMARY KEY,
+            suffix TEXT UNIQUE NOT NULL
+        );
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS nodes (
+            id        INTEGER PRIMARY KEY,
+            row       INTEGER NOT NULL,
+            col       INTEGER NOT NULL,
+            suffix_id INTEGER NOT NULL,
+            has_full_data INTEGER NOT NULL DEFAULT 0 CHECK (has_full_data IN (0, 1)),
+            UNIQUE (row, col, suffix_id),
+            FOREIGN KEY (suffix_id) REFERENCES wire_suffixes(id)
+        );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS nodes_suffix_index ON nodes (suffix_id);")
+
+        try:
+            cur.execute("ALTER TABLE pips ADD COLUMN jumpwire INTEGER")
+        except sqlite3.OperationalError as e:
+            pass
+
+        # PIPs table:
+        # from_wire and to_wire are node IDs
+        # bidir = 0 (unidirectional) or 1 (bidirectional)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS pips (
+            from_id INTEGER NOT NULL,
+            to_id   INTEGER NOT NULL,
+            bidir INTEGER NOT NULL CHECK (bidir IN (0,1)),
+            jumpwire INTEGER NOT NULL CHECK (jumpwire IN (0,1)) DEFAULT 0,
+            flags INTEGER NOT NULL DEFAULT 0,
+            buffertype TEXT NOT NULL DEFAULT "",
+            PRIMARY KEY (from_id, to_id),
+            FOREIGN KEY (from_id) REFERENCES nodes(id),
+            FOREIGN KEY (to_id)   REFERENCES nodes(id)
+        ) WITHOUT ROWID;
+        """)
 
-                    cur.execute("""
+        try:
+            cur.execute("""CREATE INDEX from_id_index ON pips (from_id);""")
+            cur.execute("""CREATE INDEX to_id_index ON pips (to_id);""")
+        except sqlite3.OperationalError as e:
+            pass
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS sites (
+            id   INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            type TEXT NOT NULL,
+            x    INTEGER NOT NULL,
+            y    INTEGER NOT NULL
+        );
+        """)
+
+        cur.execute("""
         CREATE TABLE IF NOT EXISTS site_pins (
             site_id INTEGER NOT NULL,
             pin_name TEXT NOT NULL,
             node_id INTEGER NOT NULL,
-        
+
             PRIMARY KEY (site_id, pin_name),
-        
+
             FOREIGN KEY (site_id) REFERENCES sites(id) ON DELETE CASCADE,
             FOREIGN KEY (node_id) REFERENCES nodes(id)
         ) WITHOUT ROWID;
-                                """)
-
-
-                    cur.execute("""
-                    CREATE TABLE IF NOT EXISTS node_aliases (
-                        node_id INTEGER NOT NULL,
-                        alias TEXT UNIQUE NOT NULL,
-                        
-                        PRIMARY KEY (alias),
-                        
-                        FOREIGN KEY (node_id) REFERENCES nodes(id)
-                    ) WITHOUT ROWID;            
-                    """)
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS node_aliases (
+            row       INTEGER NOT NULL,
+            col       INTEGER NOT NULL,
+            suffix_id INTEGER NOT NULL,
+            node_id   INTEGER NOT NULL,
+
+            PRIMARY KEY (row, col, suffix_id),
+
+            FOREIGN KEY (suffix_id) REFERENCES wire_suffixes(id),
+            FOREIGN KEY (node_id) REFERENCES nodes(id)
+        ) WITHOUT ROWID;
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS node_aliases_node_index ON node_aliases (node_id);")
+
+    def _migrate_node_names(self, cur):
+        """Convert the TEXT node names of a version 3 database to (row, col, suffix_id), keeping node ids"""
+        t = time.time()
+
+        suffix_ids = {}
+        def key(name):
+            row, col, suffix = split_node_name(name)
+            return row, col, suffix_ids.setdefault(suffix, len(suffix_ids) + 1)
+
+        nodes = [(node_id, *key(name), full)
+                 for node_id, name, full in cur.execute("SELECT id, name, has_full_data FROM nodes").fetchall()]
+        aliases = []
+        if "alias" in self._table_columns(cur, "node_aliases"):
+            aliases = [(*key(alias), node_id)
+                       for node_id, alias in cur.execute("SELECT node_id, alias FROM node_aliases").fetchall()]
+            cur.execute("DROP TABLE node_aliases")
+
+        cur.execute("DROP TABLE nodes")
+        self._create_tables(cur)
+
+        cur.executemany("INSERT INTO wire_suffixes (id, suffix) VALUES (?, ?)",
+                        ((suffix_id, suffix) for suffix, suffix_id in suffix_ids.items()))
+        cur.executemany("INSERT INTO nodes (id, row, col, suffix_id, has_full_data) VALUES (?, ?, ?, ?, ?)", nodes)
+        cur.executemany("INSERT OR IGNORE INTO node_aliases (row, col, suffix_id, node_id) VALUES (?, ?, ?, ?)",
+                        aliases)
+
+        logging.info(f"Migrated {len(nodes)} nodes and {len(aliases)} aliases in {self.db_path} to "
+                     f"{len(suffix_ids)} wire suffixes in {time.time() - t:.1f} sec")
 
     def _populate_tmp(self, cur, type, values):
+        # Readers are in autocommit mode; batch the temp table rows into one transaction rather than one each
+        begin = not self.conn.in_transaction
+        if begin:
+            cur.execute("BEGIN")
+
         cur.execute(f"DELETE FROM tmp_node_{type}s")
 
         cur.executemany(
@@ -148,95 +564,180 @@ class NodesDatabase:
             ((n,) for n in values)
         )
 
+        if begin:
+            cur.execute("COMMIT")
+
+    def _suffix_ids(self, cur, suffixes, create = False):
+        suffix_ids = {s: self._suffix_cache[s] for s in suffixes if s in self._suffix_cache}
+        missing = set(suffixes) - suffix_ids.keys()
+        if len(missing) == 0:
+            return suffix_ids
+
+        if create:
+            cur.executemany("INSERT OR IGNORE INTO wire_suffixes (suffix) VALUES (?)", ((s,) for s in missing))
+
+        self._populate_tmp(cur, "name", missing)
+        cur.execute("SELECT suffix, id FROM wire_suffixes WHERE suffix IN (SELECT name from tmp_node_names)")
+        found = dict(cur.fetchall())
+        suffix_ids.update(found)
+
+        # Ids from an uncommitted insert could still be rolled back, so only cache what is known to be committed
+        if self.conn.in_transaction:
+            self._uncommitted_suffixes.update(found)
+        else:
+            self._suffix_cache.update(found)
+        return suffix_ids
+
+    def _node_keys(self, cur, names, create = False):
+        """(row, col, suffix_id) for each of names. Names with a suffix the database has never seen are left out."""
+        split = {n: split_node_name(n) for n in set(names)}
+        suffix_ids = self._suffix_ids(cur, {suffix for _, _, suffix in split.values()}, create = create)
+        return {n: (row, col, suffix_ids[suffix]) for n, (row, col, suffix) in split.items() if suffix in suffix_ids}
+
+    def _populate_tmp_keys(self, cur, keys):
+        begin = not self.conn.in_transaction
+        if begin:
+            cur.execute("BEGIN")
+
+        cur.execute("DELETE FROM tmp_node_keys")
+        cur.executemany("INSERT OR IGNORE INTO tmp_node_keys (row, col, suffix_id) VALUES (?, ?, ?)", keys)
+
+        if begin:
+            cur.execute("COMMIT")
+
+    def _ids_for_keys(self, cur, keys, table = "nodes", id_column = "id", condition = ""):
+        key_to_name = {k: n for n, k in keys.items()}
+        self._populate_tmp_keys(cur, key_to_name.keys())
+
+        cur.execute(f"""
+            SELECT n.{id_column}, n.row, n.col, n.suffix_id
+            FROM tmp_node_keys t
+            JOIN {table} n ON n.row = t.row AND n.col = t.col AND n.suffix_id = t.suffix_id
+            {condition}
+        """)
+        return {key_to_name[(row, col, suffix_id)]: node_id for node_id, row, col, suffix_id in cur.fetchall()}
+
     def get_node_ids(self, names):
-        conn = self.conn
-        cur = conn.cursor()
-        self._populate_tmp(cur, "name", names)
+        """Ids for names, adding nodes that aren't known yet. Writer side; use from inside a write job."""
+        cur = self.conn.cursor()
+        keys = self._node_keys(cur, names, create = True)
 
         cur.executemany(
-            "INSERT OR IGNORE INTO nodes (name) VALUES (?)",
-            ((ni,) for ni in names)
+            "INSERT OR IGNORE INTO nodes (row, col, suffix_id) VALUES (?, ?, ?)",
+            keys.values()
         )
 
-        cur.execute(
-            f"SELECT id, name FROM nodes where name IN (SELECT name from tmp_node_names)",
-        )
+        return self._ids_for_keys(cur, keys)
 
-        id_to_name = dict(cur.fetchall())
-        name_to_id = {v: k for k, v in id_to_name.items()}
+    def lookup_node_ids(self, names, include_aliases = True):
+        """Map names (or aliases) of already known nodes to their ids; unknown names are left out"""
+        cur = self.conn.cursor()
+        keys = self._node_keys(cur, names)
+
+        name_to_id = self._ids_for_keys(cur, keys)
+        if include_aliases:
+            name_to_id.update(self._ids_for_keys(cur, keys, table = "node_aliases", id_column = "node_id"))
         return name_to_id
 
-    def get_pips(self, filter = None, filter_type = None):
-        conn = self.conn
-        cur = conn.cursor()
+    def get_node_names(self, ids):
+        cur = self.conn.cursor()
+        self._populate_tmp(cur, "id", set(ids))
+
+        cur.execute("""
+            SELECT n.id, n.row, n.col, s.suffix
+            FROM nodes n
+            JOIN wire_suffixes s ON s.id = n.suffix_id
+            WHERE n.id IN (SELECT id from tmp_node_ids)
+        """)
+        return {node_id: join_node_name(row, col, suffix) for node_id, row, col, suffix in cur.fetchall()}
+
+    def get_nodes_at_rc(self, row, col):
+        """Name -> id of every known node at R<row>C<col>"""
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT n.id, s.suffix
+            FROM nodes n
+            JOIN wire_suffixes s ON s.id = n.suffix_id
+            WHERE n.row = ? AND n.col = ?
+        """, (row, col))
+        return {join_node_name(row, col, suffix): node_id for node_id, suffix in cur.fetchall()}
+
+    def get_nodes_with_suffix(self, suffix):
+        """Name -> id of every known instance of the wire suffix, e.g. "JCLK0" for R4C5_JCLK0, R9C2_JCLK0, ..."""
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT n.id, n.row, n.col
+            FROM wire_suffixes s
+            JOIN nodes n ON n.suffix_id = s.id
+            WHERE s.suffix = ?
+        """, (suffix,))
+        return {join_node_name(row, col, suffix): node_id for node_id, row, col in cur.fetchall()}
+
+    def get_pip_edges(self, node_ids = None, direction = None, jumpwires_only = False):
+        """
+        Pip edges as NumPy arrays (from_ids, to_ids, flags).
+
+        With node_ids, only edges touching those nodes are returned; direction "uphill" keeps just the edges driving
+        them and "downhill" just the edges they drive.
+        """
+        cur = self.conn.cursor()
+        cur.arraysize = 100000
+
+        conditions = []
+        if node_ids is not None:
+            self._populate_tmp(cur, "id", set(node_ids))
+            if direction != "downhill":
+                conditions.append("to_id IN (SELECT id from tmp_node_ids)")
+            if direction != "uphill":
+                conditions.append("from_id IN (SELECT id from tmp_node_ids)")
+            conditions = [" OR ".join(conditions)]
+        if jumpwires_only:
+            conditions.append("jumpwire = 1")
+
+        where = ("WHERE " + " AND ".join(f"({c})" for c in conditions)) if conditions else ""
 
         t = time.time()
-        if filter is None:
-            cur.execute(f"""
-                SELECT n1.name, n2.name
-                FROM pips p
-                JOIN nodes n1 ON n1.id = p.from_id
-                JOIN nodes n2 ON n2.id = p.to_id            
-            """)
-        elif filter_type is None:
-            self._populate_tmp(cur, "name", filter)
-            cur.execute(f"""
-                SELECT n1.name, n2.name
-                FROM pips p
-                JOIN nodes n1 ON n1.id = p.from_id
-                JOIN nodes n2 ON n2.id = p.to_id      
-                WHERE n1.name IN (SELECT name from tmp_node_names) OR n2.name IN (SELECT name from tmp_node_names)      
-            """)
-        else:
-            self._populate_tmp(cur, "name", filter)
+        cur.execute(f"SELECT from_id, to_id, flags FROM pips {where}")
+        chunks = []
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.int64))
 
-            cur.execute(f"""
-                SELECT n1.name, n2.name
-                FROM pips p
-                JOIN nodes n1 ON n1.id = p.from_id
-                JOIN nodes n2 ON n2.id = p.to_id      
-                WHERE {"n1" if filter_type == "from" else "n2"}.name IN (SELECT name from tmp_node_names)
-            """)
+        edges = np.concatenate(chunks) if chunks else np.zeros((0, 3), dtype=np.int64)
+        logging.debug(f"Returned {len(edges)} pip edges in {time.time()-t} seconds")
+        return edges[:, 0], edges[:, 1], edges[:, 2]
 
-        cnt = 0
-        for from_id, to_id in cur.fetchall():
-            yield from_id, to_id
-            cnt = cnt + 1
-        logging.debug(f"Returned {cnt} pips in {time.time()-t} seconds {cnt / (time.time()-t)} hz")
+    def _names_for_edges(self, from_ids, to_ids):
+        ids = np.unique(np.concatenate([from_ids, to_ids]))
+        id_to_name = self.get_node_names(ids.tolist())
+        return [(id_to_name[f], id_to_name[t]) for f, t in zip(from_ids.tolist(), to_ids.tolist())]
 
-    def get_jumpwires(self):
-        conn = self.conn
-        cur = conn.cursor()
+    def get_pips(self, filter = None, filter_type = None):
+        node_ids = None
+        if filter is not None:
+            node_ids = self.lookup_node_ids(filter, include_aliases=False).values()
 
-        cur.execute(f"""
-            SELECT n1.name, n2.name, p.bidir, p.flags, p.buffertype
-            FROM pips p
-            JOIN nodes n1 ON n1.id = p.from_id
-            JOIN nodes n2 ON n2.id = p.to_id
-            WHERE jumpwire = 1
-        """)
+        direction = {"from": "downhill", "to": "uphill"}.get(filter_type)
+        from_ids, to_ids, _ = self.get_pip_edges(node_ids, direction=direction)
 
-        for from_name, to_name, bidir, flags, bt in cur.fetchall():
-            yield from_name, to_name
+        yield from self._names_for_edges(from_ids, to_ids)
 
-    def insert_jumpwires(self, jumpwires):
-        conn = self.conn
-        cur = conn.cursor()
+    def get_jumpwires(self):
+        from_ids, to_ids, _ = self.get_pip_edges(jumpwires_only=True)
 
-        touched_names = set([w for ni in jumpwires for w in ni])
+        yield from self._names_for_edges(from_ids, to_ids)
 
-        cur.executemany(
-            "INSERT OR IGNORE INTO nodes (name) VALUES (?)",
-            ((ni,) for ni in touched_names)
-        )
+    def insert_jumpwires(self, jumpwires):
+        self._write(NodesDatabase._insert_jumpwires, jumpwires)
 
-        self._populate_tmp(cur, "name", touched_names)
+    def _insert_jumpwires(self, jumpwires):
+        cur = self.conn.cursor()
 
-        cur.execute(
-            f"SELECT id, name FROM nodes WHERE name IN (SELECT name from tmp_node_names)"
-        )
-        id_to_name = dict(cur.fetchall())
-        name_to_id = {v: k for k, v in id_to_name.items()}
+        touched_names = set([w for ni in jumpwires for w in ni])
+
+        name_to_id = self.get_node_ids(touched_names)
 
         cur.executemany(
             """
@@ -253,186 +754,172 @@ class NodesDatabase:
             """,
             [(name_to_id[j[0]], name_to_id[j[1]]) for j in jumpwires]
         )
-        print("jmp", len(jumpwires))
+        self._bump_generation(cur)
+        logging.debug(f"Inserted {len(jumpwires)} jumpwires")
 
-        conn.commit()
-
-    def get_node_data(self, names, skip_pips=False):
-        from lapie import NodeInfo, PipInfo
+    def get_node_data(self, names, skip_pips=False, skip_aliases=False, direction=None):
+        """
+        NodeInfos for the nodes in names that have full data. skip_pips returns bare NodeInfos, skip_aliases leaves out
+        the alias lookup and direction ("uphill" or "downhill") fetches only that side of each node's pips. With pips,
+        the values are views into one lapie.NodeInfoBatch.
+        """
+        from lapie import NodeInfo, NodeInfoBatch
 
         conn = self.conn
         cur = conn.cursor()
         cur.arraysize = 100000
 
-        self._populate_tmp(cur, "name", names)
-
-        cur.execute(
-            f"SELECT id, name FROM nodes WHERE has_full_data = 1 and name IN (SELECT name from tmp_node_names)",
-        )
-        id_to_name = dict(cur.fetchall())
-        name_to_id = {v:k for k,v in id_to_name.items()}
+        name_to_id = self._ids_for_keys(cur, self._node_keys(cur, names), condition = "WHERE n.has_full_data = 1")
+        id_to_name = {v: k for k, v in name_to_id.items()}
 
-        # Prepare result dict
-        result = {name: NodeInfo(name) for name in name_to_id}
         if skip_pips:
-            return result
+            return {name: NodeInfo(name) for name in name_to_id}
 
-        for k,v in result.items():
-            v.aliases.append(k)
+        aliases = {node_id: [name] for node_id, name in id_to_name.items()}
 
         self._populate_tmp(cur, "id", list(id_to_name.keys()))
 
+        conditions = []
+        if direction != "downhill":
+            conditions.append("p.to_id IN (SELECT id from tmp_node_ids)")
+        if direction != "uphill":
+            conditions.append("p.from_id IN (SELECT id from tmp_node_ids)")
+
+        # Names are resolved per id afterwards rather than joined onto every pip row
         cur.execute(f"""
-            SELECT n1.name, n2.name, p.bidir, p.flags, p.buffertype
+            SELECT p.from_id, p.to_id, p.bidir, p.flags, p.buffertype
             FROM pips p
-            JOIN nodes n1 ON n1.id = p.from_id
-            JOIN nodes n2 ON n2.id = p.to_id
-            WHERE p.from_id IN (SELECT id from tmp_node_ids) or
-                  p.to_id IN (SELECT id from tmp_node_ids)
+            WHERE {" OR ".join(conditions)}
         """)
 
         t = time.time()
-        cnt = 0
+        rows = []
         while True:
             results = cur.fetchmany(cur.arraysize)
             if not results:
                 break
-            cnt = cnt + len(results)
-            for from_name, to_name, bidir, flags, bt in results:
-                pip = PipInfo(from_name, to_name,
-                            is_bidi=bool(bidir),
-                            flags=flags,
-                            buffertype=bt)
-                if from_name in result:
-                    result[from_name].downhill_pips.append(pip)
-                if to_name in result:
-                    result[to_name].uphill_pips.append(pip)
-
-        logging.debug(f"Looked up {cnt} pips in {time.time() - t} sec")
+            rows.extend(results)
 
-        cur.execute(f"""
-            SELECT n.node_id, n.alias
-            FROM node_aliases n
-            WHERE n.node_id IN (SELECT id from tmp_node_ids)                      
-        """)
+        # Before get_node_names, which reuses tmp_node_ids
+        if not skip_aliases:
+            cur.execute(f"""
+                SELECT a.node_id, a.row, a.col, s.suffix
+                FROM node_aliases a
+                JOIN wire_suffixes s ON s.id = a.suffix_id
+                WHERE a.node_id IN (SELECT id from tmp_node_ids)
+            """)
 
-        for node_id, alias in cur.fetchall():
-            result[id_to_name[node_id]].aliases.append(alias)
+            for node_id, row, col, suffix in cur.fetchall():
+                aliases[node_id].append(join_node_name(row, col, suffix))
 
-        return result
+        other_ids = {from_id for from_id, *_ in rows} | {to_id for _, to_id, *_ in rows}
+        id_to_name.update(self.get_node_names(other_ids - id_to_name.keys()))
 
+        columns = list(zip(*rows)) if len(rows) else [(), (), (), (), ()]
+        buffertypes = {}
+        buffertype_idx = [buffertypes.setdefault(bt, len(buffertypes)) for bt in columns[4]]
+        node_ids = list(aliases.keys())
+        batch = NodeInfoBatch(id_to_name, node_ids, [aliases[i] for i in node_ids],
+                              columns[0], columns[1], columns[2], columns[3], buffertype_idx, list(buffertypes),
+                              direction = direction)
 
-    def insert_nodeinfos(self, nodeinfos):
-        with self.write_lock:
-            exception = None
-            for i in range(3):
-                try:
-                    self._insert_nodeinfos(nodeinfos)
+        logging.debug(f"Looked up {len(rows)} pips in {time.time() - t} sec")
 
-                    now = time.time()
-                    if now - NodesDatabase._last_checkpoint[self.device] > 5 * 60:
-                        NodesDatabase._last_checkpoint[self.device] = now
-                        cur = self.conn.cursor()
-                        logging.debug(f"Running wal checkpoint {threading.get_ident()}")
-                        cur.execute("PRAGMA wal_checkpoint(FULL);")
+        return batch.as_dict()
 
-                    return
-                except sqlite3.OperationalError as e:
-                    exception = e
-            logging.warning(f"Could not insert nodeinfos after 3 tries: {exception}")
+
+    def insert_nodeinfos(self, nodeinfos, wait = True):
+        """Queue nodeinfos for the writer. With wait=False the Future of the write is returned instead of waiting."""
+        future = self.writer.submit(NodesDatabase._insert_nodeinfos, nodeinfos)
+        if not wait:
+            return future
+        future.result()
 
     def _insert_nodeinfos(self, nodeinfos):
         touched_names = set([w for ni in nodeinfos for p in ni.pips() for w in [p.to_wire, p.from_wire]]) | set(
             [n.name for n in nodeinfos])
 
+        cur = self.conn.cursor()
+
+        # 1. Insert all nodes
+        name_to_id = self.get_node_ids(touched_names)
+
+        cur.executemany(
+            "UPDATE nodes SET has_full_data = 1 WHERE id = ?",
+            ((name_to_id[n.name],) for n in nodeinfos)
+        )
+
+        pip_rows = []
+
+        for ni in nodeinfos:
+            for p in ni.pips():
+                from_id = name_to_id.get(p.from_wire)
+                to_id = name_to_id.get(p.to_wire)
 
-        with self.conn as conn:
-            cur = conn.cursor()
-
-            # 1. Insert all nodes
-            cur.executemany(
-                "INSERT OR IGNORE INTO nodes (name) VALUES (?)",
-                ((ni,) for ni in touched_names)
-            )
-
-            self._populate_tmp(cur, "name", {n.name for n in nodeinfos})
-
-            cur.execute(
-                f"""
-                    UPDATE nodes
-                    SET has_full_data = 1
-                    WHERE name IN (SELECT name from tmp_node_names)
-                    """
-            )
-
-            self._populate_tmp(cur, "name", touched_names)
-
-            cur.execute(
-                f"SELECT id, name FROM nodes WHERE name IN (SELECT name from tmp_node_names)"
-            )
-            id_to_name = dict(cur.fetchall())
-            name_to_id = {v:k for k,v in id_to_name.items()}
-
-            pip_rows = []
-
-            for ni in nodeinfos:
-                for p in ni.pips():
-                    from_id = name_to_id.get(p.from_wire)
-                    to_id = name_to_id.get(p.to_wire)
-
-                    pip_rows.append(
-                        (from_id, to_id,
-                         1 if p.is_bidi else 0,
-                         p.flags,
-                         p.buffertype)
-                    )
-
-            cur.executemany(
-                """
-                INSERT OR IGNORE INTO pips
-                (from_id, to_id, bidir, flags, buffertype)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                pip_rows
-            )
-
-            cur.executemany(
-                """
-                INSERT OR IGNORE INTO node_aliases
-                (node_id, alias)
-                VALUES (?, ?)
-                """,
-                [(name_to_id[n.name], alias) for n in nodeinfos for alias in n.aliases if alias != n.name]
-            )
+                pip_rows.append(
+                    (from_id, to_id,
+                     1 if p.is_bidi else 0,
+                     p.flags,
+                     p.buffertype)
+                )
+
+        cur.executemany(
+            """
+            INSERT OR IGNORE INTO pips
+            (from_id, to_id, bidir, flags, buffertype)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            pip_rows
+        )
+
+        aliases = {}
+        for n in nodeinfos:
+            for alias in n.aliases:
+                if alias != n.name:
+                    aliases.setdefault(alias, n.name)
+        alias_keys = self._node_keys(cur, aliases, create = True)
+        cur.executemany(
+            """
+            INSERT OR IGNORE INTO node_aliases
+            (row, col, suffix_id, node_id)
+            VALUES (?, ?, ?, ?)
+            """,
+            [(*alias_keys[alias], name_to_id[name]) for alias, name in aliases.items()]
+        )
+
+        self._bump_generation(cur)
 
     def insert_sites_and_fetch_ids(self, sites):
         if not sites:
             return {}
+        return self._write(NodesDatabase._insert_sites_and_fetch_ids, sites)
 
-        with self.conn:
-            cur = self.conn.cursor()
+    def _insert_sites_and_fetch_ids(self, sites):
+        cur = self.conn.cursor()
 
-            self._populate_tmp(cur, "name", {s for s in sites})
+        self._populate_tmp(cur, "name", {s for s in sites})
 
-            cur.execute("""
-                        INSERT INTO sites (name)
-                        SELECT t.name
-                        FROM tmp_node_names t
-                                 LEFT JOIN sites s ON s.name = t.name
-                        WHERE s.name IS NULL
-                        """)
+        cur.execute("""
+                    INSERT INTO sites (name)
+                    SELECT t.name
+                    FROM tmp_node_names t
+                             LEFT JOIN sites s ON s.name = t.name
+                    WHERE s.name IS NULL
+                    """)
 
-            rows = cur.execute("""
-                               SELECT s.name, s.id
-                               FROM sites s
-                                        JOIN tmp_names t ON t.name = s.name
-                               """).fetchall()
+        rows = cur.execute("""
+                           SELECT s.name, s.id
+                           FROM sites s
+                                    JOIN tmp_names t ON t.name = s.name
+                           """).fetchall()
 
         return dict(rows)
 
     def insert_sites(self, sites):
-        conn = self.conn
-        cur = conn.cursor()
+        self._write(NodesDatabase._insert_sites, sites)
+
+    def _insert_sites(self, sites):
+        cur = self.conn.cursor()
 
         # ---- Insert sites ----
         site_rows = [
@@ -489,7 +976,219 @@ class NodesDatabase:
             pin_rows
         )
 
-        conn.commit()
+    def get_metadata(self, key, default = None):
+        cur = self.conn.cursor()
+        cur.execute("SELECT value FROM metadata WHERE key = ?", (key,))
+        row = cur.fetchone()
+        return default if row is None else row[0]
+
+    def set_metadata(self, key, value):
+        self._write(NodesDatabase._set_metadata, key, value)
+
+    def _set_metadata(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def get_completed_prefetch_shards(self, shard_size):
+        cur = self.conn.cursor()
+        cur.execute("SELECT shard FROM prefetch_shards WHERE shard_size = ?", (shard_size,))
+        return {shard for (shard,) in cur.fetchall()}
+
+    def mark_prefetch_shard_complete(self, shard_size, shard, node_count, seconds):
+        self._write(NodesDatabase._mark_prefetch_shard_complete, shard_size, shard, node_count, seconds)
+
+    def _mark_prefetch_shard_complete(self, shard_size, shard, node_count, seconds):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO prefetch_shards (shard_size, shard, node_count, seconds) VALUES (?, ?, ?, ?)",
+            (shard_size, shard, node_count, seconds)
+        )
+
+    def has_node_list(self):
+        return self.get_metadata("node_list_complete") == "1"
+
+    def insert_node_list(self, names):
+        """Store the full node list of the device, replacing any earlier one"""
+        self._write(NodesDatabase._insert_node_list, names)
+
+    def _insert_node_list(self, names):
+        name_to_id = self.get_node_ids(names)
+
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM node_list")
+        cur.executemany(
+            "INSERT INTO node_list (rowid, name) VALUES (?, ?)",
+            ((node_id, name) for name, node_id in name_to_id.items())
+        )
+        self._set_metadata("node_list_hash", _hash_node_list(name_to_id))
+        self._set_metadata("node_list_complete", 1)
+
+    def get_node_list_hash(self):
+        """Hash identifying the stored node list, for keying data derived from it"""
+        value = self.get_metadata("node_list_hash")
+        if value is None:
+            value = _hash_node_list(self.get_node_list())
+            self.set_metadata("node_list_hash", value)
+        return value
+
+    def get_node_list(self):
+        return {name for (name,) in self.conn.execute("SELECT name FROM node_list")}
+
+    def filter_node_list(self, names):
+        """The subset of names that are in the full node list"""
+        name_to_id = self.lookup_node_ids(names, include_aliases = False)
+
+        cur = self.conn.cursor()
+        self._populate_tmp(cur, "id", name_to_id.values())
+        cur.execute("SELECT rowid FROM node_list WHERE rowid IN (SELECT id from tmp_node_ids)")
+        listed = {node_id for (node_id,) in cur.fetchall()}
+
+        return {name for name, node_id in name_to_id.items() if node_id in listed}
+
+    def search_node_list(self, regexes = (), globs = ()):
+        """
+        Names in the full node list matching any of regexes (as re.search) or globs (sqlite GLOB, e.g. R4C*_JCLK0).
+
+        Globs are answered by the trigram index directly. Each regex is narrowed down to candidates by the index using
+        the literal runs it requires; the candidates are then checked against all regexes together in one pass.
+        """
+        cur = self.conn.cursor()
+        t = time.time()
+
+        result = set()
+        for g in globs:
+            result.update(name for (name,) in cur.execute("SELECT name FROM node_list WHERE name GLOB ?", (g,)))
+
+        regexes = list(regexes)
+        if len(regexes) > 0:
+            literal_sets = [required_literals(r) for r in regexes]
+            if any(len(literals) == 0 for literals in literal_sets):
+                candidates = [name for (name,) in cur.execute("SELECT name FROM node_list")]
+            else:
+                # One query per regex; sqlite doesn't use the index for ORed GLOBs
+                candidates = set()
+                for literals in literal_sets:
+                    where = " AND ".join(["name GLOB ?"] * len(literals))
+                    cur.execute(f"SELECT name FROM node_list WHERE {where}", [f"*{_glob_escape(l)}*" for l in literals])
+                    candidates.update(name for (name,) in cur.fetchall())
+
+            matches = _compile_any(regexes)
+            result.update(name for name in candidates if matches(name))
+
+        logging.debug(f"Found {len(result)} nodes for {regexes} {list(globs)} in {time.time() - t} sec")
+        return result
+
+    def is_fully_prefetched(self):
+        """True once tools/prefetch_nodes.py has queried every node of the device"""
+        return self.get_metadata("prefetch_complete") == "1"
+
+    def _bump_generation(self, cur):
+        # Lets routing_graph.py notice pips were added without scanning the pips table
+        cur.execute("""
+            INSERT INTO metadata (key, value) VALUES ('generation', '1')
+            ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        """)
+
+    def get_routing_graph_stamp(self):
+        """Identifies the database contents a routing graph export was made from"""
+        cur = self.conn.cursor()
+        user_version = cur.execute("PRAGMA user_version").fetchone()[0]
+        node_count = cur.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+        return [user_version, node_count, int(self.get_metadata("generation", 0))]
+
+    def export_routing_graph(self, directory):
+        """
+        Export the pip graph as compressed sparse row arrays into directory, one .npy file per array plus meta.json.
+
+        Nodes are indexed by their integer id. Edge i is the pip edge_from[i] -> edge_to[i]; downhill_ptr[n] to
+        downhill_ptr[n+1] indexes the downhill_nodes / downhill_edges of node n, and likewise for uphill. See
+        routing_graph.RoutingGraph for the reader.
+        """
+        cur = self.conn.cursor()
+        cur.arraysize = 1 << 20
+
+        # Taken first so that a concurrent insert only makes the export look stale, never current
+        stamp = self.get_routing_graph_stamp()
+
+        t = time.time()
+        node_count = (cur.execute("SELECT MAX(id) FROM nodes").fetchone()[0] or 0) + 1
+
+        node_bits = np.zeros(node_count, dtype=np.uint8)
+        cur.execute("SELECT id FROM nodes WHERE has_full_data = 1")
+        node_bits[np.array([i for (i,) in cur.fetchall()], dtype=np.int64)] = 1
+
+        # -1 for nodes without an R<row>C<col>_ prefix
+        node_row = np.full(node_count, -1, dtype=np.int16)
+        node_col = np.full(node_count, -1, dtype=np.int16)
+        cur.execute("SELECT id, row, col FROM nodes")
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            ids, r, c = (np.array(column, dtype=np.int64) for column in zip(*rows))
+            node_row[ids] = r
+            node_col[ids] = c
+
+        buffertypes = {}
+        columns = [[] for _ in range(5)]
+        cur.execute("""
+            SELECT from_id, to_id, flags, bidir | (jumpwire << 1), buffertype
+            FROM pips
+            WHERE from_id IS NOT NULL AND to_id IS NOT NULL
+        """)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            frm, to, flags, bits, bt = zip(*rows)
+            columns[0].append(np.array(frm, dtype=np.int32))
+            columns[1].append(np.array(to, dtype=np.int32))
+            columns[2].append(np.array(flags, dtype=np.int32))
+            columns[3].append(np.array(bits, dtype=np.uint8))
+            columns[4].append(np.fromiter((buffertypes.setdefault(b, len(buffertypes)) for b in bt),
+                                          dtype=np.uint16, count=len(bt)))
+
+        dtypes = [np.int32, np.int32, np.int32, np.uint8, np.uint16]
+        edge_from, edge_to, edge_flags, edge_bits, edge_buffertype = [
+            np.concatenate(c) if len(c) else np.zeros(0, dtype=dt) for c, dt in zip(columns, dtypes)
+        ]
+
+        def csr(keys, other):
+            order = np.argsort(keys, kind="stable").astype(np.int32)
+            ptr = np.zeros(node_count + 1, dtype=np.int64)
+            np.cumsum(np.bincount(keys, minlength=node_count), out=ptr[1:])
+            return ptr, other[order], order
+
+        arrays = {
+            "node_bits": node_bits,
+            "node_row": node_row,
+            "node_col": node_col,
+            "edge_from": edge_from,
+            "edge_to": edge_to,
+            "edge_flags": edge_flags,
+            "edge_bits": edge_bits,
+            "edge_buffertype": edge_buffertype,
+        }
+        arrays["downhill_ptr"], arrays["downhill_nodes"], arrays["downhill_edges"] = csr(edge_from, edge_to)
+        arrays["uphill_ptr"], arrays["uphill_nodes"], arrays["uphill_edges"] = csr(edge_to, edge_from)
+
+        os.makedirs(directory, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(f"{directory}/{name}.npy", array)
+
+        meta = {
+            "format": ROUTING_GRAPH_FORMAT,
+            "stamp": stamp,
+            "node_count": node_count,
+            "edge_count": len(edge_from),
+            "jumpwire_count": int(np.count_nonzero(edge_bits & 2)),
+            "buffertypes": sorted(buffertypes, key=buffertypes.get),
+        }
+        # Written last; its presence marks the export as complete
+        with open(f"{directory}/meta.json", "w") as f:
+            json.dump(meta, f)
+
+        logging.info(f"Exported routing graph for {self.device} with {node_count} nodes and {len(edge_from)} pips "
+                     f"in {time.time() - t:.1f} sec")
+        return meta
 
     def get_sites(self):
         conn = self.conn
@@ -521,16 +1220,27 @@ class NodesDatabase:
         # ---- Fetch pins ----
         cur.execute(
             f"""
-            SELECT sp.site_id, sp.pin_name, n.name
+            SELECT sp.site_id, sp.pin_name, sp.node_id
             FROM site_pins sp
-            JOIN nodes n ON n.id = sp.node_id
             """,
         )
+        pin_rows = cur.fetchall()
+        node_names = self.get_node_names({node_id for _, _, node_id in pin_rows})
 
-        for sid, pin_name, node_name in cur.fetchall():
+        for sid, pin_name, node_id in pin_rows:
             result[site_id[sid]]["pins"].append({
                 "pin_name": pin_name,
-                "pin_node": node_name
+                "pin_node": node_names[node_id]
             })
 
         return result
+
+def _reset_after_fork():
+    # Writer threads and sqlite connections don't survive a fork; the child opens its own on first use
+    global _thread_local
+    NodesDatabase._lock = RLock()
+    NodesDatabase._writers = {}
+    _thread_local = threading.local()
+
+atexit.register(NodesDatabase.close_all)
+os.register_at_fork(after_in_child=_reset_after_fork)
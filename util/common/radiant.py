@@ -70,11 +70,14 @@ def run_bash_script(env, *args, cwd = None, stdout = subprocess.PIPE, stderr = s
     return proc
 
 
-def run(device, source, struct_ver=True, raw_bit=False, pdcfile=None, rbk_mode=False):
+def run(device, source, struct_ver=True, raw_bit=False, pdcfile=None, rbk_mode=False, bitstream_cache=True):
     """
-    Run radiant.sh with a given device name and source Verilog file
+    Run radiant.sh with a given device name and source Verilog file. With bitstream_cache False, radiant.sh neither
+    looks the design up in the bitstream cache nor commits the result; the caller does both.
     """
     env = os.environ.copy()
+    if not bitstream_cache:
+        env["NO_BITSTREAM_CACHE"] = "1"
     if struct_ver:
         env["STRUCT_VER"] = "1"
     if raw_bit:
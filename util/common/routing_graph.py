@@ -0,0 +1,164 @@
+"""
+Memory mapped routing graph
+
+NodesDatabase.export_routing_graph writes the pip graph of a device as compressed sparse row arrays into
+`.cache/<radiant version>/<device>-routing/`. RoutingGraph maps those files read only, so neighbour lookups are array
+slices that are shared between threads and between fuzzer processes. The export is rebuilt when the sqlite file it
+was made from has changed.
+
+Only nodes flagged with FULL_DATA have their complete pip lists in the graph; callers go to lapie for the rest.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import database
+from nodes_database import NodesDatabase, ROUTING_GRAPH_FORMAT
+
+# node_bits
+FULL_DATA = 1
+
+# edge_bits
+BIDIR = 1
+JUMPWIRE = 2
+
+class RoutingGraph:
+    _lock = threading.RLock()
+    _graphs = {}
+
+    # How often get() looks at the sqlite file for changes
+    check_interval = 5 * 60
+
+    array_names = [
+        "node_bits", "node_row", "node_col",
+        "edge_from", "edge_to", "edge_flags", "edge_bits", "edge_buffertype",
+        "downhill_ptr", "downhill_nodes", "downhill_edges",
+        "uphill_ptr", "uphill_nodes", "uphill_edges",
+    ]
+
+    @staticmethod
+    def get(device, refresh = False):
+        with RoutingGraph._lock:
+            graph = RoutingGraph._graphs.get(device)
+            now = time.time()
+            if graph is not None and not refresh and now - graph.checked < RoutingGraph.check_interval:
+                return graph
+
+            db = NodesDatabase.get(device)
+            stamp = db.get_routing_graph_stamp()
+            if graph is None or graph.stamp != stamp:
+                graph = RoutingGraph._open_or_export(device, db, stamp)
+                RoutingGraph._graphs[device] = graph
+
+            graph.checked = now
+            return graph
+
+    @staticmethod
+    def _open_or_export(device, db, stamp):
+        directory = f"{database.get_cache_dir()}/{device}-routing"
+
+        meta = RoutingGraph._read_meta(directory)
+        if meta is not None and meta["stamp"] == stamp and meta.get("format") == ROUTING_GRAPH_FORMAT:
+            return RoutingGraph(device, directory, meta)
+
+        # Export next to the live directory and swap it in, so processes that have the old files mapped keep working
+        tmp_dir = tempfile.mkdtemp(dir=database.get_cache_dir(), prefix=f"{device}-routing.")
+        meta = db.export_routing_graph(tmp_dir)
+
+        return RoutingGraph(device, database.replace_cache_dir(tmp_dir, directory), meta)
+
+    @staticmethod
+    def _read_meta(directory):
+        try:
+            with open(f"{directory}/meta.json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __init__(self, device, directory, meta):
+        self.device = device
+        self.directory = directory
+        self.stamp = meta["stamp"]
+        self.node_count = meta["node_count"]
+        self.edge_count = meta["edge_count"]
+        self.jumpwire_count = meta["jumpwire_count"]
+        self.buffertypes = meta["buffertypes"]
+        self.checked = 0
+
+        for name in RoutingGraph.array_names:
+            setattr(self, name, np.load(f"{directory}/{name}.npy", mmap_mode="r"))
+
+    def has_full_data(self, node_id):
+        return node_id < self.node_count and bool(self.node_bits[node_id] & FULL_DATA)
+
+    def downhill(self, node_id):
+        """Ids of the nodes driven by node_id"""
+        return self.downhill_nodes[self.downhill_ptr[node_id]:self.downhill_ptr[node_id + 1]]
+
+    def uphill(self, node_id):
+        """Ids of the nodes driving node_id"""
+        return self.uphill_nodes[self.uphill_ptr[node_id]:self.uphill_ptr[node_id + 1]]
+
+    def downhill_edge_ids(self, node_id):
+        return self.downhill_edges[self.downhill_ptr[node_id]:self.downhill_ptr[node_id + 1]]
+
+    def uphill_edge_ids(self, node_id):
+        return self.uphill_edges[self.uphill_ptr[node_id]:self.uphill_ptr[node_id + 1]]
+
+    def edges_for_nodes(self, node_ids, mask = 0):
+        """Sorted unique ids of the edges touching any of node_ids, optionally only those with all edge_bits in mask"""
+        node_ids = [i for i in node_ids if i < self.node_count]
+        edges = [self.downhill_edge_ids(i) for i in node_ids] + [self.uphill_edge_ids(i) for i in node_ids]
+        if len(edges) == 0:
+            return np.zeros(0, dtype=np.int32)
+
+        edges = np.unique(np.concatenate(edges))
+        if mask:
+            edges = edges[(self.edge_bits[edges] & mask) == mask]
+        return edges
+
+    def ids_for_names(self, names):
+        return NodesDatabase.get(self.device).lookup_node_ids(names)
+
+    def names_for_ids(self, ids):
+        return NodesDatabase.get(self.device).get_node_names([int(i) for i in ids])
+
+    def get_node_infos(self, names):
+        """
+        Build NodeInfos for names from the graph. Returns the NodeInfos and the list of names the graph has no full
+        data for.
+        """
+        from lapie import NodeInfoBatch
+
+        name_to_id = self.ids_for_names(names)
+
+        node_ids = set()
+        missing = []
+        for n in names:
+            node_id = name_to_id.get(n)
+            if node_id is None or not self.has_full_data(node_id):
+                missing.append(n)
+            else:
+                node_ids.add(node_id)
+
+        edges = self.edges_for_nodes(sorted(node_ids))
+        edge_from = self.edge_from[edges]
+        edge_to = self.edge_to[edges]
+
+        id_to_name = self.names_for_ids(node_ids | set(edge_from.tolist()) | set(edge_to.tolist()))
+
+        node_ids = sorted(node_ids)
+        batch = NodeInfoBatch(id_to_name, node_ids, [[id_to_name[i]] for i in node_ids],
+                              edge_from, edge_to, (self.edge_bits[edges] & BIDIR) != 0, self.edge_flags[edges],
+                              self.edge_buffertype[edges], self.buffertypes)
+
+        return list(batch), missing
+
+def _reset_after_fork():
+    RoutingGraph._lock = threading.RLock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
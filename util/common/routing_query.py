@@ -0,0 +1,157 @@
+"""
+Queries over the memory mapped routing graph
+
+Paths, fanin/fanout cones and reachability are breadth first searches over the CSR arrays of
+routing_graph.RoutingGraph, expanding a whole frontier per numpy operation. They never query the vendor tools; the
+answers are only as complete as the node database, so run tools/prefetch_nodes.py for the device first. Nodes
+without full data contribute the pips other nodes have to them, but none of their own.
+
+All functions take and return node names.
+"""
+import numpy as np
+
+from routing_graph import RoutingGraph
+
+def _neighbours(ptr, adjacent, frontier):
+    """All (neighbour, frontier node) pairs of the frontier in one CSR adjacency"""
+    starts = ptr[frontier]
+    counts = ptr[frontier + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Index of every neighbour slot: each frontier node's start, plus 0..count-1
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return adjacent[np.repeat(starts, counts) + offsets].astype(np.int64), np.repeat(frontier, counts)
+
+def _adjacency(graph, direction):
+    if direction == "downhill":
+        return graph.downhill_ptr, graph.downhill_nodes
+    elif direction == "uphill":
+        return graph.uphill_ptr, graph.uphill_nodes
+    raise ValueError(f"Unknown direction {direction}")
+
+def _ids(graph, names):
+    name_to_id = graph.ids_for_names(list(names))
+    return np.array(sorted({i for i in name_to_id.values() if i < graph.node_count}), dtype=np.int64)
+
+def _search(graph, sources, direction, max_depth = None, limit = None, targets = None):
+    """
+    BFS from sources. Returns the depth of every visited node (-1 if unvisited). Stops early once all targets are
+    visited or more than limit nodes have been found.
+    """
+    ptr, adjacent = _adjacency(graph, direction)
+    depth = np.full(graph.node_count, -1, dtype=np.int32)
+    depth[sources] = 0
+
+    frontier = sources
+    level = 0
+    visited = len(sources)
+    while len(frontier) and (max_depth is None or level < max_depth):
+        if targets is not None and np.all(depth[targets] >= 0):
+            break
+        if limit is not None and visited >= limit:
+            break
+
+        level = level + 1
+        neighbours, _ = _neighbours(ptr, adjacent, frontier)
+        frontier = np.unique(neighbours[depth[neighbours] < 0])
+        depth[frontier] = level
+        visited = visited + len(frontier)
+
+    return depth
+
+def _cone(device, nodes, direction, max_depth, limit):
+    graph = RoutingGraph.get(device)
+    depth = _search(graph, _ids(graph, nodes), direction, max_depth=max_depth, limit=limit)
+
+    found = np.flatnonzero(depth >= 0)
+    id_to_name = graph.names_for_ids(found.tolist())
+    return {id_to_name[i]: int(depth[i]) for i in found.tolist()}
+
+def fanout_cone(device, nodes, max_depth = None, limit = None):
+    """{name: hops} for every node reachable downhill from nodes within max_depth pips"""
+    return _cone(device, nodes, "downhill", max_depth, limit)
+
+def fanin_cone(device, nodes, max_depth = None, limit = None):
+    """{name: hops} for every node that can reach one of nodes within max_depth pips"""
+    return _cone(device, nodes, "uphill", max_depth, limit)
+
+def reachable(device, sources, sinks, max_depth = None):
+    """{sink: hops} for the sinks that can be reached downhill from any of sources"""
+    graph = RoutingGraph.get(device)
+    sink_ids = graph.ids_for_names(list(sinks))
+    targets = np.array(sorted(i for i in sink_ids.values() if i < graph.node_count), dtype=np.int64)
+
+    depth = _search(graph, _ids(graph, sources), "downhill", max_depth=max_depth, targets=targets)
+    return {name: int(depth[i]) for name, i in sink_ids.items() if i < graph.node_count and depth[i] >= 0}
+
+def shortest_path(device, frm, to, max_depth = None):
+    """
+    Fewest-pip path from frm to to, as the list of node names [frm, ..., to], or None if there is none within
+    max_depth pips. Searches downhill from frm and uphill from to at the same time, always growing the smaller
+    frontier.
+    """
+    graph = RoutingGraph.get(device)
+    name_to_id = graph.ids_for_names([frm, to])
+    if frm not in name_to_id or to not in name_to_id:
+        return None
+    src, dst = name_to_id[frm], name_to_id[to]
+    if max(src, dst) >= graph.node_count:
+        return None
+    if src == dst:
+        return [frm]
+
+    sides = []
+    for root, direction in [(src, "downhill"), (dst, "uphill")]:
+        parent = np.full(graph.node_count, -1, dtype=np.int64)
+        depth = np.full(graph.node_count, -1, dtype=np.int32)
+        parent[root] = root
+        depth[root] = 0
+        sides.append({"adjacency": _adjacency(graph, direction), "parent": parent, "depth": depth,
+                      "frontier": np.array([root], dtype=np.int64), "level": 0})
+
+    meet = None
+    while meet is None:
+        if len(sides[0]["frontier"]) == 0 or len(sides[1]["frontier"]) == 0:
+            return None
+        if max_depth is not None and sides[0]["level"] + sides[1]["level"] >= max_depth:
+            return None
+
+        side, other = sides if len(sides[0]["frontier"]) <= len(sides[1]["frontier"]) else sides[::-1]
+        neighbours, parents = _neighbours(*side["adjacency"], side["frontier"])
+        new = side["depth"][neighbours] < 0
+        neighbours, first = np.unique(neighbours[new], return_index=True)
+
+        side["level"] = side["level"] + 1
+        side["parent"][neighbours] = parents[new][first]
+        side["depth"][neighbours] = side["level"]
+        side["frontier"] = neighbours
+
+        # Of the nodes the other side has seen, take the one closest to its root
+        met = neighbours[other["depth"][neighbours] >= 0]
+        if len(met):
+            meet = int(met[np.argmin(other["depth"][met])])
+
+    def walk(parent, node):
+        nodes = [node]
+        while parent[node] != node:
+            node = int(parent[node])
+            nodes.append(node)
+        return nodes
+
+    path = walk(sides[0]["parent"], meet)[::-1] + walk(sides[1]["parent"], meet)[1:]
+    id_to_name = graph.names_for_ids(path)
+    return [id_to_name[i] for i in path]
+
+def pips_in_window(device, r0, c0, r1, c1):
+    """(from, to) names of every pip with both ends in rows r0..r1 and columns c0..c1, inclusive"""
+    graph = RoutingGraph.get(device)
+
+    inside = (graph.node_row >= r0) & (graph.node_row <= r1) & (graph.node_col >= c0) & (graph.node_col <= c1)
+    edges = np.flatnonzero(inside[graph.edge_from] & inside[graph.edge_to])
+    edge_from = graph.edge_from[edges]
+    edge_to = graph.edge_to[edges]
+
+    id_to_name = graph.names_for_ids(np.unique(np.concatenate([edge_from, edge_to])).tolist())
+    return [(id_to_name[frm], id_to_name[to]) for frm, to in zip(edge_from.tolist(), edge_to.tolist())]
@@ -0,0 +1,240 @@
+"""
+Task scheduler for fuzzer runs
+
+Fuzzers mix Radiant builds, lapie queries, CPU bound solves and database writes. In a single thread pool a burst of
+builds takes every thread, and the solves that consume their bitstreams -- and free the memory they hold -- queue
+behind them. Scheduler is a concurrent.futures.Executor that runs every task in a resource class with its own
+concurrency limit. Builds and solves also share a pool of CPU slots (OXIDE_CPU_JOBS, by default the core count);
+whenever one frees up the queued task with the best priority takes it, so solves in flight finish before new builds
+start.
+
+Functions are put in a class with the task_class decorator; tasks of other functions run as "default". The default
+limits are in RESOURCE_CLASSES -- one db writer, solves up to the core count, and OXIDE_JOBS for the rest -- and can be
+set per class with OXIDE_<CLASS>_JOBS, e.g. OXIDE_BUILD_JOBS=8. Worker threads are shared by all classes and started
+only when queued work could run and no thread is free, so there are never more than the peak number of tasks that
+actually ran at once, rather than one per slot of every class. The scheduler also records which futures wait on which,
+so the status panel can show what is blocked.
+"""
+import heapq
+import itertools
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# name: (priority, default limit, takes a CPU slot). Lower priorities start first.
+RESOURCE_CLASSES = {
+    "db": (0, lambda jobs: 1, False),
+    "solve": (1, lambda jobs: max(jobs, os.cpu_count() or 1), True),
+    "lapie": (2, lambda jobs: jobs, False),
+    "default": (2, lambda jobs: jobs, False),
+    "build": (3, lambda jobs: jobs, True),
+}
+
+def task_class(resource, priority = None):
+    """Decorator running fn in the given resource class, optionally with a priority other than the class's own"""
+    assert resource in RESOURCE_CLASSES, f"Unknown resource class {resource}"
+    def decorator(fn):
+        fn.resource_class = resource
+        fn.task_priority = priority
+        return fn
+    return decorator
+
+def resource_of(fn, default = "default"):
+    return getattr(fn, "resource_class", default)
+
+class Task:
+    __slots__ = ["id", "name", "resource", "priority", "state", "after", "future", "fn", "args", "kwargs"]
+
+    def __init__(self, id, name, resource, priority, after, future, fn = None, args = (), kwargs = None):
+        self.id = id
+        self.name = name
+        self.resource = resource
+        self.priority = priority
+        # waiting (on the tasks in after), queued, running, or a tracked future that completes elsewhere
+        self.state = "waiting" if len(after) else "queued"
+        self.after = after
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+
+# A ThreadPoolExecutor only so that asyncio accepts it as the default executor; none of the base class is used
+class Scheduler(ThreadPoolExecutor):
+    def __init__(self, jobs, limits = None, cpu_slots = None):
+        self.limits = {}
+        for name, (_, default_limit, _) in RESOURCE_CLASSES.items():
+            self.limits[name] = int(os.environ.get(f"OXIDE_{name.upper()}_JOBS", default_limit(jobs)))
+        self.limits.update(limits or {})
+        if cpu_slots is None:
+            cpu_slots = int(os.environ.get("OXIDE_CPU_JOBS", max(jobs, os.cpu_count() or 1)))
+        self.cpu_slots = cpu_slots
+        self._cpu_running = 0
+
+        self._cond = threading.Condition()
+        self._ready = {name: [] for name in self.limits}
+        self._running = {name: 0 for name in self.limits}
+        self._finished = {name: 0 for name in self.limits}
+        # Unfinished tasks, by id; finished ones are dropped so long runs don't accumulate them
+        self._tasks = {}
+        self._ids = itertools.count()
+        self._shutdown = False
+
+        # Started on demand by _enqueue
+        self._threads = []
+
+    def submit(self, fn, /, *args, **kwargs):
+        return self.submit_task(fn, args, kwargs)
+
+    def submit_task(self, fn, args = (), kwargs = None, resource = None, priority = None, name = None, after = ()):
+        """
+        Run fn(*args, **kwargs) in the given resource class (by default the one fn was decorated with). If after
+        lists futures, the task only starts once they are all done, and fails with the first of their exceptions.
+        """
+        resource = resource or resource_of(fn)
+        assert resource in self.limits, f"Unknown resource class {resource}"
+        if priority is None:
+            priority = getattr(fn, "task_priority", None)
+        if priority is None:
+            priority = RESOURCE_CLASSES[resource][0]
+
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new tasks after shutdown")
+            task = Task(next(self._ids), name or getattr(fn, "__name__", "task"), resource, priority,
+                        list(after), future, fn, args, kwargs)
+            future.task_id = task.id
+            self._tasks[task.id] = task
+            if task.state == "queued":
+                self._enqueue(task)
+
+        if task.state == "waiting":
+            self._wait_for(task)
+        return future
+
+    def register_future(self, future, name = None, after = ()):
+        """Record a future completed elsewhere (gathers, chained continuations) as a node of the task graph"""
+        with self._cond:
+            task = Task(next(self._ids), name or getattr(future, "name", None) or "future", None, None,
+                        [getattr(f, "task_id", None) for f in after], future)
+            task.state = "waiting"
+            self._tasks[task.id] = task
+        future.task_id = task.id
+        future.add_done_callback(lambda f, task_id=task.id: self._forget(task_id))
+
+    def _wait_for(self, task):
+        remaining = [len(task.after)]
+        def done(f):
+            with self._cond:
+                if task.state != "waiting":
+                    return
+                if f.cancelled() or f.exception() is not None:
+                    task.state = "failed"
+                    del self._tasks[task.id]
+                    failed = True
+                else:
+                    remaining[0] -= 1
+                    failed = False
+                    if remaining[0] == 0:
+                        self._enqueue(task)
+            if failed:
+                task.future.set_exception(f.exception() if not f.cancelled() else RuntimeError("dependency cancelled"))
+
+        after = task.after
+        task.after = [getattr(f, "task_id", None) for f in after]
+        for f in after:
+            f.add_done_callback(done)
+
+    def _enqueue(self, task):
+        task.state = "queued"
+        heapq.heappush(self._ready[task.resource], (task.priority, task.id, task))
+        self._cond.notify()
+        while len(self._threads) < self._wanted_threads():
+            t = threading.Thread(target=self._worker, daemon=True, name=f"scheduler-{len(self._threads)}")
+            self._threads.append(t)
+            t.start()
+
+    def _wanted_threads(self):
+        """How many tasks could run at once given what is running and queued, i.e. how many threads are useful"""
+        wanted = {False: 0, True: 0}
+        for name, limit in self.limits.items():
+            wanted[RESOURCE_CLASSES[name][2]] += min(self._running[name] + len(self._ready[name]), limit)
+        return wanted[False] + min(wanted[True], self.cpu_slots)
+
+    def _forget(self, task_id):
+        with self._cond:
+            self._tasks.pop(task_id, None)
+
+    def _next_task(self):
+        """The best queued task of the classes with a free slot"""
+        best = None
+        for name, ready in self._ready.items():
+            if len(ready) and self._running[name] < self.limits[name] and \
+                    (not RESOURCE_CLASSES[name][2] or self._cpu_running < self.cpu_slots):
+                if best is None or ready[0][:2] < self._ready[best][0][:2]:
+                    best = name
+        if best is None:
+            return None
+        return heapq.heappop(self._ready[best])[2]
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while (task := self._next_task()) is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                task.state = "running"
+                self._running[task.resource] += 1
+                self._cpu_running += RESOURCE_CLASSES[task.resource][2]
+
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    try:
+                        task.future.set_result(task.fn(*task.args, **task.kwargs))
+                    except BaseException as e:
+                        task.future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running[task.resource] -= 1
+                    self._cpu_running -= RESOURCE_CLASSES[task.resource][2]
+                    self._finished[task.resource] += 1
+                    self._tasks.pop(task.id, None)
+                    task.fn, task.args, task.kwargs = None, (), {}
+                    self._cond.notify_all()
+
+    def shutdown(self, wait = True, *, cancel_futures = False):
+        with self._cond:
+            self._shutdown = True
+            if cancel_futures:
+                for name, ready in self._ready.items():
+                    for _, _, task in ready:
+                        task.future.cancel()
+                        self._tasks.pop(task.id, None)
+                    ready.clear()
+            self._cond.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for t in threads:
+                if t is not threading.current_thread():
+                    t.join()
+
+    def status(self):
+        """One line summary: running/limit (+queued) per class, and how many tasks wait on others"""
+        with self._cond:
+            classes = " ".join(f"{name} {self._running[name]}/{self.limits[name]} (+{len(self._ready[name])})"
+                               for name in self.limits if self._running[name] or len(self._ready[name]) or self._finished[name])
+            waiting = sum(1 for t in self._tasks.values() if t.state == "waiting")
+            return f"{classes} cpu {self._cpu_running}/{self.cpu_slots} waiting {waiting}"
+
+    def dag(self):
+        """The unfinished tasks as {id: (name, resource, state, [ids of tasks it waits on])}"""
+        with self._cond:
+            return {t.id: (t.name, t.resource, t.state, [i for i in t.after if i in self._tasks])
+                    for t in self._tasks.values()}
+
+    def blocked(self, limit = 5):
+        """Names of the waiting tasks with the most unfinished dependencies"""
+        dag = self.dag()
+        waiting = sorted((len(after), name) for name, _, state, after in dag.values() if state == "waiting" and len(after))
+        return [f"{name} <- {n}" for n, name in waiting[::-1][:limit]]
@@ -0,0 +1,123 @@
+"""
+Thread safe memoisation and counters
+
+functools.cache keeps its dictionary consistent across threads, but threads that miss on the same key at the same
+time all run the function -- for the per-device loaders (tilegrids, node lists, baseline bitstreams) that means
+duplicated tool runs. Unlocked module level state and `x = x + 1` counters race outright, and on a free-threaded
+CPython build nothing serialises them. These are the replacements used by the util modules.
+"""
+import functools
+import os
+import threading
+
+class _Call:
+    """One in-flight computation of a cache key, which threads asking for the same key wait on"""
+    __slots__ = ["owner", "done", "value", "exception"]
+
+    def __init__(self):
+        self.owner = threading.get_ident()
+        self.done = threading.Event()
+        self.value = None
+        self.exception = None
+
+def cache(fn):
+    """
+    Drop-in for functools.cache that runs fn at most once per key. Threads asking for a key that is being computed
+    wait for that result, or get the exception it raised; other keys are computed concurrently. Exceptions are not
+    cached, so the next call after a failure runs fn again. Forked children start with the results computed so far
+    and fresh locks.
+    """
+    lock = threading.Lock()
+    results = {}
+    in_flight = {}
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+        try:
+            return results[key]
+        except KeyError:
+            pass
+
+        with lock:
+            if key in results:
+                return results[key]
+            call = in_flight.get(key)
+            if call is None:
+                call = in_flight[key] = _Call()
+            elif call.owner == threading.get_ident():
+                # fn recursed into itself with the same key; waiting would deadlock
+                call = None
+
+        if call is None:
+            return fn(*args, **kwargs)
+
+        if call.owner != threading.get_ident():
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.value
+
+        try:
+            call.value = fn(*args, **kwargs)
+            with lock:
+                results[key] = call.value
+            return call.value
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with lock:
+                in_flight.pop(key, None)
+            call.done.set()
+
+    def cache_clear():
+        with lock:
+            results.clear()
+
+    def reset_after_fork():
+        # A thread that held the lock or was computing a key at fork time doesn't exist in the child
+        nonlocal lock, in_flight
+        lock = threading.Lock()
+        in_flight = {}
+
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+    def cache_info():
+        with lock:
+            return {"currsize": len(results), "in_flight": len(in_flight)}
+
+    wrapper.cache_clear = cache_clear
+    wrapper.cache_info = cache_info
+    return wrapper
+
+class Counter:
+    """An integer counter that can be incremented from any thread. Formats like an int."""
+    def __init__(self, value = 0):
+        self._value = value
+        self._lock = threading.Lock()
+
+    def increment(self, n = 1):
+        """Add n and return the new value"""
+        with self._lock:
+            self._value = self._value + n
+            return self._value
+
+    @property
+    def value(self):
+        return self._value
+
+    def __int__(self):
+        return self._value
+
+    def __index__(self):
+        return self._value
+
+    def __format__(self, spec):
+        return format(self._value, spec)
+
+    def __str__(self):
+        return str(self._value)
+
+    def __repr__(self):
+        return f"Counter({self._value})"
@@ -1,21 +1,36 @@
 import asyncio
+import bisect
+import hashlib
 import itertools
+import json
 import logging
+import os
+import pickle
 import random
 import re
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
 import traceback
 from collections.abc import Iterable
-from functools import cache
+from functools import lru_cache
 
+import numpy as np
 from six import reraise
 
 import database
 from collections import defaultdict
 import lapie
+import routing_graph
+import routing_query
+import scheduler
+from nodes_database import NodesDatabase
 
 import cachecontrol
 from radiant import validate_wire_list
+from threadsafe import cache
 
 pos_re = re.compile(r'R(\d+)C(\d+)')
 
@@ -34,6 +49,80 @@ def type_from_fullname(tile):
     """
     return tile.split(":")[1]
 
+class TileGrid:
+    """
+    Indexes over the tilegrid of a device, built once per device. Tile records are the dicts from
+    database.get_tilegrid, shared rather than copied; all lookups keep the tilegrid's order.
+    """
+    _lock = threading.Lock()
+    _grids = {}
+
+    @staticmethod
+    def get(device):
+        with TileGrid._lock:
+            if device not in TileGrid._grids:
+                TileGrid._grids[device] = TileGrid(device)
+            return TileGrid._grids[device]
+
+    def __init__(self, device):
+        self.device = device
+        self.tiles = {sys.intern(k): v for k, v in database.get_tilegrid(device)['tiles'].items()}
+
+        self.by_rc = defaultdict(dict)
+        self.by_tiletype = defaultdict(dict)
+        self.by_record_tiletype = defaultdict(dict)
+        self.by_row = defaultdict(dict)
+        self.by_col = defaultdict(dict)
+        self.position = {}
+        for i, (k, v) in enumerate(self.tiles.items()):
+            self.position[k] = i
+            self.by_rc[(v['y'], v['x'])][k] = v
+            self.by_tiletype[k.split(":")[-1]][k] = v
+            self.by_record_tiletype[v.get('tiletype')][k] = v
+            self.by_row[v['y']][k] = v
+            self.by_col[v['x']][k] = v
+
+        self.sorted_names = sorted(self.tiles)
+        self._prefix_cache = {}
+
+    def at_rc(self, rc):
+        return self.by_rc.get(rc, {})
+
+    def of_tiletype(self, tiletype):
+        return self.by_tiletype.get(tiletype, {})
+
+    def with_tiletype_prefix(self, prefix):
+        """Tiles whose record's tiletype starts with prefix"""
+        if prefix not in self._prefix_cache:
+            tiles = {k: v for tt, tiles in self.by_record_tiletype.items() if tt is not None and tt.startswith(prefix)
+                     for k, v in tiles.items()}
+            self._prefix_cache[prefix] = dict(sorted(tiles.items(), key=lambda kv: self.position[kv[0]]))
+        return self._prefix_cache[prefix]
+
+    def with_name_prefix(self, prefix):
+        """Names of the tiles starting with prefix"""
+        lo = bisect.bisect_left(self.sorted_names, prefix)
+        hi = lo
+        while hi < len(self.sorted_names) and self.sorted_names[hi].startswith(prefix):
+            hi = hi + 1
+        return sorted(self.sorted_names[lo:hi], key=self.position.__getitem__)
+
+    def in_row(self, row):
+        return self.by_row.get(row, {})
+
+    def in_col(self, col):
+        return self.by_col.get(col, {})
+
+    def on_edge(self, side, offset = -1):
+        (r, c) = get_rc_from_edge(self.device, side, offset)
+        if r == -1 and c == -1:
+            return self.tiles
+        if c == -1:
+            return self.in_row(r)
+        if r == -1:
+            return self.in_col(c)
+        return self.at_rc((r, c))
+
 def get_rc_from_edge(device, side, offset):
     devices = database.get_devices()
     device_info = devices["families"][database.get_family_for_device(device)]["devices"][device]
@@ -53,10 +142,7 @@ def get_rc_from_edge(device, side, offset):
     assert False, f"Could not match IO with side as side {side} offset {offset}"
 
 def get_tiles_from_edge(device, side, offset = -1):
-    (r, c) = get_rc_from_edge(device, side, offset)
-    tg = database.get_tilegrid(device)["tiles"]
-
-    return [t for t, tinfo in tg.items() if (c == -1 or tinfo["x"] == c) and (r == -1 or tinfo["y"] == r)]
+    return list(TileGrid.get(device).on_edge(side, offset))
 
 def get_sites_from_primitive(device, primitive):
     sites = database.get_sites(device)    
@@ -64,22 +150,17 @@ def get_sites_from_primitive(device, primitive):
 
 
 def get_tiletypes(device):
-    tilegrid = database.get_tilegrid(device)['tiles']
     tiletypes = defaultdict(list)
-    for (k,v) in tilegrid.items():
-        tiletypes[k.split(":")[-1]].append(k)
+    for (tiletype, tiles) in TileGrid.get(device).by_tiletype.items():
+        tiletypes[tiletype].extend(tiles)
     return tiletypes
 
 def get_tiles_by_filter(device, fn):
-    tilegrid = database.get_tilegrid(device)['tiles']
-
-    return {k:v for k,v in tilegrid.items() if fn(k, v)}
+    return {k:v for k,v in TileGrid.get(device).tiles.items() if fn(k, v)}
     
 
 def get_tiles_by_tiletype(device, tiletype):
-    tilegrid = database.get_tilegrid(device)['tiles']
-
-    return {k: v for k, v in tilegrid.items() if k.split(":")[-1] == tiletype}
+    return dict(TileGrid.get(device).of_tiletype(tiletype))
 
 def get_coincidental_tiletypes_for_tiletype(device, tiletype):
     tt_t = get_tiles_by_tiletype(device, tiletype)
@@ -97,19 +178,19 @@ def get_coincidental_tiletypes_for_tiletype(device, tiletype):
 
 
 def get_tiles_by_primitive(device, primitive):
-    tilegrid = database.get_tilegrid(device)['tiles']
-    
-    rc_regex = re.compile("R([0-9]*)C([0-9]*)")
-    edge_regex = re.compile("IOL_(.)([0-9]*)")    
+    grid = TileGrid.get(device)
     sites = get_sites_from_primitive(device, primitive)
 
-    tg_by_rc = { (t['y'], t['x']):(k, t) for (k, t) in tilegrid.items() }
-
     rcs = {}
     for (a,v) in sites.items():
         rc = get_rc_from_name(device, a)
 
-        (name, t) = tg_by_rc[rc]
+        tiles_at_rc = grid.at_rc(rc)
+        if len(tiles_at_rc) == 0:
+            raise KeyError(rc)
+
+        # The last tile of the tilegrid at that RC
+        (name, t) = next(reversed(tiles_at_rc.items()))
         rcs[(a,name)] = t
 
     return rcs
@@ -124,22 +205,150 @@ def get_tiletypes_by_primitive(device, primitive):
     return rtn
 
 def get_sites_for_tile(device, tile):
-    tilegrid = database.get_tilegrid(device)['tiles']
-    tile = [v for (k,v) in tilegrid.items() if k.startswith(tile) ][0]
-
-    sites = database.get_sites(device)
+    grid = TileGrid.get(device)
+    tile = grid.tiles[grid.with_name_prefix(tile)[0]]
 
     RC = (tile["y"], tile["x"])
     
-    return {k:v for k,v in sites.items() if RC == get_rc_from_name(device, k)}
+    return dict(_get_sites_by_rc(device).get(RC, {}))
+
+@cache
+def _get_sites_by_rc(device):
+    sites_by_rc = defaultdict(dict)
+    for k, v in database.get_sites(device).items():
+        sites_by_rc[get_rc_from_name(device, k)][k] = v
+    return sites_by_rc
 
 @cache
 def get_full_node_set(device):
     all_nodes = lapie.get_full_node_list(device)
     return set([n for n in all_nodes if len(n)])
 
+class PackedStrings:
+    """A sorted list of strings stored as one utf-8 blob and offsets. Supports len, indexing and index()"""
+    def __init__(self, blob, ptr):
+        self.blob = blob
+        self.ptr = ptr
+
+    @staticmethod
+    def pack(strings):
+        encoded = [s.encode() for s in sorted(strings)]
+        ptr = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=ptr[1:])
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), ptr
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.ptr[i]:self.ptr[i + 1]].tobytes().decode()
+
+    def index(self, s):
+        i = bisect.bisect_left(self, s)
+        if i < len(self) and self[i] == s:
+            return i
+        return None
+
+class NodeListLookups:
+    """
+    Which nodes are listed in and owned by which tiles of a device.
+
+    Computed once per device and kept in `.cache/<radiant version>/<device>-tile-nodes/` as compressed sparse row
+    arrays over the sorted node names, keyed by the tilegrid and node list hashes. The arrays are memory mapped, so
+    lookups are available at startup without walking the node list.
+    """
+    # Bump when the ownership rules in _compute_node_list_lookups change
+    version = 1
+
+    array_names = [
+        "name_blob", "name_ptr",
+        "listed_ptr", "listed_nodes",
+        "owned_ptr", "owned_nodes",
+        "owners_ptr", "owners_tiles",
+    ]
+
+    def __init__(self, directory, meta):
+        self.tiles = meta["tiles"]
+        self.tile_index = {t: i for i, t in enumerate(self.tiles)}
+        for name in NodeListLookups.array_names:
+            setattr(self, name, np.load(f"{directory}/{name}.npy", mmap_mode="r"))
+        self.names = PackedStrings(self.name_blob, self.name_ptr)
+
+    @staticmethod
+    def stamp(device):
+        return [NodeListLookups.version, database.get_tilegrid_hash(device), lapie.get_node_list_hash(device)]
+
+    @staticmethod
+    def load(device):
+        directory = f"{database.get_cache_dir()}/{device}-tile-nodes"
+        stamp = NodeListLookups.stamp(device)
+
+        try:
+            with open(f"{directory}/meta.json") as f:
+                meta = json.load(f)
+            if meta["stamp"] == stamp:
+                return NodeListLookups(directory, meta)
+        except (OSError, ValueError):
+            pass
+
+        t = time.time()
+        node_list_lookup, node_owned_lookup, tile_owned_lookup = _compute_node_list_lookups(device)
+
+        tmp_dir = tempfile.mkdtemp(dir=database.get_cache_dir(), prefix=f"{device}-tile-nodes.")
+        meta = NodeListLookups._write(tmp_dir, stamp, node_list_lookup, node_owned_lookup, tile_owned_lookup)
+        logging.info(f"Built node to tile lookups for {device} in {time.time() - t:.1f} sec")
+
+        return NodeListLookups(database.replace_cache_dir(tmp_dir, directory), meta)
+
+    @staticmethod
+    def _write(directory, stamp, node_list_lookup, node_owned_lookup, tile_owned_lookup):
+        names = set(tile_owned_lookup.keys())
+        for nodes in itertools.chain(node_list_lookup.values(), node_owned_lookup.values()):
+            names.update(nodes)
+        tiles = sorted(set(node_list_lookup.keys()) | set(node_owned_lookup.keys()) |
+                       {t for ts in tile_owned_lookup.values() for t in ts})
+
+        arrays = {}
+        arrays["name_blob"], arrays["name_ptr"] = PackedStrings.pack(names)
+        name_index = {n: i for i, n in enumerate(sorted(names))}
+        tile_index = {t: i for i, t in enumerate(tiles)}
+
+        def csr(keys, lookup, index):
+            ptr = np.zeros(len(keys) + 1, dtype=np.int64)
+            np.cumsum([len(lookup.get(k, [])) for k in keys], out=ptr[1:])
+            values = np.fromiter((index[v] for k in keys for v in lookup.get(k, [])), dtype=np.int32, count=ptr[-1])
+            return ptr, values
+
+        arrays["listed_ptr"], arrays["listed_nodes"] = csr(tiles, node_list_lookup, name_index)
+        arrays["owned_ptr"], arrays["owned_nodes"] = csr(tiles, node_owned_lookup, name_index)
+        arrays["owners_ptr"], arrays["owners_tiles"] = csr(sorted(names), tile_owned_lookup, tile_index)
+
+        for name, array in arrays.items():
+            np.save(f"{directory}/{name}.npy", array)
+
+        meta = {"stamp": stamp, "tiles": tiles}
+        with open(f"{directory}/meta.json", "w") as f:
+            json.dump(meta, f)
+        return meta
+
+    def get_node_list_for_tile(self, tile, owned = False):
+        i = self.tile_index.get(tile)
+        if i is None:
+            return []
+        ptr, nodes = (self.owned_ptr, self.owned_nodes) if owned else (self.listed_ptr, self.listed_nodes)
+        return [self.names[n] for n in nodes[ptr[i]:ptr[i + 1]].tolist()]
+
+    def get_tile_list_for_node(self, node):
+        i = self.names.index(node)
+        if i is None:
+            return []
+        return [self.tiles[t] for t in self.owners_tiles[self.owners_ptr[i]:self.owners_ptr[i + 1]].tolist()]
+
 @cache
 def get_node_list_lookups(device):
+    return NodeListLookups.load(device)
+
+def _compute_node_list_lookups(device):
     _spine_regex = re.compile("(.)([0-9][0-9])[NEWS]([0-9][0-9])([0-9][0-9])")
     _hpbx_regex = re.compile("HPBX[0-9]*")
 
@@ -209,13 +418,13 @@ def get_node_list_lookups(device):
         elif _hpbx_regex.search(name_no_rc) is not None:
             tap_tiles_on_r = sorted([(abs(rc[1] - get_rc_from_name(device, x)[1]), x)
                         for x in get_tiles_by_filter(device, lambda _, info: info["y"] == rc[0]) if ":TAP" in x])
-            owner = next(iter([tile for tile in tap_tiles_on_r]), None)[1]
+            owner = tap_tiles_on_r[0][1] if len(tap_tiles_on_r) else None
 
             if owner is not None:
                 node_owned_lookup[owner].append(name)
                 tile_owned_lookup[name].append(owner)
             else:
-                logging.warning(f"Could not find owner for {name}: {lapie.get_node_data(device, name)[0].aliases} {tap_tiles_on_r}")
+                logging.warning(f"Could not find owner for {name}: {tap_tiles_on_r}")
         else:
             node_owned_lookup[tiles_at_rc[0]].append(name)
             tile_owned_lookup[name].extend(tiles_at_rc)
@@ -223,20 +432,15 @@ def get_node_list_lookups(device):
     return node_list_lookup, node_owned_lookup, tile_owned_lookup
 
 def get_tile_list_for_node(device, node):
-    _, _, tile_owned_lookup = get_node_list_lookups(device)
-
-    return tile_owned_lookup[node]
+    return get_node_list_lookups(device).get_tile_list_for_node(node)
 
 def get_node_list_for_tile(device, tile, owned = False):
-    node_list_lookup, node_owned_lookup, _ = get_node_list_lookups(device)
-
-    def _get_node_list_for_tile(t):
-        return (node_owned_lookup if owned else node_list_lookup).get(t, [])
+    lookups = get_node_list_lookups(device)
 
     if isinstance(tile, list):
-        return {n:t for t in tile for n in _get_node_list_for_tile(t)}
+        return {n:t for t in tile for n in lookups.get_node_list_for_tile(t, owned)}
     else:
-        return _get_node_list_for_tile(tile)
+        return lookups.get_node_list_for_tile(tile, owned)
 
 def get_nodes_for_tile(device, tile, owned = False):
     if isinstance(tile, list):
@@ -255,19 +459,11 @@ def get_nodes_for_tile(device, tile, owned = False):
     
         return {n.name:n for n in lapie.get_node_data(device, tile_nodes, False)}
 
-_get_tiles_by_rc = {}
 def get_tiles_by_rc(device, rc = None):
     if isinstance(rc, str):
         rc = get_rc_from_name(device, rc)
 
-    if device not in _get_tiles_by_rc:
-        tilegrid = database.get_tilegrid(device)['tiles']
-        _get_tiles_by_rc[device] = defaultdict(dict)
-        for k,v in tilegrid.items():
-            nrc = (v['y'], v['x'])
-            _get_tiles_by_rc[device][nrc][k] = v
-
-    return _get_tiles_by_rc[device][rc]
+    return TileGrid.get(device).at_rc(rc)
 
 
 
@@ -278,36 +474,94 @@ def get_tile_routes(device, tilename, owned = False):
 
 rc_regex = re.compile("R([0-9]+)C([0-9]+)")
 edge_regex = re.compile("IOL_(.)([0-9]+)")
-_get_rc_from_name_lookup = {}
-def get_rc_from_name(device, name):
-    if isinstance(name, tuple):
-        return name
 
-    if name[:6] in _get_rc_from_name_lookup:
-        return _get_rc_from_name_lookup[name[:7]]
+class RCCodec:
+    """
+    (row, col) of node, tile and site names for one device.
+
+    Most names start with R<row>C<col>, and that prefix alone decides the result, so results are memoised by the part
+    of the name before the first underscore. Names with the RC elsewhere (TAP_R3C5:TAP_PLC), edge IO names
+    (IOL_T12_...) and names without any RC are memoised whole.
+    """
+    _lock = threading.Lock()
+    _codecs = {}
+
+    @staticmethod
+    def get(device):
+        with RCCodec._lock:
+            if device not in RCCodec._codecs:
+                RCCodec._codecs[device] = RCCodec(device)
+            return RCCodec._codecs[device]
 
-    m = rc_regex.search(name)
-    if m:
-        rc = (int(m.group(1)), int(m.group(2)))
-        if m.start() == 0:
-            _get_rc_from_name_lookup[name[:7]] = rc
-        return rc
+    def __init__(self, device):
+        self.device = device
+        self.by_head = {}
+        self.by_name = {}
+
+    def rc(self, name):
+        if isinstance(name, tuple):
+            return name
+
+        head = name.partition("_")[0]
+        rc = self.by_head.get(head)
+        if rc is not None:
+            return rc
+        if name in self.by_name:
+            return self.by_name[name]
+        return self._parse(name, head)
+
+    def _parse(self, name, head):
+        m = rc_regex.search(name)
+        if m:
+            rc = (int(m.group(1)), int(m.group(2)))
+            # A match at the start lies within the head, since the pattern has no underscore
+            if m.start() == 0:
+                self.by_head[head] = rc
+            else:
+                self.by_name[name] = rc
+            return rc
+
+        m = edge_regex.match(name)
+        if m:
+            rc = get_rc_from_edge(self.device, m.group(1), m.group(2))
+            self.by_name[name] = rc
+            return rc
+
+        if name not in ["R", "L"]:
+            logging.warning(f"Could not derive RC from {name}")
+        self.by_name[name] = None
+        return None
 
-    m = edge_regex.match(name)
-    if m:
-        return get_rc_from_edge(device, m.group(1), m.group(2))
+    def rcs(self, names):
+        """Rows and columns of names as two int32 arrays, -1 where a name has no RC"""
+        rcs = [self.rc(n) or (-1, -1) for n in names]
+        rows = np.fromiter((rc[0] for rc in rcs), dtype=np.int32, count=len(rcs))
+        cols = np.fromiter((rc[1] for rc in rcs), dtype=np.int32, count=len(rcs))
+        return rows, cols
+
+    def group_by_rc(self, names):
+        """{(row, col): [names]}, leaving out names without an RC"""
+        names = list(names)
+        rows, cols = self.rcs(names)
+        keys = rows.astype(np.int64) << 32 | cols.astype(np.int64) & 0xffffffff
+        order = np.argsort(keys, kind="stable")
+        unique, starts = np.unique(keys[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+
+        groups = {}
+        for k, s, e in zip(unique.tolist(), starts.tolist(), ends.tolist()):
+            rc = (rows[order[s]].item(), cols[order[s]].item())
+            if rc != (-1, -1):
+                groups[rc] = [names[i] for i in order[s:e].tolist()]
+        return groups
 
-    if name not in ["R", "L"]:
-        logging.warning(f"Could not derive RC from {name}")
-    return None
+def get_rc_from_name(device, name):
+    return RCCodec.get(device).rc(name)
 
 def get_tile_from_node(device, node):
     rc = get_rc_from_name(device, node)
-    tilegrid = database.get_tilegrid(device)['tiles']
 
-    for k,v in tilegrid.items():
-        if (v['y'], v['x']) == rc:
-            return k
+    return next(iter(TileGrid.get(device).at_rc(rc)), None)
 
 def get_connected_nodes(device, tilename):
     routes = get_tile_routes(device, tilename)
@@ -358,11 +612,11 @@ def get_pips_for_tile(device, tilename, owned = False, dir = None):
 def get_connected_tiles(device, tilename):    
     connected_nodes = get_connected_nodes(device, tilename)
     
-    tilegrid = database.get_tilegrid(device)['tiles']
+    grid = TileGrid.get(device)
     
     rcs = set([get_rc_from_name(device, n) for n in connected_nodes])
     
-    return { k:v for k,v in tilegrid.items() if (v['y'], v['x']) in rcs  }
+    return dict(sorted(((k, v) for rc in rcs for k, v in grid.at_rc(rc).items()), key=lambda kv: grid.position[kv[0]]))
 
 def draw_rc(device, rcs):
     devices = database.get_devices()
@@ -379,12 +633,13 @@ def draw_rc(device, rcs):
 
 def get_wires_for_tiles(device):
     anon_nodes = defaultdict(lambda : defaultdict(list))
-    for n in get_full_node_set(device):
-        wire_name = "_".join(n.split("_")[1:])
-        rc = get_rc_from_name(device, n)
-        for tile in sorted(get_tiles_by_rc(device, rc)):
-            tiletype = tile.split(":")[-1]
-            anon_nodes[tiletype][wire_name].append(tile)
+    for rc, names in RCCodec.get(device).group_by_rc(get_full_node_set(device)).items():
+        rc_tiles = sorted(get_tiles_by_rc(device, rc))
+        for n in names:
+            wire_name = "_".join(n.split("_")[1:])
+            for tile in rc_tiles:
+                tiletype = tile.split(":")[-1]
+                anon_nodes[tiletype][wire_name].append(tile)
 
     return anon_nodes
 
@@ -441,6 +696,13 @@ def get_representative_nodes_data(device, seed = 42, exclude_set = []):
 
     return rtn
 
+def get_node_infos(device, names):
+    """Like lapie.get_node_data, but answered from the mapped routing graph for nodes it has full data for"""
+    infos, missing = routing_graph.RoutingGraph.get(device).get_node_infos(list(names))
+    if len(missing) > 0:
+        infos.extend(lapie.get_node_data(device, missing))
+    return infos
+
 def get_node_data_local_graph(device, node, should_expand = None):
     if isinstance(node, Iterable):
         node = list(node)
@@ -459,7 +721,7 @@ def get_node_data_local_graph(device, node, should_expand = None):
 
     graph = {}
     while len(query_list) > 0:
-        new_nodes = lapie.get_node_data(device, query_list)
+        new_nodes = get_node_infos(device, query_list)
         graph.update({n.name:n for n in new_nodes})
 
         query_list = [wire for n in new_nodes
@@ -480,6 +742,7 @@ def get_local_pips_for_site(device, site, include_interface_pips = True):
                                     include_interface_pips = include_interface_pips,
                                     should_expand = lambda x: site["type"] in x)
 
+@scheduler.task_class("lapie")
 def get_local_pips_for_nodes(device, nodes, should_expand = None, include_interface_pips = True, executor = None):
     if executor is not None:
         return executor.submit(get_local_pips_for_nodes, device, nodes, should_expand = should_expand ,include_interface_pips = include_interface_pips)
@@ -501,8 +764,7 @@ def get_local_pips_for_nodes(device, nodes, should_expand = None, include_interf
 
 async def get_tiles_with_pip(device, pip, tiles = None, pips_by_node = None):
     if tiles is None:
-        tilegrid = database.get_tilegrid(device)['tiles']
-        tiles = {k:get_rc_from_name(device, k) for k, v in tilegrid.items()}
+        tiles = {k:get_rc_from_name(device, k) for k in TileGrid.get(device).tiles}
     else:
         tiles = {k:get_rc_from_name(device, k) for k in tiles}
 
@@ -524,13 +786,75 @@ async def get_pip_tile_groupings_for_tiletype(device, tiletype, owned=True):
 
     return await get_pip_tile_groupings(device, ts)
 
-@cachecontrol.cache_fn()
-async def get_pip_tile_groupings(device, tiles):
-    import interconnect
-    import fuzzconfig
+class PipGroupingStore:
+    """
+    The relative pips of each tile, as computed by get_pip_tile_groupings, in
+    `.cache/<radiant version>/<device>-pip-groupings.sqlite`. Each entry carries a hash of the tile's input pips by
+    node name -- node ids change when the node database is rebuilt -- so only tiles whose pips changed are recomputed.
+    """
+    # Bump when the relative node format or the input hash changes
+    version = 2
+
+    def __init__(self, device):
+        self.conn = sqlite3.connect(f"{database.get_cache_dir()}/{device}-pip-groupings.sqlite", timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS tile_pips (
+            tile       TEXT PRIMARY KEY,
+            input_hash TEXT NOT NULL,
+            pips       BLOB NOT NULL
+        );
+        """)
+
+    @staticmethod
+    def input_hash(tile, edges):
+        """Hash of the (from_name, to_name) pairs a tile's relative pips are computed from"""
+        h = hashlib.sha1(f"{PipGroupingStore.version}:{tile}:".encode())
+        for frm, to in sorted(edges):
+            h.update(f"{frm}>{to}\n".encode())
+        return h.hexdigest()
+
+    def get_hashes(self):
+        return dict(self.conn.execute("SELECT tile, input_hash FROM tile_pips"))
+
+    def put(self, results):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tile_pips (tile, input_hash, pips) VALUES (?, ?, ?)",
+                ((tile, h, pickle.dumps(pips)) for tile, h, pips in results)
+            )
+
+    def iter_pips(self, tiles):
+        for tile in tiles:
+            row = self.conn.execute("SELECT pips FROM tile_pips WHERE tile = ?", (tile,)).fetchone()
+            yield tile, (set() if row is None else pickle.loads(row[0]))
+
+    def close(self):
+        self.conn.close()
+
+def _relative_pips_for_tiles(device, jobs):
+    """Relative pips of each (tile, rc, [(from_name, to_name), ...]) job; run in get_pip_tile_groupings' workers"""
+    resolver = NodeResolver.get(device)
+
+    results = []
+    for tile, rc, edges in jobs:
+        # Each node is made relative once per tile, not once per pip it is on
+        names = list(set(itertools.chain.from_iterable(edges)))
+        rel_names = dict(zip(names, resolver.relative_many((n, rc) for n in names)))
+        results.append((tile, {(rel_names[frm], rel_names[to]) for frm, to in edges}))
+    return results
+
+async def get_pip_tile_groupings(device, tiles, shard_size = 64):
+    """
+    Group the uphill pips of the nodes owned by tiles, made relative to their tile, by the exact set of tiles that has
+    them. Returns {tuple of tiles: set of relative pips}.
+
+    Tiles are anonymised in shards over a process pool and the results kept in a PipGroupingStore, so a rerun only
+    redoes tiles whose edges changed. The grouping is then folded together one tile at a time.
+    """
     import fuzzloops
 
-    ts = tiles
+    ts = sorted(set(tiles))
 
     all_nodes = {
         node:tile
@@ -538,36 +862,52 @@ async def get_pip_tile_groupings(device, tiles):
         for node in get_node_list_for_tile(device, tile, owned=True)
     }
 
-    all_pips = set(await lapie.get_pip_data(device, list(all_nodes.keys()), filter_type="to"))
+    name_to_id, (from_ids, to_ids, _) = await lapie.get_pip_edges(device, list(all_nodes.keys()), direction="uphill")
+    id_to_tile = {node_id: all_nodes[n] for n, node_id in name_to_id.items()}
 
-    pips_by_tile = defaultdict(set)
-    for p in all_pips:
-        w = p[1]
-        if w in all_nodes:
-            pips_by_tile[all_nodes[w]].add(p)
+    from_ids, to_ids = from_ids.tolist(), to_ids.tolist()
+    id_to_name = NodesDatabase.get(device).get_node_names(sorted(set(from_ids) | set(to_ids)))
 
-    tiles_with_rel_pips = defaultdict(set)
+    edges_by_tile = defaultdict(list)
+    for frm, to in zip(from_ids, to_ids):
+        edges_by_tile[id_to_tile[to]].append((id_to_name[frm], id_to_name[to]))
 
-    def relative_node(n, rc):
-        rel_node = resolve_relative_node(device, n, rc)
-        return rel_node
+    store = PipGroupingStore(device)
+    try:
+        stored_hashes = store.get_hashes()
+        input_hashes = {t: PipGroupingStore.input_hash(t, edges_by_tile.get(t, [])) for t in ts}
+        todo = [t for t in ts if stored_hashes.get(t) != input_hashes[t]]
+        logging.info(f"Relative pips for {device}: {len(ts) - len(todo)} tiles stored, {len(todo)} to compute")
 
-    for t, absolute_pips in pips_by_tile.items():
-        # Yield
-        await asyncio.sleep(0)
+        if len(todo):
+            shards = [[(t, get_rc_from_name(device, t), edges_by_tile.get(t, [])) for t in shard]
+                      for shard in itertools.batched(todo, shard_size)]
 
-        rc = get_rc_from_name(device, t)
-        rc_pips = set([
-            tuple([relative_node(n, rc) for n in p])
-            for p in absolute_pips
-        ])
+            def store_results(results):
+                store.put([(t, input_hashes[t], pips) for t, pips in results])
 
-        for anon_pip in rc_pips:
-            tiles_with_rel_pips[anon_pip].add(t)
+            if len(shards) == 1:
+                store_results(_relative_pips_for_tiles(device, shards[0]))
+            else:
+                # Off the event loop, so the loop's thread isn't blocked while the workers run
+                results = await asyncio.to_thread(
+                    fuzzloops.parallel_foreach, shards, lambda shard: _relative_pips_for_tiles(device, shard),
+                    mode="process", devices=[device], name=f"relative pips {device}")
+                for shard_results in results:
+                    store_results(shard_results)
+
+        # Streaming reduce; only the pip -> tiles map is held, not every tile's pips
+        tiles_with_rel_pips = defaultdict(list)
+        for t, pips in store.iter_pips(ts):
+            for anon_pip in pips:
+                tiles_with_rel_pips[anon_pip].append(t)
+            await asyncio.sleep(0)
+    finally:
+        store.close()
 
     rel_pip_groups = defaultdict(set)
     for anon_pip, tiles in tiles_with_rel_pips.items():
-        rel_pip_groups[tuple(sorted(tiles))].add(anon_pip)
+        rel_pip_groups[tuple(tiles)].add(anon_pip)
 
     return rel_pip_groups
 
@@ -625,113 +965,210 @@ def get_connections_for_device(device):
     return connections
 
 def find_path(device, frm, to):
-    nodes = lapie.get_node_data(device, [frm])
+    """
+    Breadth first search along downhill pips. Returns the nodes of the shortest path from frm to to, starting at to
+    and excluding frm, or None if to is unreachable.
+    """
+    if NodesDatabase.get(device).is_fully_prefetched():
+        path = routing_query.shortest_path(device, frm, to)
+        return None if path is None else path[::-1][:-1]
 
     edges = {}
-    visited = set()
-    found = False
-    while not found:
-        query = set()
-        for n in nodes:
-            for p in n.uphill_pips:
-                if p.to_wire == to:
-                    found = True
-                    break
-
+    visited = {frm}
+    query = [frm]
+    while len(query) > 0 and to not in visited:
+        next_query = []
+        for n in get_node_infos(device, query):
+            for p in n.downhill_pips:
                 if p.to_wire not in visited:
-                    edges[p.to_wire] = n
+                    edges[p.to_wire] = n.name
                     visited.add(p.to_wire)
-                    query.add(p.to_wire)
-        nodes = lapie.get_node_data(device, query)
+                    next_query.append(p.to_wire)
+        query = next_query
+
+    if to not in visited:
+        return None
 
     path = []
     c = to
-    while c != frm:
+    while c in edges:
         path.append(c)
         c = edges[c]
     return path
 
 _resolve_relative_node_regex = re.compile(r"([HV])0(\d)([NEWS])0([0-9])0([0-9])")
-def resolve_relative_node(device, n, rel_to = (0,0)):
-    if isinstance(rel_to, str):
-        rel_to = get_rc_from_name(device, rel_to)
-    (rr, cc) = rel_to
 
-    rc = get_rc_from_name(device, n)
-    if rc is None:
-        logging.warning(f"Can not resolve relative node for {n}")
-        return None
+# Wire suffix classes for NodeResolver
+GLOBAL_WIRE = "G"
+FIXED_COLUMN_WIRE = "C"
+SPAN_WIRE = "S"
+LOCAL_WIRE = "L"
 
-    (r,c) = rc
+class NodeResolver:
+    """
+    Memoised conversion between concrete node names and their anonymised form relative to a tile (see
+    resolve_relative_node). The class of each wire suffix -- global, fixed column, NEWS span or local -- is worked out
+    once per suffix; whole (node, rc) results are kept in LRU caches. The *_many methods take sequences of
+    (node, rc) pairs.
+    """
+    _lock = threading.Lock()
+    _resolvers = {}
 
-    wire = "_".join(n.split("_")[1:])
+    global_prefixes = ("VCC", "VPSX", "LHPRX", "RHPRX")
+    fixed_column_prefixes = ("HPBX", "HPRX")
 
-    global_prefixes = ["VCC", "VPSX", "LHPRX", "RHPRX"]
+    cache_size = 1 << 20
 
-    if any([wire.startswith(prefix) for prefix in global_prefixes]):
-        return (f"G:{wire}", (r, c))
+    @staticmethod
+    def get(device):
+        with NodeResolver._lock:
+            if device not in NodeResolver._resolvers:
+                NodeResolver._resolvers[device] = NodeResolver(device)
+            return NodeResolver._resolvers[device]
 
-    fixed_column_prefixes = ["HPBX", "HPRX"]
+    def __init__(self, device):
+        self.device = device
+        self.wire_classes = {}
+        self.relative = lru_cache(maxsize=NodeResolver.cache_size)(self._relative)
+        self.actual = lru_cache(maxsize=NodeResolver.cache_size)(self._actual)
+        self.node_rcs = lru_cache(maxsize=NodeResolver.cache_size)(self._node_rcs)
+
+    def classify_wire(self, wire):
+        cls = self.wire_classes.get(wire)
+        if cls is None:
+            if wire.startswith(NodeResolver.global_prefixes):
+                cls = (GLOBAL_WIRE,)
+            elif wire.startswith(NodeResolver.fixed_column_prefixes):
+                cls = (FIXED_COLUMN_WIRE,)
+            elif (match := _resolve_relative_node_regex.search(wire)) is not None:
+                (orientation, length, direction, slot, tap) = match.groups()
+                cls = (SPAN_WIRE, orientation, int(length), direction, int(slot), int(tap))
+            else:
+                cls = (LOCAL_WIRE,)
+            self.wire_classes[wire] = cls
+        return cls
 
-    if any([wire.startswith(prefix) for prefix in fixed_column_prefixes]):
-        return (f"C:{wire}", (r-rr, c))
+    def _relative(self, n, rel_to):
+        (rr, cc) = rel_to
 
-    # if wire.startswith("HPBX"):
-    #     return ("B:", wire.split("HPBX")[-1])
+        rc = get_rc_from_name(self.device, n)
+        if rc is None:
+            logging.warning(f"Can not resolve relative node for {n}")
+            return None
 
-    match = _resolve_relative_node_regex.search(n)
-    if match:
-        (orientation, length, direction, slot, tap) = match.groups()
-        (length, slot, tap) = (int(length), int(slot), int(tap))
+        (r,c) = rc
 
-        canon_tap = 0
-        offset = (tap - canon_tap)
-        if direction in "SE":
-            offset = -offset
+        wire = n.split("_", 1)[1] if "_" in n else ""
+        cls = self.classify_wire(wire)
 
-        d = (offset + r-rr, c-cc)
-        if orientation == 'H':
-            d = (r-rr, offset + c-cc)
-        return (direction, d, length, slot)
+        if cls[0] == GLOBAL_WIRE:
+            return (f"G:{wire}", (r, c))
 
-    return (wire, (r-rr, c-cc))
+        if cls[0] == FIXED_COLUMN_WIRE:
+            return (f"C:{wire}", (r-rr, c))
 
-def resolve_node_rcs(device, n):
-    if isinstance(n, str):
-        orig_n = n
-        n = resolve_relative_node(device, n)
+        if cls[0] == SPAN_WIRE:
+            (_, orientation, length, direction, slot, tap) = cls
 
-    if n is None:
-        return []
+            canon_tap = 0
+            offset = (tap - canon_tap)
+            if direction in "SE":
+                offset = -offset
+
+            d = (offset + r-rr, c-cc)
+            if orientation == 'H':
+                d = (r-rr, offset + c-cc)
+            return (direction, d, length, slot)
+
+        return (wire, (r-rr, c-cc))
 
-    (wire_type, rc, *args) = n
+    def _node_rcs(self, n):
+        (wire_type, rc, *args) = n
 
-    if wire_type in "NEWS":
-        def resolve_possible_names(n):
+        if wire_type in "NEWS":
             (direction, rc, length, slot) = n
-            (r, c) = (rc[0], rc[1] )
+            (r, c) = (rc[0], rc[1])
 
+            rcs = []
             for i in range(length + 1):
                 diri = i if direction in "SE" else -i
                 nc = c + diri if direction in "EW" else c
                 nr = r + diri if direction in "NS" else r
+                rcs.append((nr, nc))
+            return tuple(rcs)
+        return (rc,)
+
+    def span_names(self, n, rel_to):
+        """Concrete names of every segment of the span wire n placed relative to rel_to"""
+        (direction, rc, length, slot) = n
+        orientation = "H" if direction in "EW" else "V"
+        return [f"R{rr + rel_to[0]}C{cc + rel_to[1]}_{orientation}0{length}{direction}0{slot}0{i}"
+                for i, (rr, cc) in enumerate(self.node_rcs(n))]
+
+    def _actual(self, n, rel_to):
+        (wire_type, rc, *args) = n
+
+        if wire_type in "NEWS":
+            fullnodes = get_full_node_set(self.device)
+            existing_nodes = [name for name in self.span_names(n, rel_to) if name in fullnodes]
+
+            assert(len(existing_nodes) < 2)
+            if len(existing_nodes) == 0:
+                logging.debug(f"No nodes found for {n} {rel_to}")
+            return next(iter(existing_nodes), None)
+
+        if wire_type.startswith("G:"):
+            (r,c) = rc
+            return f"R{r}C{c}_{wire_type.split(":")[1]}"
+
+        if wire_type.startswith("B:"):
+            print(f"{n} relative to {rel_to}")
+            assert (False)
+
+        if wire_type.startswith("C:"):
+            (r,c) = (rc[0] + rel_to[0], rc[1])
+            return f"R{r}C{c}_{wire_type.split(":")[1]}"
+
+        (r,c) = (rc[0] + rel_to[0], rc[1] + rel_to[1])
+        if (r < 0) or c < 0:
+            return None
+        return f"R{r}C{c}_{wire_type}"
+
+    def to_rc(self, rel_to):
+        if isinstance(rel_to, str):
+            return get_rc_from_name(self.device, rel_to)
+        return tuple(rel_to)
 
-                yield (nr, nc)
-        return [n for n in resolve_possible_names(n)]
-    return [rc]
+    def relative_many(self, pairs):
+        """resolve_relative_node for each (node, rc) pair"""
+        return [self.relative(n, self.to_rc(rc)) for n, rc in pairs]
+
+    def actual_many(self, pairs):
+        """resolve_actual_node for each (anonymised node, rc) pair"""
+        return [self.actual(n, self.to_rc(rc)) for n, rc in pairs]
+
+def resolve_relative_node(device, n, rel_to = (0,0)):
+    resolver = NodeResolver.get(device)
+    return resolver.relative(n, resolver.to_rc(rel_to))
+
+def resolve_node_rcs(device, n):
+    resolver = NodeResolver.get(device)
+    if isinstance(n, str):
+        n = resolver.relative(n, (0, 0))
+
+    if n is None:
+        return []
+
+    return list(resolver.node_rcs(n))
 
 def resolve_possible_names(device, n, rel_to=(0,0)):
+    resolver = NodeResolver.get(device)
     if isinstance(n, str):
-        orig_n = n
-        n = resolve_relative_node(device, n)
+        n = resolver.relative(n, (0, 0))
 
-    (direction, rc, length, slot) = n
-    orientation = "H" if direction in "EW" else "V"
-    for i, (rr,cc) in enumerate(resolve_node_rcs(device, n)):
-        nr = rr + rel_to[0]
-        nc = cc + rel_to[1]
-        if nr >= 0 and nc >= 0:
-            yield f"R{nr}C{nc}_{orientation}0{length}{direction}0{slot}0{i}"
+    for name, (rr, cc) in zip(resolver.span_names(n, rel_to), resolver.node_rcs(n)):
+        if rr + rel_to[0] >= 0 and cc + rel_to[1] >= 0:
+            yield name
 
 def is_edge_node(device, n):
     rcs = resolve_node_rcs(device, n)
@@ -744,44 +1181,8 @@ def is_edge_node(device, n):
     return any([(r >= max_row or r <= 0 or c >= max_col or c <= 0) for (r,c) in rcs])
 
 def resolve_actual_node(device, n, rel_to = (0,0)):
-    if isinstance(rel_to, str):
-        rel_to = get_rc_from_name(device, rel_to)
-
-    (wire_type, rc, *args) = n
-
-    if wire_type in "NEWS":
-        def resolve_possible_names(n):
-            (direction, rc, length, slot) = n
-            orientation = "H" if direction in "EW" else "V"
-            for i, (rr,cc) in enumerate(resolve_node_rcs(device, n)):
-                nr = rr + rel_to[0]
-                nc = cc + rel_to[1]
-                yield f"R{nr}C{nc}_{orientation}0{length}{direction}0{slot}0{i}"
-
-        fullnodes = get_full_node_set(device)
-        existing_nodes = [n for n in resolve_possible_names(n) if n in fullnodes]
-
-        assert(len(existing_nodes) < 2)
-        if len(existing_nodes) == 0:
-            logging.debug(f"No nodes found for {n} {rel_to}")
-        return next(iter(existing_nodes), None)
-
-    if wire_type.startswith("G:"):
-        (r,c) = rc
-        return f"R{r}C{c}_{wire_type.split(":")[1]}"
-
-    if wire_type.startswith("B:"):
-        print(f"{n} relative to {rel_to}")
-        assert (False)
-
-    if wire_type.startswith("C:"):
-        (r,c) = (rc[0] + rel_to[0], rc[1])
-        return f"R{r}C{c}_{wire_type.split(":")[1]}"
-
-    (r,c) = (rc[0] + rel_to[0], rc[1] + rel_to[1])
-    if (r < 0) or c < 0:
-        return None
-    return f"R{r}C{c}_{wire_type}"
+    resolver = NodeResolver.get(device)
+    return resolver.actual(n, resolver.to_rc(rel_to))
 
 
 class TilesHelper:
@@ -815,10 +1216,7 @@ class TilesHelper:
         for unique_prefix in unique_prefixes:
             if tiletype.startswith(unique_prefix):
 
-                def match_by_r_and_tiletype(_, tile_info):
-                    return tile_info['tiletype'].startswith(unique_prefix)  # and rel_to[0] == tile_info['y']
-
-                return get_tiles_by_filter(self.device, match_by_r_and_tiletype)
+                return dict(TileGrid.get(self.device).with_tiletype_prefix(unique_prefix))
 
         return self.resolve_anon_tile(anon_tile, rel_to)
 
@@ -864,3 +1262,11 @@ class TilesHelper:
             match_type = type
 
         return [t for t in get_tiles_by_rc(device, match_rc) if t.split(":")[-1] == match_type]
+
+def _reset_after_fork():
+    # Locks held by other threads at fork time would never be released in the child
+    TileGrid._lock = threading.Lock()
+    RCCodec._lock = threading.Lock()
+    NodeResolver._lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
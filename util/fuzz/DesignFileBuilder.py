@@ -8,6 +8,7 @@ import asyncio
 from asyncio import CancelledError
 
 import fuzzconfig
+import scheduler
 import tiles
 from pathlib import Path
 from os import path
@@ -53,6 +54,7 @@ def create_design_file(config, elements, prefix = "", executor = None):
 
     return config.build_design(vfile, prefix=prefix)
 
+@scheduler.task_class("build")
 def create_wires_file(config, wires, prefix = "", executor = None):
     if executor is not None:
         future = executor.submit(create_wires_file, config, wires, prefix)
@@ -93,6 +95,7 @@ endmodule
 
     return config.build_design(vfile, prefix=prefix)
 
+@scheduler.task_class("build")
 def get_wires_delta(device, wires, prefix = "", executor = None, with_bitstream_info=False, job_name = None):
     if executor is not None:
         f = executor.submit(get_wires_delta, device, wires, prefix, with_bitstream_info=with_bitstream_info)
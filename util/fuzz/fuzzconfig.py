@@ -10,13 +10,15 @@ import pickle
 import threading
 from collections import defaultdict
 from concurrent.futures import Future
-from functools import cache
 from multiprocessing.synchronize import RLock
 from os import path
 from pathlib import Path
 from string import Template
 import radiant
 import database
+import scheduler
+import threadsafe
+from threadsafe import cache
 import libpyprjoxide
 import cachecontrol
 
@@ -34,15 +36,9 @@ class LockedObject:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.lock.release()
 
-_db_lock = None
-
+@cache
 def db_lock():
-    global _db_lock
-    if _db_lock is None:
-        db = libpyprjoxide.Database(database.get_db_root())
-        _db_lock = LockedObject(db)
-
-    return _db_lock
+    return LockedObject(libpyprjoxide.Database(database.get_db_root()))
 
 
 
@@ -72,7 +68,7 @@ def devices_to_fuzz():
 def get_baseline_chip(baseline):
     with db_lock() as db:
         logging.info(f"Loading {baseline}")
-        return libpyprjoxide.Chip.from_bitstream(db, baseline)
+        return libpyprjoxide.Chip.from_bitstream(db, baseline.source)
 
 def find_baseline_differences_hash_fn(args, kwds):
     device = kwds["device"]
@@ -80,8 +76,8 @@ def find_baseline_differences_hash_fn(args, kwds):
     if baseline is None:
         baseline = FuzzConfig.standard_empty(device)
 
-    kwds["active_bitstream"] = hashlib.sha1(open(kwds["active_bitstream"].bitstream, 'br').read()).hexdigest()
-    kwds["baseline"] = hashlib.sha1(open(baseline.bitstream, 'br').read()).hexdigest()
+    kwds["active_bitstream"] = kwds["active_bitstream"].sha1
+    kwds["baseline"] = baseline.sha1
 
     sorted_kwargs = sorted(kwds.items())
 
@@ -95,9 +91,9 @@ def find_baseline_differences(device, active_bitstream, ignore_tiles=set(), base
     if baseline is None:
         baseline = FuzzConfig.standard_empty(device)
 
-    baseline_chip = get_baseline_chip(baseline.bitstream)
+    baseline_chip = get_baseline_chip(baseline)
     with db_lock() as db:
-        deltas, ip_values = baseline_chip.delta_with_ipvalues(db, active_bitstream.bitstream)
+        deltas, ip_values = baseline_chip.delta_with_ipvalues(db, active_bitstream.source)
         ip_values = [(a, v) for a, v in ip_values if v != 0]
 
     filtered_deltas = {k: v for k, v in deltas.items() if k not in ignore_tiles}
@@ -110,21 +106,60 @@ def read_design_template(des_template):
         return inf.read()
 
 class BitstreamInfo:
-    def __init__(self, config, bitstream_file, vfiles):
+    """
+    A built bitstream. Cache hits hold the bitstream in memory and only write it to bitstream_file when something
+    asks for the path; pass `source` to libpyprjoxide, which takes either.
+    """
+    def __init__(self, config, bitstream_file, vfiles, contents = None, sha1 = None):
         self.config = config
         assert isinstance(bitstream_file, str)
-        self.bitstream = bitstream_file
+        self.bitstream_file = bitstream_file
         self.vfiles = vfiles
+        self.contents = contents
+        self._sha1 = sha1
+
+    @property
+    def bitstream(self):
+        """Path to the bitstream, writing it out first if it is only held in memory"""
+        if self.contents is not None and not path.exists(self.bitstream_file):
+            os.makedirs(path.dirname(self.bitstream_file), exist_ok=True)
+            tmp_file = f"{self.bitstream_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "wb") as f:
+                f.write(self.contents)
+            os.replace(tmp_file, self.bitstream_file)
+        return self.bitstream_file
+
+    @property
+    def source(self):
+        """The bitstream contents if they are in memory, its path otherwise"""
+        return self.contents if self.contents is not None else self.bitstream_file
+
+    @property
+    def sha1(self):
+        """sha1 of the uncompressed bitstream"""
+        if self._sha1 is None:
+            if self.contents is not None:
+                contents = self.contents
+            elif self.bitstream_file.endswith(".gz"):
+                with gzip.open(self.bitstream_file, "rb") as f:
+                    contents = f.read()
+            else:
+                with open(self.bitstream_file, "rb") as f:
+                    contents = f.read()
+            self._sha1 = hashlib.sha1(contents).hexdigest()
+        return self._sha1
 
     def __str__(self):
-        return f"BitstreamInfo: {self.bitstream}"
+        if self.contents is not None:
+            return f"BitstreamInfo: {self.sha1} (in memory)"
+        return f"BitstreamInfo: {self.bitstream_file}"
 
 
 class FuzzConfig:
-    _standard_empty_bitfile = {}
-    radiant_cache_hits = 0
-    radiant_builds = 0
-    delta_skips = 0
+    radiant_cache_hits = threadsafe.Counter()
+    radiant_builds = threadsafe.Counter()
+    radiant_failure_hits = threadsafe.Counter()
+    delta_skips = threadsafe.Counter()
 
     def __init__(self, device, job, tiles=[], sv = None):
         """
@@ -148,18 +183,15 @@ class FuzzConfig:
     @staticmethod
     @cache
     def standard_empty(device):
-        if device not in FuzzConfig._standard_empty_bitfile:
-            cfg = FuzzConfig(job=f"standard-empty-file", device=device, tiles=[])
-            FuzzConfig._standard_empty_bitfile[device] = cfg.build_design(cfg.sv, {}, prefix="baseline/")
-            pass
-        return FuzzConfig._standard_empty_bitfile[device]
+        cfg = FuzzConfig(job=f"standard-empty-file", device=device, tiles=[])
+        return cfg.build_design(cfg.sv, {}, prefix="baseline/")
 
     @staticmethod
     @cache
     def standard_chip(device):
         with db_lock() as db:
             baseline = FuzzConfig.standard_empty(device)
-            return libpyprjoxide.Chip.from_bitstream(db, baseline.bitstream)
+            return libpyprjoxide.Chip.from_bitstream(db, baseline.source)
 
     @property
     def workdir(self):
@@ -185,7 +217,7 @@ class FuzzConfig:
     def check_deltas(self, name):
         if os.path.exists(f"{self.delta_dir()}/{self.job}/{name}.ron"):
             logging.debug(f"Delta exists for {name} {self.job} {self.device}; skipping")
-            FuzzConfig.delta_skips = FuzzConfig.delta_skips + 1
+            FuzzConfig.delta_skips.increment()
             return True
         logging.debug(f"{self.delta_dir()}/{self.job}/{name}.ron miss")
         return False
@@ -232,6 +264,7 @@ class FuzzConfig:
         future.executor = executor
         return future
 
+    @scheduler.task_class("build")
     def build_design(self, des_template, substitutions = {}, prefix="", substitute=True, executor = None):
         assert ' ' not in prefix
         """
@@ -252,29 +285,24 @@ class FuzzConfig:
 
         subst = subst_defaults | subst
 
-        os.makedirs(path.join(self.workdir, prefix), exist_ok=True)
         desfile = path.join(self.workdir, prefix + "design.v")
+        pdcfile = path.join(self.workdir, prefix + "design.pdc")
 
         bitfile = path.join(self.workdir, prefix + "design.bit")
         bitfile_gz = path.join(self.workdir, prefix + "design.bit.gz")
         logging.debug(f"Building {des_template} with subs {substitutions} into {desfile}")
 
-        if "sysconfig" in subst:
-            pdcfile = path.join(self.workdir, prefix + "design.pdc")
-            with open(pdcfile, "w") as pdcf:
-                pdcf.write("ldc_set_sysconfig {{{}}}\n".format(subst["sysconfig"]))
-
-        for bf in [bitfile, bitfile_gz]:
-            if path.exists(bf):
-                os.remove(bf)
-
         template_contents = read_design_template(des_template)
+        design = Template(template_contents).substitute(**subst) if substitute else template_contents
+        pdc = "ldc_set_sysconfig {{{}}}\n".format(subst["sysconfig"]) if "sysconfig" in subst else None
 
-        with open(desfile, "w") as ouf:
-            if substitute:
-                ouf.write(Template(template_contents).substitute(**subst))
-            else:
-                ouf.write(template_contents)
+        def write_inputs():
+            os.makedirs(path.join(self.workdir, prefix), exist_ok=True)
+            with open(desfile, "w") as ouf:
+                ouf.write(design)
+            if pdc is not None:
+                with open(pdcfile, "w") as pdcf:
+                    pdcf.write(pdc)
 
         env = os.environ.copy()
         if self.struct_mode:
@@ -284,35 +312,73 @@ class FuzzConfig:
 
         needs_udb = self.struct_mode and self.udb_specimen is None
 
+        # Lookups and commits happen here rather than in radiant.sh. Cache hits are served from memory; the work
+        # directory is only touched for the udb specimen, or for everything with OXIDE_WRITE_ARTIFACTS set
         import bitstreamcache
-        cached_result = bitstreamcache.fetch(self.device, [desfile], env=env)
-        foundFile = None
-        for (outprod, gzfile) in cached_result:
-            if gzfile.endswith(".bit.gz"):
-                FuzzConfig.radiant_cache_hits = FuzzConfig.radiant_cache_hits + 1
-                foundFile = gzfile
-            elif needs_udb and gzfile.endswith(".udb.gz"):
-                with gzip.open(gzfile, 'rb') as gzf:
-                    self.udb_specimen = path.join(self.workdir, prefix, "par.udb")
-                    Path(self.udb_specimen).parent.mkdir(parents=True, exist_ok=True)
-                    with open(self.udb_specimen, 'wb') as outf:
-                        outf.write(gzf.read())
-
-        if foundFile is not None:
-            rtn = BitstreamInfo(self, foundFile, desfile)
+        cache_inputs = {desfile: design.encode()}
+        if pdc is not None and not self.struct_mode:
+            cache_inputs[pdcfile] = pdc.encode()
+        cached_result = bitstreamcache.fetch_in_memory(self.device, cache_inputs, env=env)
+        if cached_result is not None and "par.bit" in cached_result:
+            FuzzConfig.radiant_cache_hits.increment()
+            if needs_udb and "par.udb" in cached_result:
+                udb_specimen = path.join(self.workdir, prefix, "par.udb")
+                Path(udb_specimen).parent.mkdir(parents=True, exist_ok=True)
+                self.udb_specimen = cached_result["par.udb"].write(udb_specimen)
+
+            bit = cached_result["par.bit"]
+            rtn = BitstreamInfo(self, path.join(self.workdir, prefix, f"{bit.sha1}.bit"), desfile,
+                                contents=bit.contents, sha1=bit.sha1)
+            if os.environ.get("OXIDE_WRITE_ARTIFACTS", ""):
+                write_inputs()
+                rtn.bitstream
+
             if executor is not None:
                 f = Future()
                 f.set_result(rtn)
                 return f
             return rtn
 
+        # Designs that failed before fail the same way without running Radiant
+        failure = bitstreamcache.fetch_failure(self.device, cache_inputs, env=env)
+        if failure is not None:
+            FuzzConfig.radiant_failure_hits.increment()
+            kind, message, error_lines = failure
+            logging.debug(f"Replaying cached build failure for {desfile}: {message}")
+            exception = radiant.RadiantRunError(message, error_lines) if kind == "RadiantRunError" else Exception(message)
+            if executor is not None:
+                f = Future()
+                f.set_exception(exception)
+                return f
+            raise exception
+
+        write_inputs()
+        for bf in [bitfile, bitfile_gz]:
+            if path.exists(bf):
+                os.remove(bf)
+
+        @scheduler.task_class("build")
         def run_radiant_sh():
-            FuzzConfig.radiant_builds = FuzzConfig.radiant_builds + 1
-            process_results = radiant.run(self.device, desfile, struct_ver=self.struct_mode, raw_bit=False, rbk_mode=self.rbk_mode)
+            FuzzConfig.radiant_builds.increment()
+            try:
+                process_results = radiant.run(self.device, desfile, struct_ver=self.struct_mode, raw_bit=False,
+                                              rbk_mode=self.rbk_mode, bitstream_cache=False)
+            except radiant.RadiantRunError as e:
+                # Only failures the tools explained; a crash or a missing license says nothing about the design
+                if len(e.error_lines):
+                    bitstreamcache.commit_failure(self.device, cache_inputs, "RadiantRunError", e.message,
+                                                  e.error_lines, env=env)
+                raise
 
             error_output = process_results.stderr.decode().strip()
             if "ERROR <" in error_output:
-                raise Exception(f"Error found during bitstream build: {error_output} (Args: {self.device} {desfile})")
+                message = f"Error found during bitstream build: {error_output} (Args: {self.device} {desfile})"
+                bitstreamcache.commit_failure(self.device, cache_inputs, "Exception", message, [], env=env)
+                raise Exception(message)
+
+            products = [path.join(self.workdir, prefix + "design.tmp", p) for p in ["par.udb", "par.bit"]]
+            if all(path.exists(p) and path.getsize(p) > 0 for p in products):
+                bitstreamcache.commit_by_contents(self.device, cache_inputs, products, env=env)
 
             if self.struct_mode and self.udb_specimen is None:
                 self.udb_specimen = path.join(self.workdir, prefix + "design.tmp", "par.udb")
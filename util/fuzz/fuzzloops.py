@@ -2,20 +2,26 @@
 General Utilities for Fuzzing
 """
 import asyncio
+import bisect
+import gc
 import logging
+import multiprocessing
 import os
 import signal
 import threading
 import time
 import traceback
 from asyncio import CancelledError
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, Future
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed
 from contextlib import contextmanager
 from signal import SIGINT, SIGTERM
 from threading import Thread, RLock
 
 import lapie
+import scheduler
+import threadsafe
+from nodes_database import NodesDatabase
 
 async def wrap_future(f):
     if f is not None:
@@ -34,64 +40,221 @@ def jobs():
 def Executor(executor=None):
     cleanup = executor is None
     if executor is None:
-        executor = ThreadPoolExecutor(jobs())
+        executor = scheduler.Scheduler(jobs())
     try:
         yield executor
     finally:
         if cleanup:
             executor.shutdown(wait=True)
 
-error_count = 0
-def parallel_foreach(items, func, jobs = None):
+class LoopProgress:
+    """
+    Progress and per-item timings of one running parallel_foreach. Live loops are listed in active_loops, which the
+    FuzzerAsyncMain status panel shows.
+    """
+    # Upper bounds in seconds of the timing histogram buckets
+    buckets = [0.01, 0.1, 1, 10, 60, 600, float("inf")]
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.histogram = [0] * len(LoopProgress.buckets)
+        self.busy_time = 0.0
+        self.slowest = (0.0, None)
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, item, duration, failed = False):
+        with self._lock:
+            self.done = self.done + 1
+            if failed:
+                self.failed = self.failed + 1
+            self.busy_time = self.busy_time + duration
+            self.histogram[bisect.bisect_left(LoopProgress.buckets, duration)] += 1
+            if duration > self.slowest[0]:
+                self.slowest = (duration, item)
+
+    def status(self):
+        failed = f" {self.failed} failed" if self.failed else ""
+        return f"{self.name} {self.done}/{self.total}{failed}"
+
+    def summary(self):
+        def bound(b):
+            return f"<{b:g}s" if b != float("inf") else f">={LoopProgress.buckets[-2]:g}s"
+        histogram = " ".join(f"{bound(b)}:{n}" for b, n in zip(LoopProgress.buckets, self.histogram) if n)
+        return (f"{self.name}: {self.done} items ({self.failed} failed) in {time.time() - self.start:.1f}s, "
+                f"mean {self.busy_time / max(self.done, 1):.2f}s, slowest {self.slowest[0]:.2f}s ({self.slowest[1]!r}), "
+                f"{histogram}")
+
+active_loops = []
+_active_loops_lock = threading.Lock()
+
+def loop_status():
+    """One line status of the parallel_foreach loops currently running"""
+    with _active_loops_lock:
+        return " ".join(p.status() for p in active_loops)
+
+# Loops running at least this long log their timing summary at info level
+summary_log_threshold = 10
+
+error_count = threadsafe.Counter()
+def parallel_foreach(items, func, jobs = None, mode = "thread", devices = (), chunk_size = 1, errors = "raise",
+                     progress = None, name = None):
     """
     Run a function over a list of values, running a number of jobs
     in parallel. OXIDE_JOBS should be set to the number of jobs to run,
-    defaulting to 4.
+    defaulting to 4. Returns the results in the order of items.
+
+    Items are handed out chunk_size at a time from a shared queue; raise chunk_size for many tiny items. With
+    errors="raise" the first failure stops the remaining items from starting and is raised once the running ones
+    finish. errors="collect" runs every item and then raises an ExceptionGroup of all failures.
+
+    Every item is timed into a LoopProgress, which is shown in the fuzzer status panel while the loop runs and
+    summarised in the log afterwards. progress, if given, is called with it after each item.
+
+    mode="process" runs func in forked worker processes instead of threads, for CPU bound pure Python work. func
+    and items are inherited by the workers rather than pickled, so closures work; side effects of func stay in the
+    worker, only return values come back. The lookups of each of devices are loaded before forking so that every
+    worker shares them (see preload_device_data). Locks, tool sessions and loader threads of the util modules are
+    reset in the workers by their at-fork hooks, so a worker that does query lapie starts its own sessions.
     """
     if jobs is None:
         if "OXIDE_JOBS" in os.environ:
             jobs = int(os.environ["OXIDE_JOBS"])
         else:
             jobs = 4
-
-    items_queue = list(items)
-    items_lock = RLock()
-
-    exception = None
+    assert errors in ("raise", "collect"), f"Unknown parallel_foreach error policy {errors}"
+
+    items = list(items)
+    chunks = [range(i, min(i + chunk_size, len(items))) for i in range(0, len(items), chunk_size)]
+    loop = LoopProgress(name or getattr(func, "__name__", "loop"), len(items))
+    results = [None] * len(items)
+    exceptions = []
+
+    def record(idx, duration, exception = None):
+        loop.record(items[idx], duration, failed=exception is not None)
+        if exception is not None:
+            if error_count.increment() <= 10:
+                logging.error(f"Error in {loop.name} on {items[idx]!r}: {exception}")
+                traceback.print_exception(exception)
+            exceptions.append(exception)
+        if progress is not None:
+            progress(loop)
 
     global is_in_loop
     is_in_loop = True
+    with _active_loops_lock:
+        active_loops.append(loop)
+    try:
+        if mode == "process":
+            _parallel_foreach_processes(items, func, jobs, devices, chunks, errors, results, record)
+        else:
+            assert mode == "thread", f"Unknown parallel_foreach mode {mode}"
+            _parallel_foreach_threads(items, func, jobs, chunks, errors, results, record)
+    finally:
+        with _active_loops_lock:
+            active_loops.remove(loop)
+        is_in_loop = len(active_loops) > 0
+
+    logging.log(logging.INFO if time.time() - loop.start >= summary_log_threshold else logging.DEBUG, loop.summary())
+
+    if errors == "raise" and len(exceptions):
+        raise exceptions[0]
+    if len(exceptions):
+        raise ExceptionGroup(f"{len(exceptions)} of {len(items)} items of {loop.name} failed", exceptions)
+    return results
+
+def _parallel_foreach_threads(items, func, jobs, chunks, errors, results, record):
+    # deque.popleft is atomic, so idle threads take the next chunk without a lock
+    queue = deque(chunks)
+
     def runner():
-        nonlocal exception
+        while True:
+            try:
+                chunk = queue.popleft()
+            except IndexError:
+                return
 
-        try:            
-            while True:
-                with items_lock:
-                    if len(items_queue) == 0:
+            for idx in chunk:
+                s = time.time()
+                try:
+                    results[idx] = func(items[idx])
+                except Exception as e:
+                    record(idx, time.time() - s, e)
+                    if errors == "raise":
+                        queue.clear()
                         return
-                    item = items_queue[0]
-                    items_queue.pop(0)
+                else:
+                    record(idx, time.time() - s)
 
-                func(item)
-        except Exception as e:
-            global error_count
-            if error_count < 10:
-                error_count = error_count + 1
-                logging.error(f"Error: {e}")
-                traceback.print_exc()
-            
-            exception = e
-            with items_lock:
-                items_queue.clear()
-
-    threads = [Thread(target=runner) for i in range(jobs)]
+    threads = [Thread(target=runner) for i in range(min(jobs, len(chunks)))]
     for t in threads:
         t.start()
     for t in threads:
         t.join()
-    if exception is not None:
-        raise exception
-    is_in_loop = False
+
+def preload_device_data(device):
+    """
+    Load the per-device lookups fuzz helpers use -- tilegrid indexes, RC codec, node resolver and the node to tile
+    ownership index -- in this process. The ownership index is memory mapped from the cache folder, so it is shared by the page cache;
+    the rest is inherited copy-on-write by forked workers.
+    """
+    import tiles
+
+    tiles.TileGrid.get(device)
+    tiles.RCCodec.get(device)
+    tiles.NodeResolver.get(device)
+    tiles.get_node_list_lookups(device)
+
+# What the workers of a process mode parallel_foreach run; inherited through fork
+_process_lock = threading.Lock()
+_process_func = None
+_process_items = None
+
+def _run_process_chunk(indices, errors):
+    out = []
+    for i in indices:
+        s = time.time()
+        try:
+            out.append((i, _process_func(_process_items[i]), None, time.time() - s))
+        except Exception as e:
+            out.append((i, None, e, time.time() - s))
+            if errors == "raise":
+                break
+    return out
+
+def _parallel_foreach_processes(items, func, jobs, devices, chunks, errors, results, record):
+    global _process_func, _process_items
+
+    for device in devices:
+        preload_device_data(device)
+
+    # Each task costs a round trip to a worker, so hand out a few tasks per worker rather than every chunk
+    per_task = max(1, len(chunks) // (jobs * 4))
+    tasks = [[i for chunk in chunks[t:t + per_task] for i in chunk] for t in range(0, len(chunks), per_task)]
+
+    with _process_lock:
+        _process_func, _process_items = func, items
+        # Keep the inherited objects out of the workers' garbage collection, which would otherwise touch and copy
+        # their pages
+        gc.freeze()
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as pool:
+                futures = [pool.submit(_run_process_chunk, task, errors) for task in tasks]
+                for f in as_completed(futures):
+                    failed = False
+                    for i, result, exception, duration in f.result():
+                        results[i] = result
+                        record(i, duration, exception)
+                        failed = failed or exception is not None
+                    if failed and errors == "raise":
+                        pool.shutdown(wait=True, cancel_futures=True)
+                        break
+        finally:
+            gc.unfreeze()
+            _process_func, _process_items = None, None
 
 def gather_futures(futures, name = None):
     """
@@ -135,12 +298,12 @@ def gather_futures(futures, name = None):
         else:
             _done(i, fut)
 
-    if executor is not None and hasattr(executor, "register_future"):
-        executor.register_future(out)
-
     if name is not None:
         out.name = name
 
+    if executor is not None and hasattr(executor, "register_future"):
+        executor.register_future(out, after=futures)
+
     if n == 0:
         out.set_result([])
 
@@ -163,7 +326,9 @@ def chain(future, func, *args, **kwargs):
         try:
             r = f.result()
             if hasattr(f, 'executor'):
-                new_f = f.executor.submit(func, r, *args, **kwargs)
+                # Continuations consume finished builds; unless func says otherwise they are solves, which the
+                # scheduler starts ahead of new builds
+                new_f = f.executor.submit_task(func, (r, *args), kwargs, resource=scheduler.resource_of(func, "solve"))
                 new_f.add_done_callback(lambda f, fut=fut: fut.set_result(f.result()))
                 new_f.name = name
             else:
@@ -179,13 +344,13 @@ def chain(future, func, *args, **kwargs):
         except:
             fut.set_exception(Exception("Unknown exception in future"))
 
-    future.add_done_callback(_done)
-    if hasattr(future, 'executor'):
-        future.executor.register_future(fut)
-
     if name is not None:
         fut.name = name
 
+    future.add_done_callback(_done)
+    if hasattr(future, 'executor'):
+        future.executor.register_future(fut, after=[future])
+
     return fut
 
 class AsyncExecutor:
@@ -195,16 +360,28 @@ class AsyncExecutor:
         self.loop = asyncio.get_running_loop()
         self.executor = executor
     def submit(self, f, *args, **kwargs):
-        future = self.loop.run_in_executor(None, lambda args=args,kwargs=kwargs: f(*args, **kwargs))
+        return self.submit_task(f, args, kwargs)
+
+    def submit_task(self, f, args = (), kwargs = None, **options):
+        """submit, with the resource class, priority and dependencies of scheduler.Scheduler.submit_task"""
+        kwargs = kwargs or {}
+        if isinstance(self.executor, scheduler.Scheduler):
+            task = self.executor.submit_task(f, args, kwargs, **options)
+        else:
+            task = self.executor.submit(lambda: f(*args, **kwargs))
+        future = asyncio.wrap_future(task, loop=self.loop)
+        future.task_id = getattr(task, "task_id", None)
 
         future.name = f.__name__
-        self.register_future(future)
+        self.register_future(future, track=False)
         return future
 
-    def register_future(self, future):
+    def register_future(self, future, after = (), track = True):
         future.executor = self
         with self.lock:
             self.futures.append(future)
+        if track and hasattr(self.executor, "register_future"):
+            self.executor.register_future(future, after=after)
 
     def iterate_futures(self):
         with self.lock:
@@ -279,7 +456,7 @@ def FuzzerAsyncMain(f, *args, **kwargs):
                     f"[bold cyan]{status}[/bold cyan]",
                     title=f"Status - {FUZZER_TITLE}",
                     border_style="blue",
-                    height=3,
+                    height=3 + status.count("\n"),
                 )
 
             async def ui(async_executor, task):
@@ -322,7 +499,14 @@ def FuzzerAsyncMain(f, *args, **kwargs):
                             for fut in async_executor.iterate_futures(): process_future(fut)
                             for fut in asyncio.all_tasks(): process_future(fut)
 
-                            text = f"{list(histogram.items())} {async_executor.task_count()} {finished_tasks} finished {len(all_exceptions)} errors, built/cached {FuzzConfig.radiant_builds}/{FuzzConfig.radiant_cache_hits} tool queries {lapie.run_with_udb_cnt} {int(time.time() - start_time)}s"
+                            text = f"{list(histogram.items())} {async_executor.task_count()} {finished_tasks} finished {len(all_exceptions)} errors, built/cached/known failures {FuzzConfig.radiant_builds}/{FuzzConfig.radiant_cache_hits}/{FuzzConfig.radiant_failure_hits} tool queries {lapie.run_with_udb_cnt} {NodesDatabase.writer_status()} {int(time.time() - start_time)}s"
+                            if hasattr(async_executor.executor, "status"):
+                                text = f"{text}\n{async_executor.executor.status()}"
+                                blocked = async_executor.executor.blocked()
+                                if len(blocked):
+                                    text = f"{text} {blocked}"
+                            if len(active_loops):
+                                text = f"{text}\n{loop_status()}"
 
                             live.update(status_panel(text))
                             await asyncio.sleep(1)
@@ -18,6 +18,7 @@ import tiles
 import database
 import fuzzconfig
 import fuzzloops
+import scheduler
 from DesignFileBuilder import get_wires_delta, DesignsForPips, BitConflictException, create_wires_file
 
 def make_dict_of_lists(lst, key = None):
@@ -64,9 +65,7 @@ def collect_sinks(config, nodenames, regex = False,
                  nodename_filter_union=False,
                  ):
     if regex:
-        all_nodes = lapie.get_full_node_list(config.device)
-        regex = [re.compile(n) for n in nodenames]
-        nodenames = [n for n in all_nodes if any([r for r in regex if r.search(n) is not None])]
+        nodenames = sorted(lapie.find_nodes(config.device, nodenames))
         regex = False
 
     nodes = lapie.get_node_data(config.device, nodenames, regex)
@@ -116,14 +115,14 @@ def fuzz_interconnect_sinks(
 
     def process_bits(bitstreams, from_wires, to_wire):
         base_bitf = bitstreams[0]
-        bitstreams = [b.bitstream if b is not None else None for b in bitstreams[1:]]
+        bitstreams = [b.source if b is not None else None for b in bitstreams[1:]]
 
         with fuzzconfig.db_lock() as db:
-            fz = libpyprjoxide.Fuzzer.pip_fuzzer(db, base_bitf.bitstream, set(config.tiles), to_wire,
+            fz = libpyprjoxide.Fuzzer.pip_fuzzer(db, base_bitf.source, set(config.tiles), to_wire,
                                                  config.tiles[0],
                                                  set(ignore_tiles), full_mux_style, not (fc_filter(to_wire)))
 
-            pip_samples = [(from_wire, arc_bit if arc_bit is not None else base_bitf.bitstream) for (from_wire, arc_bit) in zip(from_wires, bitstreams)]
+            pip_samples = [(from_wire, arc_bit if arc_bit is not None else base_bitf.source) for (from_wire, arc_bit) in zip(from_wires, bitstreams)]
             fz.add_pip_samples(db, pip_samples)
 
             logging.debug(f"Solving for {to_wire}")
@@ -247,7 +246,7 @@ def fuzz_interconnect_pins(config, site_name, extra_substs = {}, full_mux_style
         prefix = "{}_{}_{}_".format(config.job, config.device, to_wire)
 
         with fuzzconfig.db_lock() as db:
-            fz = libpyprjoxide.Fuzzer.pip_fuzzer(db, base_bitf.bitstream,
+            fz = libpyprjoxide.Fuzzer.pip_fuzzer(db, base_bitf.source,
                                                  set(config.tiles),
                                                  to_wire,
                                                  config.tiles[0], set(), full_mux_style, not (fc_filter(to_wire)))
@@ -260,7 +259,7 @@ def fuzz_interconnect_pins(config, site_name, extra_substs = {}, full_mux_style
 
             print(f"Building design for ({config.job} {config.device}) {to_wire} to {from_wire}")
             arc_bit = config.build_design(config.sv, substs, prefix)
-            fz.add_pip_sample(db, from_wire, arc_bit.bitstream)
+            fz.add_pip_sample(db, from_wire, arc_bit.source)
 
         config.solve(fz, db)
 
@@ -270,6 +269,7 @@ def fuzz_interconnect_pins(config, site_name, extra_substs = {}, full_mux_style
 
 # Cache this so we only do it once. Could also probably read the ron file and check it.
 @cachecontrol.cache_fn()
+@scheduler.task_class("db")
 def register_tile_connections(device, tiletype, tile, conn_pips):
     with fuzzconfig.db_lock() as db:
         db = libpyprjoxide.Database(database.get_db_root())
@@ -409,7 +409,7 @@ async def fuzz_interconnect_sinks_across_span(
 
     nodes = set([w for p in pips for w in p])
 
-    nodeinfos = {n.name:n for n in lapie.get_node_data(config.device, nodes)}
+    nodeinfos = {n.name:n for n in await lapie.get_node_data_async(config.device, nodes)}
     if builder is not None: builder.reserve(1)
 
     device = config.device
@@ -48,10 +48,10 @@ def fuzz_word_setting(config, name, length, get_sv_substs, desc="", executor = N
             baseline = bitstreams[0]
             bitstreams = bitstreams[1:]
             with fuzzconfig.db_lock() as db:
-                fz = libpyprjoxide.Fuzzer.word_fuzzer(db, baseline.bitstream, set(config.tiles), name, desc, length,
-                                                      baseline.bitstream)
+                fz = libpyprjoxide.Fuzzer.word_fuzzer(db, baseline.source, set(config.tiles), name, desc, length,
+                                                      baseline.source)
                 for i in range(length):
-                    fz.add_word_sample(db, i, bitstreams[i].bitstream)
+                    fz.add_word_sample(db, i, bitstreams[i].source)
 
                 try:
                     config.solve(fz, db)
@@ -111,20 +111,20 @@ def fuzz_enum_setting(config, empty_bitfile, name, values, get_sv_substs, includ
 
         def integrate_bitstreams(bitstreams):
             with fuzzconfig.db_lock() as db:
-                fz = libpyprjoxide.Fuzzer.enum_fuzzer(db, empty_bitfile.bitstream, set(config.tiles), name, desc,
+                fz = libpyprjoxide.Fuzzer.enum_fuzzer(db, empty_bitfile.source, set(config.tiles), name, desc,
                                                       include_zeros, assume_zero_base,
                                                       mark_relative_to=mark_relative_to, overlay=overlay)
 
                 for idx, (opt, bitstream) in enumerate(bitstreams):
-                    logging.debug(f"Enum sample for {name}={opt} with {bitstream.bitstream} {bitstream.vfiles}")
+                    logging.debug(f"Enum sample for {name}={opt} with {bitstream} {bitstream.vfiles}")
                     transaction_log.info(f"add_enum_sample {config.device}: {name} {opt} Files: {bitstream.vfiles}")
 
-                    fz.add_enum_sample(db, opt, bitstream.bitstream)
+                    fz.add_enum_sample(db, opt, bitstream.source)
 
                 try:
                     config.solve(fz, db)
                 except BaseException as e:
-                    logging.error(f"Enum sample error for {name} with {bitstream.bitstream} {bitstream.vfiles}")
+                    logging.error(f"Enum sample error for {name} with {bitstream} {bitstream.vfiles}")
                     transaction_log.info(f"add_enum_sample error {e}")
                     raise
 
@@ -168,10 +168,10 @@ def fuzz_ip_word_setting(config, name, length, get_sv_substs, desc="", default=N
             baseline = bitstreams[0]
             ipcore, iptype = config.tiles[0].split(":")
             with fuzzconfig.db_lock() as db:
-                fz = libpyprjoxide.IPFuzzer.word_fuzzer(db, baseline.bitstream, ipcore, iptype, name, desc, length, inverted_mode)
+                fz = libpyprjoxide.IPFuzzer.word_fuzzer(db, baseline.source, ipcore, iptype, name, desc, length, inverted_mode)
                 for (i, bitfile) in enumerate(bitstreams[1:]):
                     bits = [(j >> i) & 0x1 == (1 if inverted_mode else 0) for j in range(length)]
-                    fz.add_word_sample(db, bits, bitfile.bitstream)
+                    fz.add_word_sample(db, bits, bitfile.source)
                 config.solve(fz, db)
 
         return fuzzloops.chain([baseline_future, *bitstream_futures], "Solve IP word", integrate_bitstreams)
@@ -203,9 +203,9 @@ def fuzz_ip_enum_setting(config, empty_bitfile, name, values, get_sv_substs, des
 
         def integrate_bitstreams(bitstreams):
             with fuzzconfig.db_lock() as db:
-                fz = libpyprjoxide.IPFuzzer.enum_fuzzer(db, empty_bitfile.bitstream, ipcore, iptype, name, desc)
+                fz = libpyprjoxide.IPFuzzer.enum_fuzzer(db, empty_bitfile.source, ipcore, iptype, name, desc)
                 for (opt, bitfile) in zip(values, bitstreams):
-                    fz.add_enum_sample(db, opt, bitfile.bitstream)
+                    fz.add_enum_sample(db, opt, bitfile.source)
                 config.solve(fz, db)
 
         return fuzzloops.chain(bitstream_futures,  "Solve IP enum", integrate_bitstreams)